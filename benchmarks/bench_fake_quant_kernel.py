@@ -0,0 +1,67 @@
+"""Micro-benchmark of the eager and compiled observe + fake quantize kernels.
+
+Example:
+    python benchmarks/bench_fake_quant_kernel.py --dtype int8 fp8_e4m3 --shapes 4096x4096
+"""
+import argparse
+import time
+
+import torch
+
+import quantized_training as qt
+from quantized_training import FusedAmaxObsFakeQuantize
+from quantized_training.quantizer.quantizer import get_default_qmax
+
+
+def _parse_shape(s):
+    return tuple(int(x) for x in s.split("x"))
+
+
+def _time(fn, x, iters, device):
+    for _ in range(3):
+        fn(x)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn(x)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / iters * 1e3
+    peak = torch.cuda.max_memory_allocated() / 2**20 if device.type == "cuda" else float("nan")
+    return elapsed, peak
+
+
+def benchmark(dtype, shape, input_dtype, qscheme, iters, device):
+    kwargs = dict(qscheme=qscheme, quant_max=get_default_qmax(dtype), ch_axis=0, device=device)
+    eager = FusedAmaxObsFakeQuantize(dtype, **kwargs)
+    compiled = FusedAmaxObsFakeQuantize(dtype, compile_kernel=True, **kwargs)
+    inplace = FusedAmaxObsFakeQuantize(dtype, compile_kernel=True, inplace=True, **kwargs)
+
+    x = torch.randn(shape, dtype=input_dtype, device=device)
+    results = [("eager", *_time(eager, x, iters, device)),
+               ("compiled", *_time(compiled, x, iters, device))]
+    with torch.inference_mode():
+        results.append(("compiled inplace", *_time(inplace, x.clone(), iters, device)))
+
+    for name, ms, peak in results:
+        print(f"{dtype:>10} {str(qscheme.value):>22} {str(shape):>16} {str(input_dtype):>15} "
+              f"{name:>17} {ms:9.3f} ms {peak:9.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dtype", nargs="+", default=["int8", "fp8_e4m3", "posit8_1"])
+    parser.add_argument("--shapes", nargs="+", type=_parse_shape, default=[(512, 768), (4096, 4096)])
+    parser.add_argument("--input_dtype", nargs="+", default=["float32", "bfloat16"])
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    for dtype in args.dtype:
+        for shape in args.shapes:
+            for input_dtype in args.input_dtype:
+                for qscheme in [qt.per_tensor_symmetric, qt.per_channel_symmetric]:
+                    benchmark(dtype, shape, getattr(torch, input_dtype), qscheme, args.iters, device)
@@ -0,0 +1,86 @@
+"""Compare the merged and the low-rank forward of qat.LoraLinear on a stack
+of RoBERTa-large sized projections. A training step runs forward and
+backward with the base weights frozen, like LoRA fine-tuning.
+
+The merged forward builds and fake quantizes an out x in weight per layer on
+every step. The low-rank forward reuses the cached quantized base weight and
+only quantizes the adapters. Peak memory is only reported on CUDA.
+
+Example:
+    python benchmarks/bench_lora.py --hidden 1024 --rank 8 --num_layers 4
+"""
+import argparse
+import time
+
+import torch
+from peft import LoraConfig, get_peft_model
+from torch import nn
+
+import quantized_training as qt
+from quantized_training import get_qconfig, propagate_config
+from quantized_training.modules import qat
+
+
+def _make_model(args, device):
+    torch.manual_seed(0)
+    base = nn.Sequential(*(nn.Linear(args.hidden, args.hidden) for _ in range(args.num_layers)))
+    model = get_peft_model(base, LoraConfig(
+        r=args.rank, lora_alpha=2 * args.rank,
+        target_modules=[str(i) for i in range(args.num_layers)],
+    ))
+    qspec = qt.QuantizationSpec.from_str(args.qspec)
+    propagate_config(model, "qconfig", get_qconfig(None, qspec, None))
+    for i in range(args.num_layers):
+        model.base_model.model[i] = qat.LoraLinear.from_float(model.base_model.model[i])
+    return model.to(device)
+
+
+def _time_step(model, x, iters):
+    def step():
+        model(x).sum().backward()
+
+    for _ in range(3):
+        step()
+    if x.device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(iters):
+            step()
+        if x.device.type == "cuda":
+            torch.cuda.synchronize()
+        best = min(best, (time.perf_counter() - start) / iters)
+    peak = (torch.cuda.max_memory_allocated() - base) / 2**20 if x.device.type == "cuda" else float("nan")
+    return best, peak
+
+
+def main(args):
+    device = torch.device(args.device)
+    x = torch.randn(args.batch, args.seq_len, args.hidden, device=device)
+    results = {}
+    for name, low_rank in [("merged", False), ("low_rank", True)]:
+        model = _make_model(args, device)
+        for module in model.modules():
+            if isinstance(module, qat.LoraLinear):
+                module.low_rank_forward = low_rank
+        results[name] = _time_step(model, x, args.iters)
+
+    for name, (elapsed, peak) in results.items():
+        speedup = results["merged"][0] / elapsed
+        print(f"{name:>9} {elapsed * 1e3:8.2f} ms/step  {speedup:5.2f}x  peak {peak:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden", type=int, default=1024)
+    parser.add_argument("--rank", type=int, default=8)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--seq_len", type=int, default=128)
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--qspec", default="int8,qs=per_tensor_symmetric")
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    main(parser.parse_args())
@@ -0,0 +1,105 @@
+"""Measure inference throughput of a stack of qat.LoraLinear layers that
+serves many adapters, with every request of a batch naming its own adapter.
+
+Compares one forward per adapter group on its slice of the batch against
+one batched forward with set_batch_adapters(), and against the same batch
+served by a single adapter as the reference throughput. With --merged the
+layers use the merged forward, and the batched forward multiplies the rows
+of each adapter by its cached merged weight.
+
+Example:
+    python benchmarks/bench_lora_serving.py --num_adapters 32 --batch 64
+"""
+import argparse
+import random
+import time
+
+import torch
+from peft import LoraConfig, get_peft_model
+from torch import nn
+
+import quantized_training as qt
+from quantized_training import get_qconfig, propagate_config, set_batch_adapters
+from quantized_training.modules import qat
+
+
+def _make_model(args):
+    torch.manual_seed(0)
+    base = nn.Sequential(*(nn.Linear(args.hidden, args.hidden) for _ in range(args.num_layers)))
+    target_modules = [str(i) for i in range(args.num_layers)]
+    model = get_peft_model(
+        base, LoraConfig(r=args.rank, lora_alpha=2 * args.rank, target_modules=target_modules),
+        adapter_name="task0",
+    )
+    for i in range(1, args.num_adapters):
+        model.add_adapter(f"task{i}", LoraConfig(
+            r=args.rank, lora_alpha=2 * args.rank, target_modules=target_modules))
+    qspec = qt.QuantizationSpec.from_str(args.qspec)
+    propagate_config(model, "qconfig", get_qconfig(None, qspec, None))
+    for i in range(args.num_layers):
+        layer = qat.LoraLinear.from_float(model.base_model.model[i])
+        layer.low_rank_forward = not args.merged
+        model.base_model.model[i] = layer
+    return model.base_model.model.eval()
+
+
+def _time(fn, iters):
+    with torch.no_grad():
+        for _ in range(3):
+            fn()
+        best = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            for _ in range(iters):
+                fn()
+            best = min(best, (time.perf_counter() - start) / iters)
+    return best
+
+
+def main(args):
+    model = _make_model(args)
+    x = torch.randn(args.batch, args.seq_len, args.hidden)
+    random.seed(0)
+    names = [f"task{random.randrange(args.num_adapters)}" for _ in range(args.batch)]
+
+    def per_group():
+        out = torch.empty_like(x)
+        for adapter in set(names):
+            rows = torch.tensor([i for i, name in enumerate(names) if name == adapter])
+            for layer in model:
+                layer.set_adapter(adapter)
+            out[rows] = model(x[rows])
+        return out
+
+    def single_adapter():
+        return model(x)
+
+    def batched():
+        return model(x)
+
+    for layer in model:
+        layer.set_adapter("task0")
+    results = {"single adapter": _time(single_adapter, args.iters)}
+    results["per group"] = _time(per_group, args.iters)
+    set_batch_adapters(model, names)
+    results["batched"] = _time(batched, args.iters)
+    set_batch_adapters(model, None)
+
+    for name, elapsed in results.items():
+        throughput = args.batch / elapsed
+        print(f"{name:>15} {elapsed * 1e3:8.2f} ms/batch  {throughput:8.1f} requests/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden", type=int, default=1024)
+    parser.add_argument("--rank", type=int, default=8)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--num_adapters", type=int, default=32)
+    parser.add_argument("--seq_len", type=int, default=32)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--qspec", default="int8,qs=per_tensor_symmetric")
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--merged", action="store_true",
+                        help="serve the merged forward instead of the low-rank forward")
+    main(parser.parse_args())
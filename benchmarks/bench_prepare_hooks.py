@@ -0,0 +1,98 @@
+"""Measure the per-step cost of the activation and error observer hooks
+installed by prepare(), with observers created lazily by the hooks or up front
+from an input arity table or example inputs.
+
+Small tensors keep the step dominated by Python overhead, like QAT of small
+models such as MobileBERT-tiny. With ``--observer identity`` the observers
+are replaced by nn.Identity to measure the hooks alone.
+
+Example:
+    python benchmarks/bench_prepare_hooks.py --num_blocks 96 --hidden 32 --observer identity
+"""
+import argparse
+import time
+
+import torch
+from torch import nn
+
+import quantized_training as qt
+from quantized_training import QConfig, get_qconfig, prepare, propagate_config
+from quantized_training.modules.quantizable import AddFunctional, MatmulFunctional, MulFunctional
+from quantized_training.quantization_mappings import MODULE_INPUT_ARITY
+
+
+class Block(nn.Module):
+    def __init__(self, hidden):
+        super().__init__()
+        self.query = nn.Linear(hidden, hidden)
+        self.key = nn.Linear(hidden, hidden)
+        self.scaling = MulFunctional()
+        self.matmul = MatmulFunctional()
+        self.softmax = nn.Softmax(dim=-1)
+        self.gelu = nn.GELU()
+        self.residual = AddFunctional()
+
+    def forward(self, x):
+        scores = self.matmul(self.scaling(self.query(x), 0.125), self.key(x).transpose(-1, -2))
+        return self.residual(x, self.gelu(self.softmax(scores) @ x))
+
+
+def _time_step(model, x, iters, backward):
+    def step():
+        if backward:
+            model(x).sum().backward()
+        else:
+            with torch.no_grad():
+                model(x)
+
+    for _ in range(3):
+        step()
+    # Best of several runs, the per-hook costs are small compared to the noise
+    best = float("inf")
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(iters):
+            step()
+        best = min(best, (time.perf_counter() - start) / iters)
+    return best
+
+
+def main(args):
+    x = torch.randn(args.batch, args.seq_len, args.hidden, requires_grad=True)
+    if args.observer == "identity":
+        identity = lambda device=None: nn.Identity()
+        qconfig = QConfig(activation=identity, weight=None, error=identity)
+    else:
+        qspec = qt.QuantizationSpec.from_str(args.qspec)
+        qconfig = get_qconfig(qspec, None, qspec)
+    # Error observers are only installed when the backward pass is timed
+    ops = ("gemm,activation,residual,scaling", "gemm,residual" if args.backward else None)
+
+    baseline = nn.Sequential(*(Block(args.hidden) for _ in range(args.num_blocks)))
+    propagate_config(baseline, "qconfig", qconfig)
+    results = {"no hooks": _time_step(baseline, x, args.iters, args.backward)}
+
+    for name, kwargs in [
+        ("lazy", {}),
+        ("input_arity", {"input_arity": MODULE_INPUT_ARITY}),
+        ("example_inputs", {"example_inputs": (x,)}),
+    ]:
+        model = prepare(baseline, False, *ops, **kwargs)
+        results[name] = _time_step(model, x, args.iters, args.backward)
+
+    for name, elapsed in results.items():
+        overhead = elapsed - results["no hooks"]
+        print(f"{name:>15} {elapsed * 1e3:8.2f} ms/step  hooks + observers {overhead * 1e3:8.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_blocks", type=int, default=96)
+    parser.add_argument("--hidden", type=int, default=32)
+    parser.add_argument("--seq_len", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--qspec", default="int8,qs=per_tensor_symmetric")
+    parser.add_argument("--observer", choices=["fake_quant", "identity"], default="fake_quant")
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--backward", action="store_true", help="Time forward and backward")
+    main(parser.parse_args())
@@ -0,0 +1,53 @@
+"""Benchmark fake quantizer construction with and without the shared
+quantization map cache.
+
+Example:
+    python benchmarks/bench_quant_map_cache.py --dtype posit8_1 --num_observers 1000
+"""
+import argparse
+import time
+
+import torch
+
+from quantized_training.fake_quantize import (
+    FusedAmaxObsFakeQuantize,
+    get_fake_quant_fn,
+)
+
+
+def _legacy_quant_map(dtype, device):
+    values = torch.arange(2 ** 16, dtype=torch.int16, device=device).view(torch.bfloat16)
+    return get_fake_quant_fn(dtype)(values)
+
+
+def _unique_bytes(tensors):
+    storages = {t.untyped_storage().data_ptr(): t.untyped_storage().nbytes() for t in tensors}
+    return sum(storages.values())
+
+
+def benchmark(dtype, num_observers, device):
+    start = time.perf_counter()
+    legacy_maps = [_legacy_quant_map(dtype, device) for _ in range(num_observers)]
+    legacy_time = time.perf_counter() - start
+    legacy_bytes = _unique_bytes(legacy_maps)
+    del legacy_maps
+
+    start = time.perf_counter()
+    observers = [FusedAmaxObsFakeQuantize(dtype, device=device) for _ in range(num_observers)]
+    shared_time = time.perf_counter() - start
+    shared_bytes = _unique_bytes([obs.quant_map for obs in observers])
+
+    print(f"dtype={dtype} observers={num_observers} device={device}")
+    print(f"  per-instance maps: {legacy_time:8.3f} s  {legacy_bytes / 2**20:8.2f} MB")
+    print(f"  shared maps:       {shared_time:8.3f} s  {shared_bytes / 2**20:8.2f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dtype", nargs="+", default=["int8", "fp8_e4m3", "posit8_1"])
+    parser.add_argument("--num_observers", type=int, default=500)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    for dtype in args.dtype:
+        benchmark(dtype, args.num_observers, args.device)
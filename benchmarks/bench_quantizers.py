@@ -0,0 +1,67 @@
+"""Compare the lookup table and the arithmetic quantizer of each format.
+
+Example:
+    python benchmarks/bench_quantizers.py --dtype int8 fp8_e4m3 fp6_e3m2 --shapes 4096x4096
+"""
+import argparse
+import time
+
+import torch
+
+from quantized_training.fake_quantize import (
+    _get_arithmetic_quant_fn,
+    _quantize,
+    get_quantization_map,
+)
+
+
+def _parse_shape(s):
+    return tuple(int(x) for x in s.split("x"))
+
+
+def _time(fn, x, iters, device):
+    for _ in range(3):
+        fn(x)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn(x)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / iters
+    peak = (torch.cuda.max_memory_allocated() - base) / 2**20 if device.type == "cuda" else float("nan")
+    return elapsed, peak
+
+
+def benchmark(dtype, shape, input_dtype, iters, device):
+    x = torch.randn(shape, dtype=input_dtype, device=device) * 4
+    quant_map = get_quantization_map(dtype, device)
+    quantizers = [("lut", lambda x: _quantize(x, quant_map))]
+    if _get_arithmetic_quant_fn(dtype, input_dtype) is not None:
+        quantizers.append(("arithmetic", lambda x: _quantize(x, quant_map, dtype)))
+
+    reference = quantizers[-1][1](x)
+    for name, fn in quantizers:
+        elapsed, peak = _time(fn, x, iters, device)
+        mismatches = (fn(x) != reference).sum().item()
+        print(f"{dtype:>10} {str(shape):>16} {str(input_dtype):>15} {name:>10} "
+              f"{x.numel() / elapsed / 1e9:8.3f} Gelem/s {peak:9.1f} MB {mismatches:>8} mismatches")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dtype", nargs="+", default=["int8", "fp8_e4m3", "fp8_e5m2", "fp6_e3m2", "posit8_1", "nf4"])
+    parser.add_argument("--shapes", nargs="+", type=_parse_shape, default=[(4096, 4096)])
+    parser.add_argument("--input_dtype", nargs="+", default=["float32", "bfloat16"])
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    for dtype in args.dtype:
+        for shape in args.shapes:
+            for input_dtype in args.input_dtype:
+                benchmark(dtype, shape, getattr(torch, input_dtype), args.iters, device)
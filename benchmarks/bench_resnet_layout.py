@@ -0,0 +1,86 @@
+"""Compare the throughput of a QAT ResNet-50 in the NCHW and the channels_last
+(NHWC) memory format. Conv and BN pairs are fused into qat.ConvBn2d with
+weight fake quantization, and the conv inputs are fake quantized by the
+activation observers of prepare(). With an MX format the blocks run along the
+channels, which are contiguous in NHWC.
+
+Requires torchvision.
+
+Example:
+    python benchmarks/bench_resnet_layout.py --qspec fp8_e4m3,qs=microscaling,bs=32,ax=1 --batch 16
+"""
+import argparse
+import time
+
+import torch
+from torchvision import models
+
+import quantized_training as qt
+from quantized_training import convert, get_qconfig, prepare, propagate_config
+from quantized_training.quantization_mappings import DEFAULT_QAT_MODULE_MAPPINGS
+
+
+def _conv_bn_pairs(model):
+    names = [name for name, _ in model.named_modules()]
+    pairs = [["conv1", "bn1"]]
+    for name in names:
+        if name.endswith(".downsample"):
+            pairs.append([f"{name}.0", f"{name}.1"])
+        elif name.rsplit(".", 1)[-1].startswith("conv") and "." in name:
+            pairs.append([name, name.replace(".conv", ".bn")])
+    return pairs
+
+
+def _make_model(args):
+    torch.manual_seed(0)
+    model = models.resnet50()
+    model.train()
+    model = torch.ao.quantization.fuse_modules_qat(model, _conv_bn_pairs(model))
+    qspec = qt.QuantizationSpec.from_str(args.qspec)
+    propagate_config(model, "qconfig", get_qconfig(qspec, qspec, None))
+    convert(model, DEFAULT_QAT_MODULE_MAPPINGS, inplace=True)
+    prepare(model, True, "gemm")
+    return model
+
+
+def _time(fn, iters):
+    for _ in range(2):
+        fn()
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn()
+        best = min(best, (time.perf_counter() - start) / iters)
+    return best
+
+
+def main(args):
+    x = torch.randn(args.batch, 3, 224, 224)
+    results = {}
+    for layout, memory_format in [("nchw", torch.contiguous_format), ("nhwc", torch.channels_last)]:
+        model = _make_model(args).to(memory_format=memory_format)
+        input = x.contiguous(memory_format=memory_format)
+
+        def train_step():
+            model(input).sum().backward()
+
+        def eval_step():
+            with torch.no_grad():
+                model(input)
+
+        model.train()
+        results[f"{layout} train"] = _time(train_step, args.iters)
+        model.eval()
+        results[f"{layout} eval"] = _time(eval_step, args.iters)
+
+    for name, elapsed in results.items():
+        print(f"{name:>10} {elapsed * 1e3:9.1f} ms/batch  {args.batch / elapsed:7.1f} images/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--qspec", default="int8,qs=per_tensor_symmetric")
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--iters", type=int, default=3)
+    main(parser.parse_args())
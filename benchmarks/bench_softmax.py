@@ -0,0 +1,61 @@
+"""Compare the speed and error of nn.Softmax, the posit lookup table Softmax
+and the integer-only IntSoftmax on attention scores.
+
+Example:
+    python benchmarks/bench_softmax.py --shapes 8x12x128x128 --scale 3.0
+"""
+import argparse
+import time
+
+import torch
+from torch import nn
+
+from quantized_training.modules import IntSoftmax, Softmax
+
+
+def _parse_shape(s):
+    return tuple(int(x) for x in s.split("x"))
+
+
+def _time(fn, x, iters, device):
+    for _ in range(3):
+        fn(x)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn(x)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+def benchmark(shape, scale, iters, device):
+    # Scores with a standard deviation of ``scale``, like scaled QK^T
+    x = torch.randn(shape, device=device) * scale
+    softmaxes = [
+        ("nn.Softmax", nn.Softmax(dim=-1)),
+        ("posit", Softmax(posit_exp=True, posit_reciprocal=True, dim=-1)),
+        ("int", IntSoftmax(dim=-1)),
+    ]
+
+    reference = torch.softmax(x.double(), dim=-1)
+    with torch.no_grad():
+        for name, softmax in softmaxes:
+            elapsed = _time(softmax, x, iters, device)
+            error = (softmax(x).double() - reference).abs()
+            print(f"{str(shape):>20} {name:>10} {elapsed * 1e3:9.3f} ms "
+                  f"max err {error.max().item():.2e} mean err {error.mean().item():.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shapes", nargs="+", type=_parse_shape, default=[(8, 12, 128, 128)])
+    parser.add_argument("--scale", type=float, default=3.0)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    for shape in args.shapes:
+        benchmark(shape, args.scale, args.iters, device)
@@ -88,6 +88,8 @@ parser.add_argument('--max_pool2x2', action="store_true",
                     help="Whether to replace 3x3 maxpool with 2x2.")
 parser.add_argument('--bn_folding', action="store_true",
                     help="Whether to fold batch normalization into conv.")
+parser.add_argument('--channels_last', action="store_true",
+                    help="Whether to run the model in the channels_last (NHWC) memory format.")
 parser.add_argument('--model_id', default=None, help="Model checkpoint for evaluation.")
 parser.add_argument('--save_val_dataset', action="store_true",
                     help="Whether to save the validation dataset.")
@@ -227,6 +229,11 @@ def main_worker(gpu, ngpus_per_node, args):
     args.do_train = True
     quantize(model, args)
 
+    # Convolutions with channels_last weights also return channels_last
+    # outputs for NCHW inputs, so only the model needs to be converted
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
     example_inputs = torch.randn(1, 3, 224, 224).to(device)
     if args.bf16:
         example_inputs = example_inputs.bfloat16()
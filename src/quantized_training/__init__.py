@@ -18,11 +18,14 @@ __all__ = [
     "add_qspec_args",
     "convert",
     "dispatch_model",
+    "decode_posit",
     "dtype_byte_size",
+    "encode_posit",
     "get_device_map",
     "get_qconfig",
     "get_quantized_model",
     "get_default_quantizer",
+    "merge_and_quantize",
     "plot_histogram",
     "plot_layer_range",
     "prepare",
@@ -30,10 +33,13 @@ __all__ = [
     "propagate_config",
     "propagate_fake_tensor",
     "quantize",
+    "quantize_weights_",
     "quantize_to_fp8_e4m3",
     "quantize_to_fp8_e5m2",
     "quantize_to_posit",
+    "replace_activation",
     "replace_softmax",
+    "set_batch_adapters",
     "setup_logging",
 ]
 
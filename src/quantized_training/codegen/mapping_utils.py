@@ -323,6 +323,7 @@ def map_reduce(node, output_dir):
         torch.ops.aten.mean.dim,
         torch.ops.aten._softmax.default,
         torch.ops.aten.softmax.int,
+        torch.ops.quantized_ops.softmax_int.default,
     ]:
         return None
     param = ReduceParam()
@@ -330,6 +331,9 @@ def map_reduce(node, output_dir):
     param.opcode = node.target.__name__.split(".")[0]
     _set_tensor_field(param.input, node.args[0], output_dir)
     _set_repeated_field(param.dim, node.args[1])
+    if node.target == torch.ops.quantized_ops.softmax_int.default:
+        param.scale = node.args[2]
+        param.output_bits = node.args[3] if len(node.args) > 3 else 8
     return param
 
 
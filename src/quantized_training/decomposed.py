@@ -1,10 +1,14 @@
+import math
 from typing import Tuple, Union, Optional
 
 import torch
 import torch.nn.functional as F
 from torch.library import Library, impl
 
-from .fake_quantize import _quantize
+from .fake_quantize import (
+    _amax_obs_fake_quant,
+    _quantize,
+)
 
 
 def _broadcast_shapes(input, target, block_size=32):
@@ -18,6 +22,33 @@ def _broadcast_shapes(input, target, block_size=32):
         input = input[slices]
     return input
 
+def _apply_block_scale(fn, input, scale, block_size):
+    """Compute ``fn(input, scale)`` where the scale has one entry per block
+    of ``block_size`` elements. Blocked dimensions of the input are viewed as
+    (blocks, block_size), so the scale broadcasts without being repeated to
+    the input size and channels_last inputs are not copied. Ragged blocks
+    fall back to repeating the scale.
+    """
+    dims = [
+        dim for dim in range(scale.ndim)
+        if dim < input.ndim and scale.shape[dim] not in (1, input.shape[dim])
+    ]
+    if scale.ndim != input.ndim or any(
+        scale.shape[dim] * block_size != input.shape[dim] for dim in dims
+    ):
+        return fn(input, _broadcast_shapes(scale, input, block_size))
+
+    for i, dim in enumerate(dims):
+        input = input.unflatten(dim + i, (scale.shape[dim], block_size))
+        scale = scale.unsqueeze(dim + i + 1)
+    output = fn(input, scale)
+    for i, dim in reversed(list(enumerate(dims))):
+        output = output.flatten(dim + i, dim + i + 1)
+    return output
+
+def _mul_exp2(input, scale):
+    return input * (2 ** scale)
+
 # Note: decomposed means decomposed quantized tensor, using decomposed so that the
 # name is not too long
 quantized_decomposed_lib = Library("quantized_ops", "DEF")
@@ -49,8 +80,8 @@ def quantize_symmetric(
     """
 
     if block_size is not None:
-        scale = _broadcast_shapes(scale, input, block_size)
-    return _quantize(input / scale, quant_map)
+        return _quantize(_apply_block_scale(torch.div, input, scale, block_size), quant_map, dtype)
+    return _quantize(input / scale, quant_map, dtype)
 
 quantized_decomposed_lib.define(
     "dequantize_symmetric(Tensor input, Tensor scale, str? dtype, Tensor quant_map) -> Tensor")
@@ -77,9 +108,45 @@ def dequantize_symmetric(
     """
 
     if dtype is not None:
-        return _quantize(input, quant_map) * scale
+        return _quantize(input, quant_map, dtype) * scale
     return input * scale
 
+_AMAX_OBS_FAKE_QUANTIZE_ARGS = (
+    "Tensor quant_map, Tensor(b!) amax_history, Tensor(c!) amax_history_idx, "
+    "Tensor(d!) block_max, Tensor(e!) scale, int amax_history_len, int history_block_size, "
+    "float? quant_max, int? ch_axis, bool per_row_fake_quant, bool force_scale_power_of_two, "
+    "bool observer_enabled, bool fake_quant_enabled, str? dtype=None"
+)
+
+quantized_decomposed_lib.define(
+    f"amax_obs_fake_quantize(Tensor input, {_AMAX_OBS_FAKE_QUANTIZE_ARGS}) -> Tensor")
+
+@impl(quantized_decomposed_lib, "amax_obs_fake_quantize", "CompositeExplicitAutograd")
+def amax_obs_fake_quantize(input: torch.Tensor, *args) -> torch.Tensor:
+    """ Update the amax history and scale from the input and fake quantize the
+    input, using a kernel compiled by torch.compile. See
+    FusedAmaxObsFakeQuantFunction for the meaning of the arguments.
+    """
+    return _amax_obs_fake_quant(input, *args, compile_kernel=True)
+
+quantized_decomposed_lib.define(
+    f"amax_obs_fake_quantize_(Tensor(a!) input, {_AMAX_OBS_FAKE_QUANTIZE_ARGS}) -> Tensor(a!)")
+
+@impl(quantized_decomposed_lib, "amax_obs_fake_quantize_", "CompositeExplicitAutograd")
+def amax_obs_fake_quantize_(input: torch.Tensor, *args) -> torch.Tensor:
+    """ In-place variant of amax_obs_fake_quantize """
+    return _amax_obs_fake_quant(input, *args, inplace=True, compile_kernel=True)
+
+# Meta kernels let the ops be traced by torch.compile. The history and scale
+# buffers are updated in place and keep their shapes.
+@impl(quantized_decomposed_lib, "amax_obs_fake_quantize", "Meta")
+def amax_obs_fake_quantize_meta(input: torch.Tensor, *args) -> torch.Tensor:
+    return torch.empty_like(input)
+
+@impl(quantized_decomposed_lib, "amax_obs_fake_quantize_", "Meta")
+def amax_obs_fake_quantize__meta(input: torch.Tensor, *args) -> torch.Tensor:
+    return input
+
 quantized_decomposed_lib.define(
     "conv2d_mx(Tensor input, Tensor weight, Tensor? bias=None, SymInt[2] stride=1, SymInt[2] padding=0, SymInt[2] dilation=1, SymInt groups=1, Tensor? scale_inp=None, Tensor? scale_wt=None, SymInt? block_size=None) -> Tensor")
 
@@ -97,11 +164,9 @@ def conv2d_mx(
     block_size: Optional[int] = None,
 ) -> torch.Tensor:
     if scale_inp is not None:
-        scale_inp = _broadcast_shapes(scale_inp, input, block_size)
-        input = input * (2 ** scale_inp)
+        input = _apply_block_scale(_mul_exp2, input, scale_inp, block_size)
     if scale_wt is not None:
-        scale_wt = _broadcast_shapes(scale_wt, weight, block_size)
-        weight = weight * (2 ** scale_wt)
+        weight = _apply_block_scale(_mul_exp2, weight, scale_wt, block_size)
     return F.conv2d(input, weight, bias, stride, padding, dilation, groups)
 
 quantized_decomposed_lib.define(
@@ -117,11 +182,9 @@ def linear_mx(
     block_size: Optional[int] = None,
 ) -> torch.Tensor:
     if scale_inp is not None:
-        scale_inp = _broadcast_shapes(scale_inp, input, block_size)
-        input = input * (2 ** scale_inp)
+        input = _apply_block_scale(_mul_exp2, input, scale_inp, block_size)
     if scale_wt is not None:
-        scale_wt = _broadcast_shapes(scale_wt, weight, block_size)
-        weight = weight * (2 ** scale_wt)
+        weight = _apply_block_scale(_mul_exp2, weight, scale_wt, block_size)
     return F.linear(input, weight, bias)
 
 quantized_decomposed_lib.define(
@@ -136,9 +199,56 @@ def matmul_mx(
     block_size: Optional[int] = None,
 ) -> torch.Tensor:
     if scale_inp is not None:
-        scale_inp = _broadcast_shapes(scale_inp, input, block_size)
-        input = input * (2 ** scale_inp)
+        input = _apply_block_scale(_mul_exp2, input, scale_inp, block_size)
     if scale_wt is not None:
-        scale_wt = _broadcast_shapes(scale_wt, weight, block_size)
-        weight = weight * (2 ** scale_wt)
+        weight = _apply_block_scale(_mul_exp2, weight, scale_wt, block_size)
     return torch.matmul(input, weight)
+
+quantized_decomposed_lib.define(
+    "softmax_int(Tensor input, int dim, float scale, int output_bits=8) -> Tensor")
+
+@impl(quantized_decomposed_lib, "softmax_int", "CompositeExplicitAutograd")
+def softmax_int(
+    input: torch.Tensor,
+    dim: int,
+    scale: float,
+    output_bits: int = 8,
+) -> torch.Tensor:
+    """ Integer-only softmax from I-BERT (Kim et al., 2021). The input is
+    rounded to integers with the given scale and every following step only
+    uses integer arithmetic: exp(x) = 2^-z * exp(r) with r in (-ln2, 0], a
+    second order polynomial for exp(r), an integer sum and an integer division
+    of 2^32 by the sum.
+
+    Args:
+       input (torch.Tensor): float32 or bfloat16 Tensor
+       dim (int): dimension along which softmax is computed
+       scale (float): scale of the integer input, in [2^-14, ln2)
+       output_bits (int): number of fraction bits of the output
+
+    Returns:
+       Tensor with the same dtype as input holding multiples of 2^-output_bits
+    """
+    # exp(r) ~= a * (r + b)^2 + c on (-ln2, 0]
+    a, b, c = 0.3585, 1.353, 0.344
+    q_ln2 = math.floor(math.log(2) / scale)
+    q_b = math.floor(b / scale)
+    q_c = math.floor(c / (a * scale ** 2))
+
+    # The polynomial fits in 32 bits for scales down to about 2^-14, the sum
+    # and the normalization need 64 bits. The input is clamped so that masked
+    # positions (-inf or the dtype minimum) and the max subtraction do not
+    # overflow int32. Past -31 * ln2 the shifted exponential is already zero.
+    q = torch.mul(input.float(), 1 / scale).round_().clamp_(-2 ** 30, 2 ** 30).int()
+    q -= torch.amax(q, dim=dim, keepdim=True)
+    q.clamp_(min=-31 * q_ln2)
+
+    z = torch.div(q, -q_ln2, rounding_mode="floor")
+    r = q.add_(z * q_ln2)
+    exp_int = r.add_(q_b).square_().add_(q_c).bitwise_right_shift_(z.clamp_(max=31))
+    del z
+
+    exp_sum = torch.sum(exp_int, dim=dim, keepdim=True, dtype=torch.int64)
+    factor = torch.div(1 << 32, exp_sum, rounding_mode="floor")
+    output = torch.mul(exp_int, factor).bitwise_right_shift_(32 - output_bits)
+    return output.to(input.dtype).mul_(2 ** -output_bits)
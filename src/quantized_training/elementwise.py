@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import torch
+
+__all__ = [
+    "apply_elementwise",
+]
+
+
+def apply_elementwise(
+    fn: Callable[[torch.Tensor], torch.Tensor],
+    input: torch.Tensor,
+    chunk_size: Optional[int] = None,
+    out: Optional[torch.Tensor] = None,
+    num_threads: int = 0,
+) -> torch.Tensor:
+    """Apply an elementwise function to the input in chunks of ``chunk_size``
+    elements, so that the temporaries of ``fn`` are bounded by the chunk size
+    instead of the input size.
+
+    Args:
+        fn: elementwise function, e.g. a quantizer
+        input: input tensor
+        chunk_size: number of elements per chunk, or None for a single chunk
+        out: preallocated output with the shape of the input. It may alias
+            the input.
+        num_threads: number of CPU threads that process chunks concurrently
+
+    Returns:
+        The output tensor, which is ``out`` if given.
+    """
+    numel = input.numel()
+    if numel == 0 or (out is None and (chunk_size is None or chunk_size >= numel)):
+        return fn(input)
+
+    chunk_size = chunk_size or numel
+    flat = input.reshape(-1)
+    starts = range(0, numel, chunk_size)
+
+    first = fn(flat[:chunk_size])
+    if out is None:
+        out = torch.empty(input.shape, dtype=first.dtype, device=input.device)
+    assert out.shape == input.shape, (
+        f"out has shape {tuple(out.shape)} but the input has shape {tuple(input.shape)}"
+    )
+    flat_out = out.view(-1) if out.is_contiguous() else torch.empty(
+        numel, dtype=out.dtype, device=out.device)
+    flat_out[:chunk_size] = first
+    del first
+
+    def run(start):
+        flat_out[start:start + chunk_size] = fn(flat[start:start + chunk_size])
+
+    if num_threads > 0 and input.device.type == "cpu":
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(run, starts[1:]))
+    else:
+        for start in starts[1:]:
+            run(start)
+
+    if not out.is_contiguous():
+        out.copy_(flat_out.view(out.shape))
+    return out
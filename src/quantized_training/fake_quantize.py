@@ -1,24 +1,26 @@
+import functools
 import logging
 import math
 import re
+import threading
+import weakref
 from typing import Optional
 
 import torch
 from torch.ao.quantization import FakeQuantizeBase
 
 import quantized_training as qt
-from quantized_training.fp8 import (
-    _quantize_elemwise_core,
-    quantize_to_fp8_e4m3,
-    quantize_to_fp8_e5m2,
-)
+from quantized_training.elementwise import apply_elementwise
+from quantized_training.fp8 import _quantize_elemwise_core
 from quantized_training.mx_utils import (
-    _reshape_to_blocks,
-    _shared_exponents,
-    _undo_reshape_to_blocks,
+    _inverse_permutation,
+    _memory_order,
+    _mx_block_plan,
+    _mx_shared_exponents,
 )
 from quantized_training.normal_float import quantize_to_nf
 from quantized_training.posit import quantize_to_posit
+from quantized_training.quant_tables import load_table
 
 
 __all__ = [
@@ -29,32 +31,73 @@ __all__ = [
 logger = logging.getLogger(__name__)
 
 
-def get_fake_quant_fn(dtype: str):
-    """Return the quantization function for the given dtype."""
-    if (match := re.fullmatch(r'posit(\d+)_(\d+)', dtype)):
-        nbits, es = match.groups()
-        return lambda x: quantize_to_posit(x, int(nbits), int(es), round_to_even=True)
+def _quantize_to_float8(x, float8_dtype, max_norm, inf_to_nan=False):
+    """Round to a native float8 dtype, saturating finite values at max_norm."""
+    out = torch.clamp(x, -max_norm, max_norm).to(float8_dtype).to(x.dtype)
+    if inf_to_nan:
+        return torch.where(torch.isfinite(x), out, torch.nan)
+    return torch.where(torch.isinf(x), x, out)
+
+
+_FLOAT8_DTYPES = {
+    (4, 3): torch.float8_e4m3fn,
+    (5, 2): torch.float8_e5m2,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_arithmetic_quant_fn(dtype: Optional[str], input_dtype=torch.float32):
+    """Return a function that quantizes inputs of ``input_dtype`` to the given
+    dtype without a lookup table, or None if the table should be used.
+    """
+    if dtype is None:
+        return None
 
     if (match := re.fullmatch(r'(?:fp8\.)?(e4m3|e5m2)', dtype, re.IGNORECASE)):
         fp8_format = match.group(1).lower()
-        return quantize_to_fp8_e4m3 if fp8_format == 'e4m3' else quantize_to_fp8_e5m2
+        if fp8_format == 'e4m3':
+            return functools.partial(
+                _quantize_to_float8, float8_dtype=torch.float8_e4m3fn, max_norm=448., inf_to_nan=True)
+        return functools.partial(
+            _quantize_to_float8, float8_dtype=torch.float8_e5m2, max_norm=57344., inf_to_nan=True)
 
     if (match := re.fullmatch(r"fp(\d+)_e(\d+)m(\d+)", dtype)):
         nbits, ebits, mbits = map(int, match.groups())
         assert nbits == ebits + mbits + 1
+        float8_dtype = _FLOAT8_DTYPES.get((ebits, mbits))
         mbits = mbits + 2
         emax = 2 ** (ebits - 1) - 1 if ebits > 4 else 2 ** (ebits - 1)
         if dtype != "fp8_e4m3":
             max_norm = 2**emax * float(2**(mbits-1) - 1) / 2**(mbits-2)
         else:
             max_norm = 2**emax * 1.75
-        return lambda x: _quantize_elemwise_core(x, mbits, ebits, max_norm, "even", True)
+        if float8_dtype is not None:
+            return functools.partial(_quantize_to_float8, float8_dtype=float8_dtype, max_norm=max_norm)
+        # bfloat16 inputs index the quantization map exactly, and the lookup
+        # is much cheaper than _quantize_elemwise_core
+        if input_dtype == torch.bfloat16:
+            return None
+        # The private exponents are computed with log2, which is only exact
+        # in float32
+        return lambda x: _quantize_elemwise_core(
+            x.float(), mbits, ebits, max_norm, "even", True).to(x.dtype)
 
     if (match := re.fullmatch(r'int(\d+)', dtype)):
         nbits = int(match.group(1))
         quant_min, quant_max = -2 ** (nbits - 1), 2 ** (nbits - 1) - 1
         return lambda x: torch.clamp(torch.round(x), quant_min, quant_max)
 
+    return None
+
+
+def _get_lut_quant_fn(dtype: str):
+    """Return the reference function used to build the quantization map of a
+    dtype without an arithmetic implementation.
+    """
+    if (match := re.fullmatch(r'posit(\d+)_(\d+)', dtype)):
+        nbits, es = match.groups()
+        return lambda x: quantize_to_posit(x, int(nbits), int(es), round_to_even=True)
+
     if (match := re.fullmatch(r'nf(\d+)', dtype)):
         nbits = int(match.group(1))
         return lambda x: quantize_to_nf(x, nbits)
@@ -62,7 +105,77 @@ def get_fake_quant_fn(dtype: str):
     raise ValueError(f"Unrecognized dtype: {dtype}")
 
 
-def _quantize(input, quant_map):
+def get_fake_quant_fn(dtype: str):
+    """Return the quantization function for the given dtype.
+
+    Integer and floating point formats are quantized arithmetically, with
+    native float8 casts where possible. Posit and NormalFloat go through the
+    quantization map.
+    """
+    if (quant_fn := _get_arithmetic_quant_fn(dtype)) is not None:
+        return quant_fn
+    _get_lut_quant_fn(dtype)
+    return lambda x: _quantize(x, get_quantization_map(dtype, x.device))
+
+
+# Quantization maps are interned per (dtype, device) and shared by every
+# fake quantizer. The cache only holds weak references, so a map is freed
+# once the last module that uses it is destroyed or moved to another device.
+_QUANT_MAP_CACHE = weakref.WeakValueDictionary()
+_QUANT_MAP_LOCK = threading.Lock()
+
+
+def _canonical_device(device) -> torch.device:
+    device = torch.device(device) if device is not None else torch.device("cpu")
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return device
+
+
+def _build_quantization_map(dtype: str) -> torch.Tensor:
+    values = torch.arange(2 ** 16, dtype=torch.int16).view(torch.bfloat16)
+    quant_fn = _get_arithmetic_quant_fn(dtype) or _get_lut_quant_fn(dtype)
+    return quant_fn(values)
+
+
+def load_quantization_map(dtype: str) -> torch.Tensor:
+    """Load the quantization map of the given dtype from the table store."""
+    return load_table(dtype, lambda: _build_quantization_map(dtype), torch.bfloat16)
+
+
+def get_quantization_map(dtype: Optional[str], device=None) -> torch.Tensor:
+    """Return the shared map from every bfloat16 bit pattern to its quantized
+    value in the given dtype. A dtype of None returns the identity map.
+
+    The returned tensor is shared across callers and must not be modified.
+    """
+    key = (dtype, _canonical_device(device))
+    with _QUANT_MAP_LOCK:
+        quant_map = _QUANT_MAP_CACHE.get(key)
+        if quant_map is None:
+            if dtype is not None:
+                quant_map = load_quantization_map(dtype).to(key[1])
+            else:
+                quant_map = torch.arange(2 ** 16, dtype=torch.int16, device=key[1]).view(torch.bfloat16)
+            _QUANT_MAP_CACHE[key] = quant_map
+    return quant_map
+
+
+def _quantize(input, quant_map, dtype=None, chunk_size=None, out=None, num_threads=0):
+    """Quantize the input to the given dtype. Dtypes with an arithmetic
+    implementation skip the quantization map, everything else looks up the
+    bfloat16 bit pattern of the input in it.
+
+    With ``chunk_size`` or ``out``, the input is quantized in chunks into a
+    preallocated output, see apply_elementwise.
+    """
+    if chunk_size is not None or out is not None:
+        fn = functools.partial(_quantize, quant_map=quant_map, dtype=dtype)
+        return apply_elementwise(fn, input, chunk_size, out, num_threads)
+
+    if (quant_fn := _get_arithmetic_quant_fn(dtype, input.dtype)) is not None:
+        return quant_fn(input)
+
     if input.dtype == torch.bfloat16:
         indices = input.view(torch.int16).to(torch.int32) & 0xffff
     else:
@@ -72,6 +185,37 @@ def _quantize(input, quant_map):
     return quant_map[indices].to(input.dtype)
 
 
+def _exponent_histogram(
+    input: torch.Tensor,
+    sample_size: Optional[int] = None,
+    generator: Optional[torch.Generator] = None,
+) -> torch.Tensor:
+    """Count the unbiased exponents -126 to 127 of the input, read directly
+    from the bfloat16 or float32 bit pattern. Zeros, subnormals, infinities
+    and NaNs are not counted. If ``sample_size`` is given, only that many
+    randomly chosen elements are counted, drawn from ``generator``.
+    """
+    input = input.detach().flatten()
+    if sample_size is not None and sample_size < input.numel():
+        indices = torch.randint(
+            input.numel(), (sample_size,), device=input.device, generator=generator
+        )
+        input = input[indices]
+
+    if input.dtype == torch.bfloat16:
+        exp = (input.view(torch.int16) >> 7) & 0xff
+    else:
+        exp = (input.float().view(torch.int32) >> 23) & 0xff
+
+    if exp.is_cpu:
+        counts = torch.bincount(exp, minlength=256)
+    else:
+        # bincount reads the input max on the host to size its output
+        counts = torch.zeros(256, dtype=torch.long, device=exp.device)
+        counts.index_add_(0, exp.long(), torch.ones(1, dtype=torch.long, device=exp.device).expand_as(exp))
+    return counts[1:255]
+
+
 class MXFakeQuantFunction(torch.autograd.Function):
     """This function performs MX quantization by calculating the scaling
     factor using absolute maximum values in the tensor.
@@ -81,111 +225,284 @@ class MXFakeQuantFunction(torch.autograd.Function):
     def forward(
         ctx,
         input,
-        fake_quant_enabled,
+        fake_quant_enabled: bool,
         quant_map,
         quant_max,
         shared_exp_method="max",
         axes=None,
         block_size=0,
+        dtype=None,
     ):
-        if fake_quant_enabled[0] == 0:
+        if not fake_quant_enabled:
             return input
 
         axes = [axes] if type(axes) == int else axes
-        axes = [x + input.ndim if x < 0 else x for x in axes]
-
-        # Perform tiling to the hardware vector size
-        if block_size > 0:
-            input, axes, orig_shape, padded_shape = _reshape_to_blocks(
-                input, axes, block_size
+        # Permuted inputs, e.g. channels_last activations, are quantized in
+        # memory order and the result is permuted back to the same layout
+        perm, axes = _memory_order(input, axes)
+        if perm is not None:
+            output = MXFakeQuantFunction.forward(
+                ctx, input.permute(perm), fake_quant_enabled, quant_map, quant_max,
+                shared_exp_method, axes, block_size, dtype,
             )
+            return output.permute(_inverse_permutation(perm))
 
-        shared_exp_axes = [x + 1 for x in axes] if block_size > 0 else axes
-
-        # TODO we are abusing shared_exp_method here to handle NormalFloat
+        # Blocks are strided views of the input. A ragged last block is
+        # quantized as a separate segment instead of being padded.
+        _, segments = _mx_block_plan(tuple(input.shape), axes, block_size)
         if shared_exp_method == "max":
-            # Get shared exponents
-            shared_exp = _shared_exponents(
-                input, method=shared_exp_method, axes=shared_exp_axes, ebits=0,
-            )
-
             # Offset the max exponent by the largest representable exponent
             # in the element data format
-            shared_exp = shared_exp - math.floor(math.log2(quant_max))
+            shared_exp = _mx_shared_exponents(input, axes, block_size)
+            scale = torch.exp2(shared_exp - math.floor(math.log2(quant_max))).to(input.dtype)
+
+        output = torch.empty_like(input) if len(segments) > 1 else None
+        for slices, block_shape, amax_shape, reduce_dims, exp_slices in segments:
+            blocks = input[slices].view(block_shape)
+            if shared_exp_method == "max":
+                block_scale = scale[exp_slices].view(amax_shape)
+            else:
+                # TODO we are abusing shared_exp_method here to handle NormalFloat.
+                # NormalFloat requires dividing by the exact absmax value
+                block_scale = torch.amax(torch.abs(blocks), dim=reduce_dims, keepdim=True)
+            out = None if output is None else output[slices].view(block_shape)
+            out = torch.mul(_quantize(blocks / block_scale, quant_map, dtype), block_scale, out=out)
 
-            scale = (2 ** shared_exp).to(input.dtype)
+        if output is None:
+            return out.view(input.shape)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output, None, None, None, None, None, None, None
+
+
+def _history_block_size(amax_history_len: Optional[int]) -> int:
+    """Largest divisor of the history length that does not exceed its square
+    root. The amax history is split into blocks of this size so that the
+    running max only rescans one block per update.
+    """
+    if not amax_history_len:
+        return 1
+    block_size = math.isqrt(amax_history_len)
+    while amax_history_len % block_size != 0:
+        block_size -= 1
+    return block_size
+
+
+def _amax_shape(input, ch_axis, per_row_fake_quant):
+    if not per_row_fake_quant:
+        return torch.Size()
+    ch_axis = ch_axis + input.ndim if ch_axis < 0 else ch_axis
+    return torch.Size(input.shape[i] if i == ch_axis else 1 for i in range(input.ndim))
+
+
+def _fake_quantize_lut(input, scale, quant_map, out=None, dtype=None):
+    """Quantize and dequantize the input with a lookup table, or arithmetically
+    if ``dtype`` allows it. The result is written into ``out`` when given,
+    which may alias the input.
+    """
+    scale = scale.to(input.dtype)
+    return torch.mul(_quantize(input / scale, quant_map, dtype), scale, out=out)
+
+
+def _update_scale(block_max, scale, quant_max, force_scale_power_of_two):
+    amax = torch.amax(block_max, dim=0)
+    sf = amax / quant_max
+    sf = torch.where(amax > 0.0, sf, scale)
+    sf = torch.where(torch.isfinite(amax), sf, scale)
+    if force_scale_power_of_two:
+        sf = torch.pow(2, torch.floor(torch.log2(sf)))
+    scale.copy_(sf)
+
+
+def _update_amax_history(amax_cur, amax_history, amax_history_idx, block_max,
+                         amax_history_len, history_block_size):
+    # Overwrite the oldest entry and rescan the block that contains it
+    num_blocks = amax_history_len // history_block_size
+    amax_history.index_copy_(0, amax_history_idx, amax_cur.unsqueeze(0).to(amax_history.dtype))
+    block_idx = torch.div(amax_history_idx, history_block_size, rounding_mode="floor")
+    blocks = amax_history.view((num_blocks, history_block_size) + amax_history.shape[1:])
+    block_max.index_copy_(0, block_idx, torch.amax(blocks.index_select(0, block_idx), dim=1))
+    amax_history_idx.add_(1).remainder_(amax_history_len)
+
+
+def _amax_and_fake_quant(input, scale, quant_map, ch_axis, per_row_fake_quant,
+                         observer_enabled, fake_quant_enabled, inplace=False, dtype=None):
+    """Compute the amax of the input and fake quantize it with the given
+    scale. These are the only passes over the full input.
+    """
+    amax_cur = None
+    if observer_enabled:
+        if per_row_fake_quant:
+            ch_axis = ch_axis + input.ndim if ch_axis < 0 else ch_axis
+            dim = tuple(i for i in range(input.ndim) if i != ch_axis)
+            amax_cur = torch.amax(torch.abs(input), dim=dim, keepdim=True)
         else:
-            # NormalFloat requires dividing by the exact absmax value
-            scale = torch.amax(torch.abs(input), dim=shared_exp_axes, keepdim=True)
-        input = _quantize(input / scale, quant_map) * scale
+            amax_cur = torch.amax(torch.abs(input))
+
+    if fake_quant_enabled:
+        input = _fake_quantize_lut(input, scale, quant_map, out=input if inplace else None, dtype=dtype)
+
+    return input, amax_cur
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_amax_and_fake_quant():
+    # Inductor fuses the amax reduction and the lookup table quantization
+    # without materializing full-size temporaries.
+    return torch.compile(_amax_and_fake_quant, dynamic=True)
+
+
+def _amax_obs_fake_quant(
+    input: torch.Tensor,
+    quant_map: torch.Tensor,
+    amax_history: torch.Tensor,
+    amax_history_idx: torch.Tensor,
+    block_max: torch.Tensor,
+    scale: torch.Tensor,
+    amax_history_len: int,
+    history_block_size: int,
+    quant_max: Optional[float],
+    ch_axis: Optional[int],
+    per_row_fake_quant: bool,
+    force_scale_power_of_two: bool,
+    observer_enabled: bool,
+    fake_quant_enabled: bool,
+    dtype: Optional[str] = None,
+    inplace: bool = False,
+    compile_kernel: bool = False,
+) -> torch.Tensor:
+    """Observe the amax of the input, update the scale and fake quantize the
+    input. The history buffers must already be initialized.
+
+    The scale only depends on the amax history before this call, so it is
+    updated first and the amax reduction and quantization share one pass.
+    """
+    if observer_enabled:
+        _update_scale(block_max, scale, quant_max, force_scale_power_of_two)
 
-        # Undo tile reshaping
-        if block_size:
-            input = _undo_reshape_to_blocks(input, padded_shape, orig_shape, axes)
+    # Round the scale to the input dtype before the kernel. Inductor would
+    # otherwise skip the rounding and divide by the fp32 scale.
+    kernel = _compiled_amax_and_fake_quant() if compile_kernel else _amax_and_fake_quant
+    input, amax_cur = kernel(
+        input, scale.to(input.dtype), quant_map, ch_axis, per_row_fake_quant,
+        observer_enabled, fake_quant_enabled, inplace, dtype,
+    )
 
-        return input
+    if observer_enabled:
+        _update_amax_history(amax_cur, amax_history, amax_history_idx, block_max,
+                             amax_history_len, history_block_size)
 
-    @staticmethod
-    def backward(ctx, grad_output):
-        return grad_output, None, None, None, None, None, None
+    return input
 
 
 class FusedAmaxObsFakeQuantFunction(torch.autograd.Function):
     """This function observes the amax statistics of inputs and
     quantize the inputs based on the observed amax values.
+
+    The amax history is a ring buffer indexed by ``amax_history_idx``. The max
+    of each block of ``history_block_size`` entries is kept in ``block_max``,
+    so an update rescans a single block instead of the whole history.
+
+    The enable flags are Python bools so that the forward pass never reads
+    tensor values on the host. With ``compile_kernel`` the work is done by the
+    compiled ``quantized_ops::amax_obs_fake_quantize`` operator, and with
+    ``inplace`` the result is written into the input.
     """
 
     @staticmethod
     def forward(
         ctx,
         input: torch.Tensor,
-        observer_enabled: torch.Tensor,
-        fake_quant_enabled: torch.Tensor,
+        observer_enabled: bool,
+        fake_quant_enabled: bool,
         quant_map: torch.Tensor,
         amax_history: torch.Tensor,
+        amax_history_idx: torch.Tensor,
+        block_max: torch.Tensor,
         scale: torch.Tensor,
         amax_history_len: int,
+        history_block_size: int,
         quant_max: float,
         ch_axis: Optional[int] = None,
         per_row_fake_quant=False,
         force_scale_power_of_two=False,
+        compile_kernel=False,
+        inplace=False,
+        dtype=None,
     ) -> torch.Tensor:
-        if observer_enabled[0] == 1:
-            if per_row_fake_quant:
-                ch_axis = ch_axis + input.ndim if ch_axis < 0 else ch_axis
-                dim = tuple(i for i in range(input.ndim) if i != ch_axis)
-                amax_cur = torch.amax(torch.abs(input), dim=dim, keepdim=True)
-            else:
-                amax_cur = torch.amax(torch.abs(input))
+        if observer_enabled and amax_history.numel() == 0:
+            size = _amax_shape(input, ch_axis, per_row_fake_quant)
+            num_blocks = amax_history_len // history_block_size
+            amax_history.resize_((amax_history_len,) + size).fill_(0.0)
+            block_max.resize_((num_blocks,) + size).fill_(0.0)
+            scale.resize_(size).fill_(1.0)
+
+        args = (
+            quant_map, amax_history, amax_history_idx, block_max, scale,
+            amax_history_len, history_block_size, quant_max, ch_axis,
+            per_row_fake_quant, force_scale_power_of_two, observer_enabled,
+            fake_quant_enabled, dtype,
+        )
+        if inplace:
+            ctx.mark_dirty(input)
+        if compile_kernel:
+            if inplace:
+                return torch.ops.quantized_ops.amax_obs_fake_quantize_(input, *args)
+            return torch.ops.quantized_ops.amax_obs_fake_quantize(input, *args)
+        return _amax_obs_fake_quant(input, *args, inplace=inplace)
 
-            if amax_history.numel() == 0:
-                size = amax_cur.shape
-                amax_history.resize_((amax_history_len,) + size).fill_(0.0)
-                scale.resize_(size).fill_(1.0)
+    @staticmethod
+    def backward(ctx, grad_output):
+        return (grad_output,) + (None,) * 16
 
-            amax = torch.amax(amax_history, dim=0)
 
-            if amax_history.shape[0] > 1:
-                new_amax_history = torch.roll(amax_history, -1, 0)
-                amax_history.copy_(new_amax_history)
-            amax_history[0] = amax_cur
+@torch.no_grad()
+def _foreach_fake_quantize_(tensors, fake_quant):
+    """Fake quantize a list of tensors with the same shape in place. Each
+    tensor gets its own scale, as if it was observed and then quantized by a
+    fresh copy of ``fake_quant``. The tensors are stacked so that a single
+    pass quantizes all of them.
+    """
+    ndim = tensors[0].ndim
+    if len(tensors) == 1:
+        stacked = tensors[0].unsqueeze(0)
+    else:
+        stacked = torch.stack(tensors)
 
-            sf = amax / quant_max
-            sf = torch.where(amax > 0.0, sf, scale)
-            sf = torch.where(torch.isfinite(amax), sf, scale)
-            if force_scale_power_of_two:
-                sf = torch.pow(2, torch.floor(torch.log2(sf)))
-            scale.copy_(sf)
+    if fake_quant.qscheme == qt.microscaling:
+        axes = fake_quant.ch_axis
+        axes = [axes] if type(axes) == int else axes
+        output = MXFakeQuantFunction.apply(
+            stacked,
+            True,
+            fake_quant.quant_map,
+            fake_quant.quant_max,
+            fake_quant.shared_exp_method,
+            [x % ndim + 1 for x in axes],
+            fake_quant.block_size,
+            fake_quant.dtype,
+        )
+        stacked.copy_(output)
+    else:
+        scale = fake_quant.scale
+        if fake_quant.qscheme is not None:
+            ch_axis = fake_quant.ch_axis % ndim + 1 if fake_quant.is_per_channel else None
+            dim = tuple(i for i in range(1, stacked.ndim) if i != ch_axis)
+            amax = torch.abs(stacked)
+            if dim:
+                amax = torch.amax(amax, dim=dim, keepdim=True)
+            # The scale is computed in float32, as from the amax history
+            amax = amax.float()
+            scale = torch.ones_like(amax)
+            _update_scale(
+                amax.unsqueeze(0), scale, fake_quant.quant_max, fake_quant.force_scale_power_of_two
+            )
+        _fake_quantize_lut(stacked, scale, fake_quant.quant_map, out=stacked, dtype=fake_quant.dtype)
 
-        if fake_quant_enabled[0] == 1:
-            scale = scale.to(input.dtype)
-            input = _quantize(input / scale, quant_map) * scale
-
-        return input
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        return grad_output, None, None, None, None, None, None, None, None, None, None
+    if len(tensors) > 1:
+        torch._foreach_copy_(tensors, stacked.unbind(0))
 
 
 class FusedAmaxObsFakeQuantize(FakeQuantizeBase):
@@ -199,8 +516,9 @@ class FusedAmaxObsFakeQuantize(FakeQuantizeBase):
     tensors, and uses this statistic to compute the quantization parameters.
     """
 
-    quant_map: torch.Tensor
     amax_history: torch.Tensor
+    amax_history_idx: torch.Tensor
+    amax_block_max: torch.Tensor
     scale: torch.Tensor
 
     def __init__(
@@ -213,6 +531,10 @@ class FusedAmaxObsFakeQuantize(FakeQuantizeBase):
         block_size: Optional[int] = None,
         record_histogram: bool = False,
         force_scale_power_of_two: bool = False,
+        histogram_sample_every: int = 1,
+        histogram_sample_size: Optional[int] = None,
+        compile_kernel: bool = False,
+        inplace: bool = False,
         **kwargs,
     ) -> None:
         super().__init__()
@@ -223,22 +545,80 @@ class FusedAmaxObsFakeQuantize(FakeQuantizeBase):
         self.ch_axis = ch_axis
         self.block_size = block_size
         self.force_scale_power_of_two = force_scale_power_of_two
+        # Use the compiled observe and quantize kernel, and quantize in place
+        # when running under torch.inference_mode()
+        self.compile_kernel = compile_kernel
+        self.inplace = inplace
         self.shared_exp_method = None if dtype.startswith("nf") else "max"
         device = kwargs.get("device", None)
-        # Generate a quantization map from bfloat16 to quantized values of the given dtype
-        values = torch.arange(2 ** 16, dtype=torch.int16, device=device).view(torch.bfloat16)
-        fake_quant_fn = get_fake_quant_fn(dtype)
-        self.register_buffer("quant_map", fake_quant_fn(values), persistent=False)
+        # Quantization map from bfloat16 to quantized values of the given dtype.
+        # It is shared with other fake quantizers and not registered as a buffer.
+        self.quant_map = get_quantization_map(dtype, device)
         # Create amax history and scale buffers
         factory_kwargs = {'device': device, 'dtype': torch.float}
         self.register_buffer("amax_history", torch.tensor([], **factory_kwargs))
+        # Ring buffer write position and per-block maxima of the amax history.
+        # Neither is saved; both are rebuilt when a state dict is loaded.
+        self.history_block_size = _history_block_size(amax_history_len)
+        self.register_buffer(
+            "amax_history_idx", torch.zeros(1, dtype=torch.long, device=device), persistent=False
+        )
+        self.register_buffer("amax_block_max", torch.tensor([], **factory_kwargs), persistent=False)
         self.register_buffer('scale', torch.tensor([1.0], **factory_kwargs))
-        self.observer_enabled[0] = self.qscheme is not None
+        # Python mirrors of the enable flags and the buffer device, so that
+        # forward does not read buffers on the host. The flags must be changed
+        # through enable_observer() and enable_fake_quant().
+        self._device = self.scale.device
+        self._fake_quant_enabled = True
+        self.enable_observer(self.qscheme is not None)
         self.is_per_channel = self.qscheme == qt.per_channel_symmetric
-        # Create histogram buffer
+        # Create histogram buffer. The histogram can be recorded on every k-th
+        # call only and on a random subset of the elements.
         self.record_histogram = record_histogram
+        self.histogram_sample_every = histogram_sample_every
+        self.histogram_sample_size = histogram_sample_size
+        self._num_calls = 0
+        # The elements are sampled with a generator owned by the module, so
+        # that recording does not advance the global RNG used for training.
+        self._sample_generator = None
         self.register_buffer("histogram", torch.zeros(254, **factory_kwargs), persistent=False)
 
+    @torch.jit.export
+    def enable_fake_quant(self, enabled: bool = True) -> None:
+        self.fake_quant_enabled[0] = 1 if enabled else 0
+        self._fake_quant_enabled = enabled
+
+    @torch.jit.export
+    def enable_observer(self, enabled: bool = True) -> None:
+        self.observer_enabled[0] = 1 if enabled else 0
+        self._observer_enabled = enabled
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        # Re-intern the shared quantization map on the device the buffers moved to
+        self._device = self.scale.device
+        self.quant_map = get_quantization_map(self.dtype, self._device)
+        if self._sample_generator is not None and self._sample_generator.device != self._device:
+            self._sample_generator = None
+        return self
+
+    def _get_sample_generator(self) -> torch.Generator:
+        if self._sample_generator is None:
+            self._sample_generator = torch.Generator(self._device).manual_seed(0)
+        return self._sample_generator
+
+    def __getstate__(self):
+        # Copies and pickles reference the shared map instead of duplicating it
+        state = self.__dict__.copy()
+        state.pop("quant_map", None)
+        # Generators cannot be pickled; the copy starts a fresh one
+        state["_sample_generator"] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.quant_map = get_quantization_map(self.dtype, self.scale.device)
+
     @torch.jit.export
     def calculate_qparams(self):
         return self.scale
@@ -264,40 +644,58 @@ class FusedAmaxObsFakeQuantize(FakeQuantizeBase):
 
     def forward(self, X: torch.Tensor) -> torch.Tensor:
         # TODO this is a workaround when input is not on the same device as the module
-        devices = {p.device for p in self.buffers()}
-        device = next(iter(devices)) if len(devices) > 0 else None
-        if len(devices) > 1 or X.device != device:
+        if X.device != self._device:
             self.to(X.device)
 
         if self.record_histogram:
-            exp = torch.floor(torch.log2(torch.abs(X.detach().float())))
-            self.histogram += torch.histc(exp, 254, min=-126, max=127)
+            if self._num_calls % self.histogram_sample_every == 0:
+                generator = None
+                if self.histogram_sample_size is not None:
+                    generator = self._get_sample_generator()
+                self.histogram += _exponent_histogram(X, self.histogram_sample_size, generator)
+            self._num_calls += 1
 
         if self.qscheme == qt.microscaling:
             return MXFakeQuantFunction.apply(
                 X,
-                self.fake_quant_enabled,
+                self._fake_quant_enabled,
                 self.quant_map,
                 self.quant_max,
                 self.shared_exp_method,
                 self.ch_axis,
                 self.block_size,
+                self.dtype,
             )
 
         return FusedAmaxObsFakeQuantFunction.apply(
             X,
-            self.observer_enabled,
-            self.fake_quant_enabled,
+            self._observer_enabled,
+            self._fake_quant_enabled,
             self.quant_map,
             self.amax_history,
+            self.amax_history_idx,
+            self.amax_block_max,
             self.scale,
             self.amax_history_len,
+            self.history_block_size,
             self.quant_max,
             self.ch_axis,
             self.is_per_channel,
             self.force_scale_power_of_two,
+            self.compile_kernel,
+            self.inplace and torch.is_inference_mode_enabled(),
+            self.dtype,
         )
 
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+        # Save the ring buffer in the original layout, with the newest entry
+        # first and the oldest entry second.
+        key = prefix + 'amax_history'
+        if key in destination and self.amax_history.numel() > 0:
+            shift = 1 - int(self.amax_history_idx)
+            destination[key] = torch.roll(destination[key], shift, 0)
+
     def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
                               missing_keys, unexpected_keys, error_msgs):
         # Removing this function throws an error that the size of the loaded tensor does not match the original size
@@ -328,3 +726,15 @@ class FusedAmaxObsFakeQuantize(FakeQuantizeBase):
                 missing_keys.append(key)
         super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
                                       missing_keys, unexpected_keys, error_msgs)
+
+        self._fake_quant_enabled = bool(self.fake_quant_enabled[0])
+        self._observer_enabled = bool(self.observer_enabled[0])
+
+        # The saved layout has the oldest entry at index 1, which is where
+        # the ring buffer writes next.
+        if self.amax_history.numel() > 0:
+            num_blocks = self.amax_history_len // self.history_block_size
+            blocks = self.amax_history.view(
+                (num_blocks, self.history_block_size) + self.amax_history.shape[1:])
+            self.amax_block_max = torch.amax(blocks, dim=1)
+            self.amax_history_idx.fill_(1 % self.amax_history_len)
@@ -1,6 +1,9 @@
+import functools
 import math
 import torch
 
+from quantized_training.elementwise import apply_elementwise
+
 __all__ = [
     "quantize_to_fp8_e4m3",
     "quantize_to_fp8_e5m2",
@@ -12,7 +15,14 @@ def quantize_to_fp8_e4m3(
     mbits: int = 3,
     fp8_max: float = 448,
     fp8_min: float = 2 ** -6,
+    chunk_size: int = None,
+    out: torch.Tensor = None,
+    num_threads: int = 0,
 ) -> torch.Tensor:
+    if chunk_size is not None or out is not None:
+        fn = functools.partial(quantize_to_fp8_e4m3, mbits=mbits, fp8_max=fp8_max, fp8_min=fp8_min)
+        return apply_elementwise(fn, input, chunk_size, out, num_threads)
+
     raw_bits = input.clone().to(torch.float).view(torch.int32)
     exp = ((raw_bits & 0x7f800000) >> 23) - 127
     fraction = (raw_bits & 0x7fffff) | 0x800000
@@ -42,7 +52,14 @@ def quantize_to_fp8_e5m2(
     mbits: int = 2,
     fp8_max: float = 57344,
     fp8_min: float = 2 ** -14,
+    chunk_size: int = None,
+    out: torch.Tensor = None,
+    num_threads: int = 0,
 ) -> torch.Tensor:
+    if chunk_size is not None or out is not None:
+        fn = functools.partial(quantize_to_fp8_e5m2, mbits=mbits, fp8_max=fp8_max, fp8_min=fp8_min)
+        return apply_elementwise(fn, input, chunk_size, out, num_threads)
+
     raw_bits = input.clone().to(torch.float).view(torch.int32)
     exp = ((raw_bits & 0x7f800000) >> 23) - 127
     fraction = (raw_bits & 0x7fffff) | 0x800000
@@ -71,15 +88,15 @@ def write_fp8_values():
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
     input_tensor = torch.arange(2 ** 16, dtype=torch.int16, device=device).view(torch.bfloat16)
 
-    e4m3_values = quantize_to_fp8_e4m3(input_tensor)
+    inputs = input_tensor.tolist()
+
+    e4m3_values = quantize_to_fp8_e4m3(input_tensor).tolist()
     with open('fp8_e4m3.txt', 'w') as file:
-        for v1, v2 in zip(input_tensor, e4m3_values):
-            file.write(f"{v1.item()}\t{v2.item()}\n")
+        file.writelines(f"{v1}\t{v2}\n" for v1, v2 in zip(inputs, e4m3_values))
 
-    e5m2_values = quantize_to_fp8_e5m2(input_tensor)
+    e5m2_values = quantize_to_fp8_e5m2(input_tensor).tolist()
     with open('fp8_e5m2.txt', 'w') as file:
-        for v1, v2 in zip(input_tensor, e5m2_values):
-            file.write(f"{v1.item()}\t{v2.item()}\n")
+        file.writelines(f"{v1}\t{v2}\n" for v1, v2 in zip(inputs, e5m2_values))
 
 
 # -------------------------------------------------------------------------
@@ -145,7 +162,8 @@ def _get_min_norm(ebits):
 # Main funcs
 # -------------------------------------------------------------------------
 def _quantize_elemwise_core(A, bits, exp_bits, max_norm, round='nearest',
-                            saturate_normals=False, allow_denorm=True):
+                            saturate_normals=False, allow_denorm=True,
+                            chunk_size=None, out=None, num_threads=0):
     """ Core function used for element-wise quantization
     Arguments:
       A         {PyTorch tensor} -- A tensor to be quantized
@@ -159,9 +177,17 @@ def _quantize_elemwise_core(A, bits, exp_bits, max_norm, round='nearest',
                                     Must be True for correct MX conversion.
       allow_denorm     {bool}    -- If False, flush denorm numbers in the
                                     elem_format to zero.
+      chunk_size       {int}     -- Quantize in chunks of this many elements
+      out              {PyTorch tensor} -- Preallocated output tensor
+      num_threads      {int}     -- Number of CPU threads to process chunks
     Returns:
       quantized tensor {PyTorch tensor} -- A tensor that has been quantized
     """
+    if chunk_size is not None or out is not None:
+        fn = functools.partial(
+            _quantize_elemwise_core, bits=bits, exp_bits=exp_bits, max_norm=max_norm,
+            round=round, saturate_normals=saturate_normals, allow_denorm=allow_denorm)
+        return apply_elementwise(fn, A, chunk_size, out, num_threads)
 
     # Flush values < min_norm to zero if denorms are not allowed
     if not allow_denorm and exp_bits > 0:
@@ -196,9 +222,7 @@ def _quantize_elemwise_core(A, bits, exp_bits, max_norm, round='nearest',
                            torch.sign(out) * float("Inf"), out)
 
     # handle Inf/NaN
-    out[A == float("Inf")] = float("Inf")
-    out[A == -float("Inf")] = -float("Inf")
-    out[A == float("NaN")] = float("NaN")
+    out = torch.where(torch.isinf(A), A, out)
 
     return out
 
@@ -235,5 +259,6 @@ if __name__ == "__main__":
     input_tensor = torch.arange(2 ** 16, dtype=torch.int16).view(torch.bfloat16)
     quantized_tensor = fq_fn(input_tensor)
     with open('quantized_tensor.out', 'w') as file:
-        for v1, v2 in zip(input_tensor, quantized_tensor):
-            file.write(f"{v1.item()}\t{v2.item()}\n")
+        file.writelines(
+            f"{v1}\t{v2}\n" for v1, v2 in zip(input_tensor.tolist(), quantized_tensor.tolist())
+        )
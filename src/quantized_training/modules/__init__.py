@@ -1,5 +1,9 @@
-from .softmax import Softmax
+from .activation import LUTActivation, LUTLayerNorm
+from .softmax import IntSoftmax, Softmax
 
 __all__ = [
+    "LUTActivation",
+    "LUTLayerNorm",
+    "IntSoftmax",
     "Softmax"
 ]
\ No newline at end of file
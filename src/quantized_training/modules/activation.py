@@ -0,0 +1,176 @@
+import threading
+import weakref
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from quantized_training.fake_quantize import (
+    _canonical_device,
+    _get_arithmetic_quant_fn,
+    _get_lut_quant_fn,
+)
+from quantized_training.quant_tables import load_table
+
+__all__ = [
+    "LUTActivation",
+    "LUTLayerNorm",
+    "get_activation_table",
+]
+
+# Functions that can be approximated with a lookup table. The gradient of the
+# exact function is used in the backward pass.
+ACTIVATION_FNS = {
+    "gelu": F.gelu,
+    "gelu_tanh": lambda x: F.gelu(x, approximate="tanh"),
+    "tanh": torch.tanh,
+    "silu": F.silu,
+    "exp": torch.exp,
+    "reciprocal": torch.reciprocal,
+    "rsqrt": torch.rsqrt,
+}
+
+def _build_activation_table(function, dtype):
+    # The function is evaluated in float32 on every bfloat16 value, and the
+    # result is rounded to the output format.
+    input = torch.arange(2 ** 16, dtype=torch.int32).short().view(torch.bfloat16)
+    values = ACTIVATION_FNS[function](input.float())
+    if dtype is not None:
+        quant_fn = _get_arithmetic_quant_fn(dtype) or _get_lut_quant_fn(dtype)
+        values = quant_fn(values)
+    return values
+
+# Tables are shared per (function, dtype, device) by all modules, like the
+# quantization maps and the softmax tables.
+_TABLE_CACHE = weakref.WeakValueDictionary()
+_TABLE_LOCK = threading.Lock()
+
+def get_activation_table(function: str, dtype: Optional[str] = None, device=None):
+    """Return the table that maps every bfloat16 bit pattern to the result of
+    ``function`` rounded to ``dtype``, or kept in float32 if dtype is None.
+
+    The returned tensor is shared across callers and must not be modified.
+    """
+    if function not in ACTIVATION_FNS:
+        raise ValueError(f"Unsupported function: {function}")
+    key = (function, dtype, _canonical_device(device))
+    with _TABLE_LOCK:
+        values = _TABLE_CACHE.get(key)
+        if values is None:
+            values = load_table(
+                f"{function}_{dtype or 'fp32'}",
+                lambda: _build_activation_table(function, dtype),
+                torch.float,
+            ).to(key[2])
+            _TABLE_CACHE[key] = values
+    return values
+
+def _lookup(input: torch.Tensor, values: torch.Tensor):
+    # Inputs are rounded to bfloat16, whose bit pattern indexes the table
+    indices = input.to(torch.bfloat16).view(torch.int16).int().bitwise_and_(0xffff)
+    output = torch.index_select(values, 0, indices.view(-1)).view(input.shape)
+    return output.to(input.dtype)
+
+class LUTFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, input, values, function):
+        ctx.save_for_backward(input)
+        ctx.function = function
+        return _lookup(input, values)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, = ctx.saved_tensors
+        with torch.enable_grad():
+            input = input.detach().requires_grad_()
+            output = ACTIVATION_FNS[ctx.function](input)
+        grad_input, = torch.autograd.grad(output, input, grad_output)
+        return grad_input, None, None
+
+def _apply_table(input, values, function):
+    if torch.is_grad_enabled() and input.requires_grad:
+        return LUTFunction.apply(input, values, function)
+    return _lookup(input, values)
+
+class _TableHolder:
+    """Holds the shared table of a module for the device of its last input,
+    which keeps the table in the weak cache between calls."""
+
+    def _get_table(self, function, dtype, device):
+        table = self.__dict__.get("_table")
+        if table is None or table[0] != device:
+            table = (device, get_activation_table(function, dtype, device))
+            self._table = table
+        return table[1]
+
+    def __getstate__(self):
+        # Copies and pickles look the shared table up again
+        state = self.__dict__.copy()
+        state.pop("_table", None)
+        return state
+
+class LUTActivation(_TableHolder, nn.Module):
+    r"""Elementwise function evaluated with a lookup table indexed by the
+    bfloat16 bit pattern of the input, which models an accelerator that
+    implements the function with a table.
+
+    Args:
+        function: one of gelu, gelu_tanh, tanh, silu, exp, reciprocal, rsqrt
+        dtype: format the table entries are rounded to, e.g. ``posit16_1`` or
+            ``fp8_e4m3``. Entries are kept in float32 if None.
+    """
+
+    def __init__(self, function: str, dtype: Optional[str] = None):
+        super().__init__()
+        if function not in ACTIVATION_FNS:
+            raise ValueError(f"Unsupported function: {function}")
+        self.function = function
+        self.dtype = dtype
+
+    @property
+    def table(self):
+        table = self.__dict__.get("_table")
+        device = table[0] if table is not None else _canonical_device(None)
+        return self._get_table(self.function, self.dtype, device)
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        values = self._get_table(self.function, self.dtype, input.device)
+        return _apply_table(input, values, self.function)
+
+    def extra_repr(self) -> str:
+        return f"function={self.function}, dtype={self.dtype}"
+
+class LUTLayerNorm(_TableHolder, nn.LayerNorm):
+    r"""LayerNorm that computes the reciprocal standard deviation with an
+    rsqrt lookup table. Takes the same arguments as ``nn.LayerNorm`` plus the
+    ``dtype`` of the table entries.
+    """
+
+    def __init__(self, normalized_shape, eps=1e-5, elementwise_affine=True,
+                 bias=True, device=None, dtype=None, table_dtype=None):
+        super().__init__(normalized_shape, eps, elementwise_affine,
+                         bias=bias, device=device, dtype=dtype)
+        self.table_dtype = table_dtype
+
+    @classmethod
+    def from_float(cls, mod, table_dtype=None):
+        new_mod = cls(mod.normalized_shape, mod.eps, mod.elementwise_affine,
+                      bias=mod.bias is not None, table_dtype=table_dtype)
+        new_mod.weight = mod.weight
+        new_mod.bias = mod.bias
+        return new_mod
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        dims = tuple(range(-len(self.normalized_shape), 0))
+        var, mean = torch.var_mean(input, dim=dims, unbiased=False, keepdim=True)
+        values = self._get_table("rsqrt", self.table_dtype, input.device)
+        output = (input - mean) * _apply_table(var + self.eps, values, "rsqrt")
+        if self.weight is not None:
+            output = output * self.weight
+        if self.bias is not None:
+            output = output + self.bias
+        return output
+
+    def extra_repr(self) -> str:
+        return super().extra_repr() + f", table_dtype={self.table_dtype}"
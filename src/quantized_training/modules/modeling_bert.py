@@ -51,6 +51,8 @@ from transformers.utils import (
 )
 from transformers.models.bert.configuration_bert import BertConfig
 
+from .quantization_plan import init_quantization_sites, set_quantization_plan
+
 
 logger = logging.get_logger(__name__)
 
@@ -180,8 +182,11 @@ def load_tf_weights_in_bert(model, config, tf_checkpoint_path):
 class BertEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings."""
 
+    quantization_sites = ('LayerNorm',)
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.word_embeddings = nn.Embedding(config.vocab_size, config.hidden_size, padding_idx=config.pad_token_id)
         self.position_embeddings = nn.Embedding(config.max_position_embeddings, config.hidden_size)
         self.token_type_embeddings = nn.Embedding(config.type_vocab_size, config.hidden_size)
@@ -206,7 +211,6 @@ class BertEmbeddings(nn.Module):
         position_ids: Optional[torch.LongTensor] = None,
         inputs_embeds: Optional[torch.FloatTensor] = None,
         past_key_values_length: int = 0,
-        module_name: Optional[str] = None,
     ) -> torch.Tensor:
         if input_ids is not None:
             input_shape = input_ids.size()
@@ -238,19 +242,30 @@ class BertEmbeddings(nn.Module):
         if self.position_embedding_type == "absolute":
             position_embeddings = self.position_embeddings(position_ids)
             embeddings += position_embeddings
-        # embeddings = (input_quantizer(inputs_embeds, f'{module_name}.residual.inputs_embeds')
-        #               +  input_quantizer(token_type_embeddings, f'{module_name}.residual.token_type_embeddings'))
+        # embeddings = (self.input_quantizers['residual.inputs_embeds'](inputs_embeds)
+        #               +  self.input_quantizers['residual.token_type_embeddings'](token_type_embeddings))
         # if self.position_embedding_type == "absolute":
         #     position_embeddings = self.position_embeddings(position_ids)
-        #     embeddings += input_quantizer(position_embeddings, f'{module_name}.residual.position_embeddings')
-        embeddings = self.LayerNorm(input_quantizer(embeddings, f'{module_name}.LayerNorm'))
+        #     embeddings += self.input_quantizers['residual.position_embeddings'](position_embeddings)
+        embeddings = self.LayerNorm(self.input_quantizers['LayerNorm'](embeddings))
         embeddings = self.dropout(embeddings)
         return embeddings
 
 
 class BertSelfAttention(nn.Module):
+    quantization_sites = (
+        'hidden_states',
+        'query_layer',
+        'key_layer',
+        'attn_scaling',
+        'softmax',
+        'attention_probs',
+        'value_layer',
+    )
+
     def __init__(self, config, position_embedding_type=None):
         super().__init__()
+        init_quantization_sites(self)
         if config.hidden_size % config.num_attention_heads != 0 and not hasattr(config, "embedding_size"):
             raise ValueError(
                 f"The hidden size ({config.hidden_size}) is not a multiple of the number of attention "
@@ -290,9 +305,8 @@ class BertSelfAttention(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         past_key_value: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
         output_attentions: Optional[bool] = False,
-        module_name: Optional[str] = None,
     ) -> Tuple[torch.Tensor]:
-        hidden_states = input_quantizer(hidden_states, f'{module_name}.hidden_states')
+        hidden_states = self.input_quantizers['hidden_states'](hidden_states)
         mixed_query_layer = self.query(hidden_states)
 
         # If this is instantiated as a cross-attention module, the keys
@@ -333,8 +347,8 @@ class BertSelfAttention(nn.Module):
 
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(
-            input_quantizer(query_layer, f'{module_name}.query_layer'),
-            input_quantizer(key_layer.transpose(-1, -2), f'{module_name}.key_layer'))
+            self.input_quantizers['query_layer'](query_layer),
+            self.input_quantizers['key_layer'](key_layer.transpose(-1, -2)))
 
         if self.position_embedding_type == "relative_key" or self.position_embedding_type == "relative_key_query":
             query_length, key_length = query_layer.shape[2], key_layer.shape[2]
@@ -358,14 +372,14 @@ class BertSelfAttention(nn.Module):
                 relative_position_scores_key = torch.einsum("bhrd,lrd->bhlr", key_layer, positional_embedding)
                 attention_scores = attention_scores + relative_position_scores_query + relative_position_scores_key
 
-        attention_scores = input_quantizer(attention_scores, f'{module_name}.attn_scaling')
+        attention_scores = self.input_quantizers['attn_scaling'](attention_scores)
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
         if attention_mask is not None:
             # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
             attention_scores = attention_scores + attention_mask
 
         # Normalize the attention scores to probabilities.
-        attention_scores = input_quantizer(attention_scores, f'{module_name}.softmax')
+        attention_scores = self.input_quantizers['softmax'](attention_scores)
         attention_probs = self.softmax(attention_scores)
 
         # This is actually dropping out entire tokens to attend to, which might
@@ -377,8 +391,8 @@ class BertSelfAttention(nn.Module):
             attention_probs = attention_probs * head_mask
 
         context_layer = torch.matmul(
-            input_quantizer(attention_probs, f'{module_name}.attention_probs'),
-            input_quantizer(value_layer, f'{module_name}.value_layer'))
+            self.input_quantizers['attention_probs'](attention_probs),
+            self.input_quantizers['value_layer'](value_layer))
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
@@ -392,18 +406,21 @@ class BertSelfAttention(nn.Module):
 
 
 class BertSelfOutput(nn.Module):
+    quantization_sites = ('dense', 'residual.hidden_states', 'residual.input_tensor', 'LayerNorm')
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.dense = nn.Linear(config.hidden_size, config.hidden_size)
         self.LayerNorm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, hidden_states: torch.Tensor, input_tensor: torch.Tensor, module_name: Optional[str] = None) -> torch.Tensor:
-        hidden_states = self.dense(input_quantizer(hidden_states, f'{module_name}.dense'))
+    def forward(self, hidden_states: torch.Tensor, input_tensor: torch.Tensor) -> torch.Tensor:
+        hidden_states = self.dense(self.input_quantizers['dense'](hidden_states))
         hidden_states = self.dropout(hidden_states)
-        hidden_states = (input_quantizer(hidden_states, f'{module_name}.residual.hidden_states')
-                         + input_quantizer(input_tensor, f'{module_name}.residual.input_tensor'))
-        hidden_states = self.LayerNorm(input_quantizer(hidden_states, f'{module_name}.LayerNorm'))
+        hidden_states = (self.input_quantizers['residual.hidden_states'](hidden_states)
+                         + self.input_quantizers['residual.input_tensor'](input_tensor))
+        hidden_states = self.LayerNorm(self.input_quantizers['LayerNorm'](hidden_states))
         return hidden_states
 
 
@@ -441,7 +458,6 @@ class BertAttention(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         past_key_value: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
         output_attentions: Optional[bool] = False,
-        module_name: Optional[str] = None,
     ) -> Tuple[torch.Tensor]:
         self_outputs = self.self(
             hidden_states,
@@ -451,41 +467,46 @@ class BertAttention(nn.Module):
             encoder_attention_mask,
             past_key_value,
             output_attentions,
-            f'{module_name}.self',
         )
-        attention_output = self.output(self_outputs[0], hidden_states, f'{module_name}.output')
+        attention_output = self.output(self_outputs[0], hidden_states)
         outputs = (attention_output,) + self_outputs[1:]  # add attentions if we output them
         return outputs
 
 
 class BertIntermediate(nn.Module):
+    quantization_sites = ('dense', 'intermediate_act_fn')
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.dense = nn.Linear(config.hidden_size, config.intermediate_size)
         if isinstance(config.hidden_act, str):
             self.intermediate_act_fn = ACT2FN[config.hidden_act]
         else:
             self.intermediate_act_fn = config.hidden_act
 
-    def forward(self, hidden_states: torch.Tensor, module_name: Optional[str]) -> torch.Tensor:
-        hidden_states = self.dense(input_quantizer(hidden_states, f'{module_name}.dense'))
-        hidden_states = self.intermediate_act_fn(input_quantizer(hidden_states, f'{module_name}.intermediate_act_fn'))
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        hidden_states = self.dense(self.input_quantizers['dense'](hidden_states))
+        hidden_states = self.intermediate_act_fn(self.input_quantizers['intermediate_act_fn'](hidden_states))
         return hidden_states
 
 
 class BertOutput(nn.Module):
+    quantization_sites = ('dense', 'residual.hidden_states', 'residual.input_tensor', 'LayerNorm')
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.dense = nn.Linear(config.intermediate_size, config.hidden_size)
         self.LayerNorm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, hidden_states: torch.Tensor, input_tensor: torch.Tensor, module_name: Optional[str]) -> torch.Tensor:
-        hidden_states = self.dense(input_quantizer(hidden_states, f'{module_name}.dense'))
+    def forward(self, hidden_states: torch.Tensor, input_tensor: torch.Tensor) -> torch.Tensor:
+        hidden_states = self.dense(self.input_quantizers['dense'](hidden_states))
         hidden_states = self.dropout(hidden_states)
-        hidden_states = (input_quantizer(hidden_states, f'{module_name}.residual.hidden_states')
-                         + input_quantizer(input_tensor, f'{module_name}.residual.input_tensor'))
-        hidden_states = self.LayerNorm(input_quantizer(hidden_states, f'{module_name}.LayerNorm'))
+        hidden_states = (self.input_quantizers['residual.hidden_states'](hidden_states)
+                         + self.input_quantizers['residual.input_tensor'](input_tensor))
+        hidden_states = self.LayerNorm(self.input_quantizers['LayerNorm'](hidden_states))
         return hidden_states
 
 
@@ -513,7 +534,6 @@ class BertLayer(nn.Module):
         encoder_attention_mask: Optional[torch.FloatTensor] = None,
         past_key_value: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
         output_attentions: Optional[bool] = False,
-        module_name: Optional[str] = None,
     ) -> Tuple[torch.Tensor]:
         # decoder uni-directional self-attention cached key/values tuple is at positions 1,2
         self_attn_past_key_value = past_key_value[:2] if past_key_value is not None else None
@@ -523,7 +543,6 @@ class BertLayer(nn.Module):
             head_mask,
             output_attentions=output_attentions,
             past_key_value=self_attn_past_key_value,
-            module_name=f'{module_name}.attention',
         )
         attention_output = self_attention_outputs[0]
 
@@ -561,7 +580,7 @@ class BertLayer(nn.Module):
             present_key_value = present_key_value + cross_attn_present_key_value
 
         layer_output = apply_chunking_to_forward(
-            self.feed_forward_chunk, self.chunk_size_feed_forward, self.seq_len_dim, attention_output, module_name
+            self.feed_forward_chunk, self.chunk_size_feed_forward, self.seq_len_dim, attention_output
         )
         outputs = (layer_output,) + outputs
 
@@ -571,9 +590,9 @@ class BertLayer(nn.Module):
 
         return outputs
 
-    def feed_forward_chunk(self, attention_output, module_name):
-        intermediate_output = self.intermediate(attention_output, f'{module_name}.intermediate')
-        layer_output = self.output(intermediate_output, attention_output, f'{module_name}.output')
+    def feed_forward_chunk(self, attention_output):
+        intermediate_output = self.intermediate(attention_output)
+        layer_output = self.output(intermediate_output, attention_output)
         return layer_output
 
 
@@ -596,7 +615,6 @@ class BertEncoder(nn.Module):
         output_attentions: Optional[bool] = False,
         output_hidden_states: Optional[bool] = False,
         return_dict: Optional[bool] = True,
-        module_name: Optional[str] = None,
     ) -> Union[Tuple[torch.Tensor], BaseModelOutputWithPastAndCrossAttentions]:
         all_hidden_states = () if output_hidden_states else None
         all_self_attentions = () if output_attentions else None
@@ -642,7 +660,6 @@ class BertEncoder(nn.Module):
                     encoder_attention_mask,
                     past_key_value,
                     output_attentions,
-                    f'{module_name}.layer.{i}',
                 )
 
             hidden_states = layer_outputs[0]
@@ -678,16 +695,19 @@ class BertEncoder(nn.Module):
 
 
 class BertPooler(nn.Module):
+    quantization_sites = ('dense',)
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.dense = nn.Linear(config.hidden_size, config.hidden_size)
         self.activation = nn.Tanh()
 
-    def forward(self, hidden_states: torch.Tensor, module_name: Optional[str]) -> torch.Tensor:
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
         # We "pool" the model by simply taking the hidden state corresponding
         # to the first token.
         first_token_tensor = hidden_states[:, 0]
-        pooled_output = self.dense(input_quantizer(first_token_tensor, f'{module_name}.dense'))
+        pooled_output = self.dense(self.input_quantizers['dense'](first_token_tensor))
         pooled_output = self.activation(pooled_output)
         return pooled_output
 
@@ -1044,7 +1064,6 @@ class BertModel(BertPreTrainedModel):
             token_type_ids=token_type_ids,
             inputs_embeds=inputs_embeds,
             past_key_values_length=past_key_values_length,
-            module_name='bert.embeddings',
         )
         encoder_outputs = self.encoder(
             embedding_output,
@@ -1057,10 +1076,9 @@ class BertModel(BertPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
-            module_name='bert.encoder'
         )
         sequence_output = encoder_outputs[0]
-        pooled_output = self.pooler(sequence_output, 'bert.pooler') if self.pooler is not None else None
+        pooled_output = self.pooler(sequence_output) if self.pooler is not None else None
 
         if not return_dict:
             return (sequence_output, pooled_output) + encoder_outputs[1:]
@@ -1545,7 +1563,7 @@ class BertForNextSentencePrediction(BertPreTrainedModel):
     BERT_START_DOCSTRING,
 )
 class BertForSequenceClassification(BertPreTrainedModel):
-    def __init__(self, config, quantizer):
+    def __init__(self, config, quantizer=None):
         super().__init__(config)
         self.num_labels = config.num_labels
         self.config = config
@@ -1560,8 +1578,8 @@ class BertForSequenceClassification(BertPreTrainedModel):
         # Initialize weights and apply final processing
         self.post_init()
 
-        global input_quantizer
-        input_quantizer = quantizer
+        if quantizer is not None:
+            set_quantization_plan(self, quantizer)
 
     @add_start_docstrings_to_model_forward(BERT_INPUTS_DOCSTRING.format("batch_size, sequence_length"))
     @add_code_sample_docstrings(
@@ -1830,10 +1848,13 @@ class BertForTokenClassification(BertPreTrainedModel):
     BERT_START_DOCSTRING,
 )
 class BertForQuestionAnswering(BertPreTrainedModel):
+    quantization_sites = ('qa_outputs',)
+
     _keys_to_ignore_on_load_unexpected = [r"pooler"]
 
-    def __init__(self, config, quantizer):
+    def __init__(self, config, quantizer=None):
         super().__init__(config)
+        init_quantization_sites(self)
         self.num_labels = config.num_labels
 
         self.bert = BertModel(config, add_pooling_layer=False)
@@ -1842,8 +1863,8 @@ class BertForQuestionAnswering(BertPreTrainedModel):
         # Initialize weights and apply final processing
         self.post_init()
 
-        global input_quantizer
-        input_quantizer = quantizer
+        if quantizer is not None:
+            set_quantization_plan(self, quantizer)
 
     @add_start_docstrings_to_model_forward(BERT_INPUTS_DOCSTRING.format("batch_size, sequence_length"))
     @add_code_sample_docstrings(
@@ -1895,7 +1916,7 @@ class BertForQuestionAnswering(BertPreTrainedModel):
 
         sequence_output = outputs[0]
 
-        logits = self.qa_outputs(input_quantizer(sequence_output, "qa_outputs"))
+        logits = self.qa_outputs(self.input_quantizers['qa_outputs'](sequence_output))
         start_logits, end_logits = logits.split(1, dim=-1)
         start_logits = start_logits.squeeze(-1).contiguous()
         end_logits = end_logits.squeeze(-1).contiguous()
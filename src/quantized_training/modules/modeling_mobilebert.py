@@ -53,6 +53,8 @@ from transformers.utils import (
 )
 from transformers.models.mobilebert.configuration_mobilebert import MobileBertConfig
 
+from .quantization_plan import init_quantization_sites, set_quantization_plan
+
 
 logger = logging.get_logger(__name__)
 
@@ -173,8 +175,11 @@ NORM2FN = {"layer_norm": nn.LayerNorm, "no_norm": NoNorm}
 class MobileBertEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings."""
 
+    quantization_sites = ('embedding_transformation', 'LayerNorm')
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.trigram_input = config.trigram_input
         self.embedding_size = config.embedding_size
         self.hidden_size = config.hidden_size
@@ -201,7 +206,6 @@ class MobileBertEmbeddings(nn.Module):
         token_type_ids: Optional[torch.LongTensor] = None,
         position_ids: Optional[torch.LongTensor] = None,
         inputs_embeds: Optional[torch.FloatTensor] = None,
-        module_name: Optional[str] = None,
     ) -> torch.Tensor:
         if input_ids is not None:
             input_shape = input_ids.size()
@@ -236,25 +240,38 @@ class MobileBertEmbeddings(nn.Module):
             )
         if self.trigram_input or self.embedding_size != self.hidden_size:
             inputs_embeds = self.embedding_transformation(
-                input_quantizer(inputs_embeds, f'{module_name}.embedding_transformation')
+                self.input_quantizers['embedding_transformation'](inputs_embeds)
             )
 
         # Add positional embeddings and token type embeddings, then layer
         # normalize and perform dropout.
         position_embeddings = self.position_embeddings(position_ids)
         token_type_embeddings = self.token_type_embeddings(token_type_ids)
-        # embeddings = (input_quantizer(inputs_embeds, f'{module_name}.residual.inputs_embeds')
-        #               + input_quantizer(position_embeddings, f'{module_name}.residual.position_embeddings')
-        #               + input_quantizer(token_type_embeddings, f'{module_name}.residual.token_type_embeddings'))
+        # embeddings = (self.input_quantizers['residual.inputs_embeds'](inputs_embeds)
+        #               + self.input_quantizers['residual.position_embeddings'](position_embeddings)
+        #               + self.input_quantizers['residual.token_type_embeddings'](token_type_embeddings))
         embeddings = inputs_embeds + position_embeddings + token_type_embeddings
-        embeddings = self.LayerNorm(input_quantizer(embeddings, f'{module_name}.LayerNorm'))
+        embeddings = self.LayerNorm(self.input_quantizers['LayerNorm'](embeddings))
         embeddings = self.dropout(embeddings)
         return embeddings
 
 
 class MobileBertSelfAttention(nn.Module):
+    quantization_sites = (
+        'query_tensor',
+        'key_tensor',
+        'value_tensor',
+        'query_layer',
+        'key_layer',
+        'attn_scaling',
+        'softmax',
+        'attention_probs',
+        'value_layer',
+    )
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.num_attention_heads = config.num_attention_heads
         self.attention_head_size = int(config.true_hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
@@ -280,11 +297,10 @@ class MobileBertSelfAttention(nn.Module):
         attention_mask: Optional[torch.FloatTensor] = None,
         head_mask: Optional[torch.FloatTensor] = None,
         output_attentions: Optional[bool] = None,
-        module_name: Optional[str] = None,
     ) -> Tuple[torch.Tensor]:
-        mixed_query_layer = self.query(input_quantizer(query_tensor, f'{module_name}.query_tensor'))
-        mixed_key_layer = self.key(input_quantizer(key_tensor, f'{module_name}.key_tensor'))
-        mixed_value_layer = self.value(input_quantizer(value_tensor, f'{module_name}.value_tensor'))
+        mixed_query_layer = self.query(self.input_quantizers['query_tensor'](query_tensor))
+        mixed_key_layer = self.key(self.input_quantizers['key_tensor'](key_tensor))
+        mixed_value_layer = self.value(self.input_quantizers['value_tensor'](value_tensor))
 
         query_layer = self.transpose_for_scores(mixed_query_layer)
         key_layer = self.transpose_for_scores(mixed_key_layer)
@@ -292,15 +308,15 @@ class MobileBertSelfAttention(nn.Module):
 
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(
-            input_quantizer(query_layer, f'{module_name}.query_layer'),
-            input_quantizer(key_layer.transpose(-1, -2), f'{module_name}.key_layer'))
-        attention_scores = input_quantizer(attention_scores, f'{module_name}.attn_scaling')
+            self.input_quantizers['query_layer'](query_layer),
+            self.input_quantizers['key_layer'](key_layer.transpose(-1, -2)))
+        attention_scores = self.input_quantizers['attn_scaling'](attention_scores)
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
         if attention_mask is not None:
             # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
             attention_scores = attention_scores + attention_mask
         # Normalize the attention scores to probabilities.
-        attention_scores = input_quantizer(attention_scores, f'{module_name}.softmax')
+        attention_scores = self.input_quantizers['softmax'](attention_scores)
         attention_probs = self.softmax(attention_scores)
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
@@ -309,8 +325,8 @@ class MobileBertSelfAttention(nn.Module):
         if head_mask is not None:
             attention_probs = attention_probs * head_mask
         context_layer = torch.matmul(
-            input_quantizer(attention_probs, f'{module_name}.attention_probs'),
-            input_quantizer(value_layer, f'{module_name}.value_layer'))
+            self.input_quantizers['attention_probs'](attention_probs),
+            self.input_quantizers['value_layer'](value_layer))
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(new_context_layer_shape)
@@ -319,21 +335,24 @@ class MobileBertSelfAttention(nn.Module):
 
 
 class MobileBertSelfOutput(nn.Module):
+    quantization_sites = ('dense', 'residual.layer_outputs', 'residual.residual_tensor', 'LayerNorm')
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.use_bottleneck = config.use_bottleneck
         self.dense = nn.Linear(config.true_hidden_size, config.true_hidden_size)
         self.LayerNorm = NORM2FN[config.normalization_type](config.true_hidden_size, eps=config.layer_norm_eps)
         if not self.use_bottleneck:
             self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, hidden_states: torch.Tensor, residual_tensor: torch.Tensor, module_name: Optional[str]) -> torch.Tensor:
-        layer_outputs = self.dense(input_quantizer(hidden_states, f'{module_name}.dense'))
+    def forward(self, hidden_states: torch.Tensor, residual_tensor: torch.Tensor) -> torch.Tensor:
+        layer_outputs = self.dense(self.input_quantizers['dense'](hidden_states))
         if not self.use_bottleneck:
             layer_outputs = self.dropout(layer_outputs)
-        layer_outputs = (input_quantizer(layer_outputs, f'{module_name}.residual.layer_outputs')
-                         + input_quantizer(residual_tensor, f'{module_name}.residual.residual_tensor'))
-        layer_outputs = self.LayerNorm(input_quantizer(layer_outputs, f'{module_name}.LayerNorm'))
+        layer_outputs = (self.input_quantizers['residual.layer_outputs'](layer_outputs)
+                         + self.input_quantizers['residual.residual_tensor'](residual_tensor))
+        layer_outputs = self.LayerNorm(self.input_quantizers['LayerNorm'](layer_outputs))
         return layer_outputs
 
 
@@ -371,7 +390,6 @@ class MobileBertAttention(nn.Module):
         attention_mask: Optional[torch.FloatTensor] = None,
         head_mask: Optional[torch.FloatTensor] = None,
         output_attentions: Optional[bool] = None,
-        module_name: Optional[str] = None,
     ) -> Tuple[torch.Tensor]:
         self_outputs = self.self(
             query_tensor,
@@ -380,49 +398,57 @@ class MobileBertAttention(nn.Module):
             attention_mask,
             head_mask,
             output_attentions,
-            f'{module_name}.self',
         )
         # Run a linear projection of `hidden_size` then add a residual
         # with `layer_input`.
-        attention_output = self.output(self_outputs[0], layer_input, f'{module_name}.output')
+        attention_output = self.output(self_outputs[0], layer_input)
         outputs = (attention_output,) + self_outputs[1:]  # add attentions if we output them
         return outputs
 
 
 class MobileBertIntermediate(nn.Module):
+    quantization_sites = ('dense', 'intermediate_act_fn')
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.dense = nn.Linear(config.true_hidden_size, config.intermediate_size)
         if isinstance(config.hidden_act, str):
             self.intermediate_act_fn = ACT2FN[config.hidden_act]
         else:
             self.intermediate_act_fn = config.hidden_act
 
-    def forward(self, hidden_states: torch.Tensor, module_name: Optional[str]) -> torch.Tensor:
-        hidden_states = self.dense(input_quantizer(hidden_states, f'{module_name}.dense'))
-        hidden_states = self.intermediate_act_fn(input_quantizer(hidden_states, f'{module_name}.intermediate_act_fn'))
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        hidden_states = self.dense(self.input_quantizers['dense'](hidden_states))
+        hidden_states = self.intermediate_act_fn(self.input_quantizers['intermediate_act_fn'](hidden_states))
         return hidden_states
 
 
 class OutputBottleneck(nn.Module):
+    quantization_sites = ('dense', 'residual.layer_outputs', 'residual.residual_tensor', 'LayerNorm')
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.dense = nn.Linear(config.true_hidden_size, config.hidden_size)
         self.LayerNorm = NORM2FN[config.normalization_type](config.hidden_size, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, hidden_states: torch.Tensor, residual_tensor: torch.Tensor, module_name: Optional[str]) -> torch.Tensor:
-        layer_outputs = self.dense(input_quantizer(hidden_states, f'{module_name}.dense'))
+    def forward(self, hidden_states: torch.Tensor, residual_tensor: torch.Tensor) -> torch.Tensor:
+        layer_outputs = self.dense(self.input_quantizers['dense'](hidden_states))
         layer_outputs = self.dropout(layer_outputs)
-        layer_outputs = (input_quantizer(layer_outputs, f'{module_name}.residual.layer_outputs')
-                        + input_quantizer(residual_tensor, f'{module_name}.residual.residual_tensor'))
-        layer_outputs = self.LayerNorm(input_quantizer(layer_outputs, f'{module_name}.LayerNorm'))
+        layer_outputs = (self.input_quantizers['residual.layer_outputs'](layer_outputs)
+                        + self.input_quantizers['residual.residual_tensor'](residual_tensor))
+        layer_outputs = self.LayerNorm(self.input_quantizers['LayerNorm'](layer_outputs))
         return layer_outputs
 
 
 class MobileBertOutput(nn.Module):
+    quantization_sites = ('dense', 'residual.layer_output', 'residual.residual_tensor_1', 'LayerNorm')
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.use_bottleneck = config.use_bottleneck
         self.dense = nn.Linear(config.intermediate_size, config.true_hidden_size)
         self.LayerNorm = NORM2FN[config.normalization_type](config.true_hidden_size)
@@ -433,29 +459,31 @@ class MobileBertOutput(nn.Module):
 
     def forward(
         self, intermediate_states: torch.Tensor, residual_tensor_1: torch.Tensor, residual_tensor_2: torch.Tensor,
-        module_name: Optional[str],
     ) -> torch.Tensor:
-        layer_output = self.dense(input_quantizer(intermediate_states, f'{module_name}.dense'))
+        layer_output = self.dense(self.input_quantizers['dense'](intermediate_states))
         if not self.use_bottleneck:
             layer_output = self.dropout(layer_output)
             layer_output = self.LayerNorm(layer_output + residual_tensor_1)
         else:
-            layer_output = (input_quantizer(layer_output, f'{module_name}.residual.layer_output')
-                            + input_quantizer(residual_tensor_1, f'{module_name}.residual.residual_tensor_1'))
-            layer_output = self.LayerNorm(input_quantizer(layer_output, f'{module_name}.LayerNorm'))
-            layer_output = self.bottleneck(layer_output, residual_tensor_2, f'{module_name}.bottleneck')
+            layer_output = (self.input_quantizers['residual.layer_output'](layer_output)
+                            + self.input_quantizers['residual.residual_tensor_1'](residual_tensor_1))
+            layer_output = self.LayerNorm(self.input_quantizers['LayerNorm'](layer_output))
+            layer_output = self.bottleneck(layer_output, residual_tensor_2)
         return layer_output
 
 
 class BottleneckLayer(nn.Module):
+    quantization_sites = ('dense', 'LayerNorm')
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.dense = nn.Linear(config.hidden_size, config.intra_bottleneck_size)
         self.LayerNorm = NORM2FN[config.normalization_type](config.intra_bottleneck_size, eps=config.layer_norm_eps)
 
-    def forward(self, hidden_states: torch.Tensor, module_name: Optional[str]) -> torch.Tensor:
-        layer_input = self.dense(input_quantizer(hidden_states, f'{module_name}.dense'))
-        layer_input = self.LayerNorm(input_quantizer(layer_input, f'{module_name}.LayerNorm'))
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        layer_input = self.dense(self.input_quantizers['dense'](hidden_states))
+        layer_input = self.LayerNorm(self.input_quantizers['LayerNorm'](layer_input))
         return layer_input
 
 
@@ -468,7 +496,7 @@ class Bottleneck(nn.Module):
         if self.key_query_shared_bottleneck:
             self.attention = BottleneckLayer(config)
 
-    def forward(self, hidden_states: torch.Tensor, module_name: Optional[str]) -> Tuple[torch.Tensor]:
+    def forward(self, hidden_states: torch.Tensor) -> Tuple[torch.Tensor]:
         # This method can return three different tuples of values. These different values make use of bottlenecks,
         # which are linear layers used to project the hidden states to a lower-dimensional vector, reducing memory
         # usage. These linear layer have weights that are learned during training.
@@ -485,27 +513,30 @@ class Bottleneck(nn.Module):
         # Finally, in the last case, the values for the query, key and values are the hidden states without bottleneck,
         # and the residual layer will be this value passed through a bottleneck.
 
-        bottlenecked_hidden_states = self.input(hidden_states, f'{module_name}.input')
+        bottlenecked_hidden_states = self.input(hidden_states)
         if self.use_bottleneck_attention:
             return (bottlenecked_hidden_states,) * 4
         elif self.key_query_shared_bottleneck:
-            shared_attention_input = self.attention(hidden_states, f'{module_name}.attention')
+            shared_attention_input = self.attention(hidden_states)
             return (shared_attention_input, shared_attention_input, hidden_states, bottlenecked_hidden_states)
         else:
             return (hidden_states, hidden_states, hidden_states, bottlenecked_hidden_states)
 
 
 class FFNOutput(nn.Module):
+    quantization_sites = ('dense', 'residual.layer_outputs', 'residual.residual_tensor', 'LayerNorm')
+
     def __init__(self, config):
         super().__init__()
+        init_quantization_sites(self)
         self.dense = nn.Linear(config.intermediate_size, config.true_hidden_size)
         self.LayerNorm = NORM2FN[config.normalization_type](config.true_hidden_size, eps=config.layer_norm_eps)
 
-    def forward(self, hidden_states: torch.Tensor, residual_tensor: torch.Tensor, module_name: Optional[str]) -> torch.Tensor:
-        layer_outputs = self.dense(input_quantizer(hidden_states, f'{module_name}.dense'))
-        layer_outputs = (input_quantizer(layer_outputs, f'{module_name}.residual.layer_outputs')
-                         + input_quantizer(residual_tensor, f'{module_name}.residual.residual_tensor'))
-        layer_outputs = self.LayerNorm(input_quantizer(layer_outputs, f'{module_name}.LayerNorm'))
+    def forward(self, hidden_states: torch.Tensor, residual_tensor: torch.Tensor) -> torch.Tensor:
+        layer_outputs = self.dense(self.input_quantizers['dense'](hidden_states))
+        layer_outputs = (self.input_quantizers['residual.layer_outputs'](layer_outputs)
+                         + self.input_quantizers['residual.residual_tensor'](residual_tensor))
+        layer_outputs = self.LayerNorm(self.input_quantizers['LayerNorm'](layer_outputs))
         return layer_outputs
 
 
@@ -515,9 +546,9 @@ class FFNLayer(nn.Module):
         self.intermediate = MobileBertIntermediate(config)
         self.output = FFNOutput(config)
 
-    def forward(self, hidden_states: torch.Tensor, module_name: Optional[str]) -> torch.Tensor:
-        intermediate_output = self.intermediate(hidden_states, f'{module_name}.intermediate')
-        layer_outputs = self.output(intermediate_output, hidden_states, f'{module_name}.output')
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        intermediate_output = self.intermediate(hidden_states)
+        layer_outputs = self.output(intermediate_output, hidden_states)
         return layer_outputs
 
 
@@ -541,10 +572,9 @@ class MobileBertLayer(nn.Module):
         attention_mask: Optional[torch.FloatTensor] = None,
         head_mask: Optional[torch.FloatTensor] = None,
         output_attentions: Optional[bool] = None,
-        module_name: Optional[str] = None,
     ) -> Tuple[torch.Tensor]:
         if self.use_bottleneck:
-            query_tensor, key_tensor, value_tensor, layer_input = self.bottleneck(hidden_states, f'{module_name}.bottleneck')
+            query_tensor, key_tensor, value_tensor, layer_input = self.bottleneck(hidden_states)
         else:
             query_tensor, key_tensor, value_tensor, layer_input = [hidden_states] * 4
 
@@ -556,7 +586,6 @@ class MobileBertLayer(nn.Module):
             attention_mask,
             head_mask,
             output_attentions=output_attentions,
-            module_name=f'{module_name}.attention',
         )
         attention_output = self_attention_outputs[0]
         s = (attention_output,)
@@ -564,11 +593,11 @@ class MobileBertLayer(nn.Module):
 
         if self.num_feedforward_networks != 1:
             for i, ffn_module in enumerate(self.ffn):
-                attention_output = ffn_module(attention_output, f'{module_name}.ffn.{i}')
+                attention_output = ffn_module(attention_output)
                 s += (attention_output,)
 
-        intermediate_output = self.intermediate(attention_output, f'{module_name}.intermediate')
-        layer_output = self.output(intermediate_output, attention_output, hidden_states, f'{module_name}.output')
+        intermediate_output = self.intermediate(attention_output)
+        layer_output = self.output(intermediate_output, attention_output, hidden_states)
         outputs = (
             (layer_output,)
             + outputs
@@ -599,7 +628,6 @@ class MobileBertEncoder(nn.Module):
         output_attentions: Optional[bool] = False,
         output_hidden_states: Optional[bool] = False,
         return_dict: Optional[bool] = True,
-        module_name: Optional[str] = None,
     ) -> Union[Tuple, BaseModelOutput]:
         all_hidden_states = () if output_hidden_states else None
         all_attentions = () if output_attentions else None
@@ -612,7 +640,6 @@ class MobileBertEncoder(nn.Module):
                 attention_mask,
                 head_mask[i],
                 output_attentions,
-                f'{module_name}.layer.{i}',
             )
             hidden_states = layer_outputs[0]
 
@@ -926,7 +953,6 @@ class MobileBertModel(MobileBertPreTrainedModel):
             position_ids=position_ids,
             token_type_ids=token_type_ids,
             inputs_embeds=inputs_embeds,
-            module_name='mobilebert.embeddings'
         )
         encoder_outputs = self.encoder(
             embedding_output,
@@ -935,7 +961,6 @@ class MobileBertModel(MobileBertPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
-            module_name='mobilebert.encoder'
         )
         sequence_output = encoder_outputs[0]
         pooled_output = self.pooler(sequence_output) if self.pooler is not None else None
@@ -1280,8 +1305,11 @@ class MobileBertForNextSentencePrediction(MobileBertPreTrainedModel):
 )
 # Copied from transformers.models.bert.modeling_bert.BertForSequenceClassification with Bert->MobileBert all-casing
 class MobileBertForSequenceClassification(MobileBertPreTrainedModel):
-    def __init__(self, config, quantizer):
+    quantization_sites = ('classifier',)
+
+    def __init__(self, config, quantizer=None):
         super().__init__(config)
+        init_quantization_sites(self)
         self.num_labels = config.num_labels
         self.config = config
 
@@ -1295,8 +1323,8 @@ class MobileBertForSequenceClassification(MobileBertPreTrainedModel):
         # Initialize weights and apply final processing
         self.post_init()
 
-        global input_quantizer
-        input_quantizer = quantizer
+        if quantizer is not None:
+            set_quantization_plan(self, quantizer)
 
     @add_start_docstrings_to_model_forward(MOBILEBERT_INPUTS_DOCSTRING.format("batch_size, sequence_length"))
     @add_code_sample_docstrings(
@@ -1342,7 +1370,7 @@ class MobileBertForSequenceClassification(MobileBertPreTrainedModel):
         pooled_output = outputs[1]
 
         pooled_output = self.dropout(pooled_output)
-        pooled_output = input_quantizer(pooled_output, "classifier")
+        pooled_output = self.input_quantizers['classifier'](pooled_output)
         logits = self.classifier(pooled_output)
 
         loss = None
@@ -1388,10 +1416,13 @@ class MobileBertForSequenceClassification(MobileBertPreTrainedModel):
 )
 # Copied from transformers.models.bert.modeling_bert.BertForQuestionAnswering with Bert->MobileBert all-casing
 class MobileBertForQuestionAnswering(MobileBertPreTrainedModel):
+    quantization_sites = ('qa_outputs',)
+
     _keys_to_ignore_on_load_unexpected = [r"pooler"]
 
-    def __init__(self, config, quantizer):
+    def __init__(self, config, quantizer=None):
         super().__init__(config)
+        init_quantization_sites(self)
         self.num_labels = config.num_labels
 
         self.mobilebert = MobileBertModel(config, add_pooling_layer=False)
@@ -1400,8 +1431,8 @@ class MobileBertForQuestionAnswering(MobileBertPreTrainedModel):
         # Initialize weights and apply final processing
         self.post_init()
 
-        global input_quantizer
-        input_quantizer = quantizer
+        if quantizer is not None:
+            set_quantization_plan(self, quantizer)
 
     @add_start_docstrings_to_model_forward(MOBILEBERT_INPUTS_DOCSTRING.format("batch_size, sequence_length"))
     @add_code_sample_docstrings(
@@ -1453,7 +1484,7 @@ class MobileBertForQuestionAnswering(MobileBertPreTrainedModel):
 
         sequence_output = outputs[0]
 
-        logits = self.qa_outputs(input_quantizer(sequence_output, "qa_outputs"))
+        logits = self.qa_outputs(self.input_quantizers['qa_outputs'](sequence_output))
         start_logits, end_logits = logits.split(1, dim=-1)
         start_logits = start_logits.squeeze(-1).contiguous()
         end_logits = end_logits.squeeze(-1).contiguous()
@@ -5,6 +5,8 @@ from torch.ao.nn.intrinsic import _FusedModule
 from typing import Tuple, TypeVar, Union
 from torch.nn.common_types import _size_1_t, _size_2_t, _size_3_t
 
+from .utils import WeightFakeQuantCacheMixin
+
 __all__ = [
     "Conv1d",
     "Conv2d",
@@ -13,7 +15,7 @@ __all__ = [
 
 MOD = TypeVar('MOD', bound=nn.modules.conv._ConvNd)
 
-class _ConvNd(nn.modules.conv._ConvNd):
+class _ConvNd(WeightFakeQuantCacheMixin, nn.modules.conv._ConvNd):
 
     _FLOAT_MODULE = MOD
 
@@ -41,7 +43,7 @@ class _ConvNd(nn.modules.conv._ConvNd):
         self.weight_fake_quant = qconfig.weight(factory_kwargs=factory_kwargs)
 
     def forward(self, input):
-        return self._conv_forward(input, self.weight_fake_quant(self.weight), self.bias)
+        return self._conv_forward(input, self.fake_quant_weight(), self.bias)
 
     @staticmethod
     def from_float(cls, mod):
@@ -205,7 +207,7 @@ class Conv2d(_ConvNd, nn.Conv2d):
             dtype=dtype)
 
     def forward(self, input):
-        return self._conv_forward(input, self.weight_fake_quant(self.weight), self.bias)
+        return self._conv_forward(input, self.fake_quant_weight(), self.bias)
 
     @classmethod
     def from_float(cls, mod):
@@ -263,7 +265,7 @@ class Conv3d(_ConvNd, nn.Conv3d):
             dtype=dtype)
 
     def forward(self, input):
-        return self._conv_forward(input, self.weight_fake_quant(self.weight), self.bias)
+        return self._conv_forward(input, self.fake_quant_weight(), self.bias)
 
     @classmethod
     def from_float(cls, mod):
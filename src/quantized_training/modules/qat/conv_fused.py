@@ -10,6 +10,8 @@ from torch.nn.modules.utils import _single, _pair, _triple
 from torch.nn.parameter import Parameter
 from typing import TypeVar
 
+from .utils import WeightFakeQuantCacheMixin
+
 __all__ = ['ConvBn1d', 'ConvBnReLU1d', 'ConvReLU1d', 'ConvBn2d', 'ConvBnReLU2d', 'ConvReLU2d', 'ConvBn3d',
            'ConvBnReLU3d', 'ConvReLU3d', 'update_bn_stats', 'freeze_bn_stats']
 _BN_CLASS_MAP = {
@@ -22,7 +24,7 @@ _BN_CLASS_MAP = {
 MOD = TypeVar('MOD', bound=nn.modules.conv._ConvNd)
 
 
-class _ConvBnNd(nn.modules.conv._ConvNd, nni._FusedModule):
+class _ConvBnNd(WeightFakeQuantCacheMixin, nn.modules.conv._ConvNd, nni._FusedModule):
 
     _version = 2
     _FLOAT_MODULE = MOD
@@ -96,10 +98,46 @@ class _ConvBnNd(nn.modules.conv._ConvNd, nni._FusedModule):
         return self
 
     def _forward(self, input):
+        # Only BN frozen through freeze_bn_stats() is folded. A plain eval()
+        # keeps the numerics of the approximate path.
+        if self.freeze_bn:
+            return self._forward_frozen(input)
         if self._enable_slow_path_for_better_numerical_stability:
             return self._forward_slow(input)
         return self._forward_approximate(input)
 
+    def _weight_cache_extra_state(self):
+        # The folded weight and bias also depend on the conv bias, the BN
+        # parameters and the running statistics
+        tensors = [self.bias, self.bn.weight, self.bn.bias, self.bn.running_mean, self.bn.running_var]
+        return tuple((t.data_ptr(), t._version) for t in tensors if t is not None)
+
+    def _fold_frozen_bn(self):
+        # With running statistics BN is an affine map per channel, which folds
+        # into the conv weight and bias:
+        #   Z = conv(X, fake_quant(r * W / running_std)) - r * (running_mean - B_c) / running_std + beta
+        running_std = torch.sqrt(self.bn.running_var + self.bn.eps)
+        scale_factor = self.bn.weight / running_std
+        weight_shape = [1] * len(self.weight.shape)
+        weight_shape[0] = -1
+        scaled_weight = self.weight_fake_quant(self.weight * scale_factor.reshape(weight_shape))
+        fused_mean = self.bn.running_mean - (self.bias if self.bias is not None else 0)
+        fused_bias = self.bn.bias - self.bn.weight * fused_mean / running_std
+        return scaled_weight, fused_bias
+
+    def _forward_frozen(self, input):
+        """Fused conv and bn with frozen BN statistics, which is a single conv.
+
+        The folded weight and bias are cached while no gradient is required
+        and reused until the conv or BN parameters, the running statistics or
+        the state of `weight_fake_quant` change, see
+        `WeightFakeQuantCacheMixin`.
+        """
+        weight, bias = self._cached_weight(
+            self.weight, self._fold_frozen_bn, (self.bias, self.bn.weight, self.bn.bias)
+        )
+        return self._conv_forward(input, weight, bias.to(input.dtype))
+
     def _forward_approximate(self, input):
         """Approximated method to fuse conv and bn. It requires only one forward pass.
         conv_orig = conv / scale_factor where scale_factor = bn.weight / running_std
@@ -229,6 +267,7 @@ class _ConvBnNd(nn.modules.conv._ConvNd, nni._FusedModule):
         changing it if BN is frozen. This makes sure that calling `model.train()`
         on a model with a frozen BN will behave properly.
         """
+        self.invalidate_weight_cache()
         self.training = mode
         if not self.freeze_bn:
             for module in self.children():
@@ -8,11 +8,13 @@ from torch.nn.utils.parametrize import (
     transfer_parametrizations_and_params,
 )
 
+from .utils import WeightFakeQuantCacheMixin
+
 __all__ = [
     "Linear"
 ]
 
-class Linear(nn.Linear):
+class Linear(WeightFakeQuantCacheMixin, nn.Linear):
     r"""
     A linear module attached with FakeQuantize modules for weight,
     used for quantization aware training.
@@ -22,7 +24,8 @@ class Linear(nn.Linear):
     for documentation.
 
     Similar to `torch.nn.Linear`, with FakeQuantize modules initialized to
-    default.
+    default. The fake quantized weight is cached while no gradient is
+    required, see `WeightFakeQuantCacheMixin`.
 
     Attributes:
         weight: fake quant module for weight
@@ -38,7 +41,7 @@ class Linear(nn.Linear):
         self.weight_fake_quant = qconfig.weight(factory_kwargs=factory_kwargs)
 
     def forward(self, input):
-        return F.linear(input, self.weight_fake_quant(self.weight), self.bias)
+        return F.linear(input, self.fake_quant_weight(), self.bias)
 
     @classmethod
     def from_float(cls, mod):
@@ -1,3 +1,5 @@
+import contextlib
+
 import torch
 import torch.nn.functional as F
 from torch.nn.utils.parametrize import type_before_parametrizations
@@ -5,12 +7,87 @@ from torch.nn.utils.parametrize import type_before_parametrizations
 from peft.tuners import lora
 from peft.utils.other import transpose
 
+from .linear import Linear as QATLinear
+from .utils import WeightFakeQuantCacheMixin
+
 __all__ = [
-    "Linear"
+    "Linear",
+    "group_adapters",
 ]
 
-class Linear(lora.Linear):
+def group_adapters(adapter_names, device=None):
+    r"""Groups the rows of a batch by the adapter each row names.
+
+    Args:
+        adapter_names: adapter of every row of the batch, or None for rows
+            that only use the base model
+        device: device of the row indices
+
+    Returns:
+        A list of (adapter, row indices) pairs for `Linear.batch_adapters`.
+        Rows that only use the base model are grouped under None.
+    """
+    rows = {}
+    for row, adapter in enumerate(adapter_names):
+        rows.setdefault(adapter, []).append(row)
+    return [
+        (adapter, torch.tensor(indices, dtype=torch.long, device=device))
+        for adapter, indices in rows.items()
+    ]
+
+@contextlib.contextmanager
+def _observers_disabled(fake_quants):
+    enabled = [fq for fq in fake_quants if getattr(fq, "_observer_enabled", False)]
+    for fake_quant in enabled:
+        fake_quant.enable_observer(False)
+    try:
+        yield
+    finally:
+        for fake_quant in enabled:
+            fake_quant.enable_observer(True)
+
+class Linear(WeightFakeQuantCacheMixin, lora.Linear):
+    r"""
+    A LoRA linear module attached with FakeQuantize modules for weight,
+    used for quantization aware training.
+
+    By default the active adapters are merged into the base weight on every
+    forward and the merged weight is fake quantized, which matches a model
+    whose adapters are merged before quantization.
+
+    With `low_rank_forward` the merged weight is never formed. The frozen base
+    weight is fake quantized by `weight_fake_quant` and cached, see
+    `WeightFakeQuantCacheMixin`, and each adapter is applied as
+    ``(x @ A^T) @ B^T``. A and B are fake quantized by `weight_A_fake_quant`
+    and `weight_B_fake_quant`, and ``x @ A^T`` by `adapter_act_fake_quant`.
+    These quantizers are only created once the low-rank forward is enabled
+    or loaded from a state dict, so models that never use it keep the state
+    dict of the merged forward.
+    Since the base weight does not change, its observer is disabled once the
+    scale has settled so that the cache can be used while training. Unlike
+    the merged forward, the low-rank forward applies `lora_dropout`.
+
+    Several adapters can be served in one batch by setting `batch_adapters`,
+    see `group_adapters`. Every row is computed with the numerics the module
+    was trained with, regardless of the active adapters. With
+    `low_rank_forward` the base GEMM runs once for the whole batch and every
+    adapter is applied with the low-rank forward to the rows that name it.
+    Otherwise the rows of each adapter are multiplied by the fake quantized
+    merged weight of that adapter. Like the base weight, the merged weight of
+    every adapter is cached while no gradient is required, which keeps one
+    weight per served adapter in memory. Serving does not update the scales,
+    so the observers are paused during the forward.
+
+    Attributes:
+        low_rank_forward: whether to apply the adapters as low-rank products
+        batch_adapters: (adapter, row indices) pairs of the current batch
+    """
     _FLOAT_MODULE = lora.Linear
+    _LOW_RANK_FAKE_QUANTS = ("weight_A_fake_quant", "weight_B_fake_quant", "adapter_act_fake_quant")
+    _use_low_rank = False
+    batch_adapters = None
+    _merged_weight_cache = None
+    _base_observations = 0
 
     def __init__(
         self,
@@ -30,7 +107,144 @@ class Linear(lora.Linear):
         assert qconfig, 'quantizer must be provided for QAT module'
         self.qconfig = qconfig
         self.weight_fake_quant = qconfig.weight(**kwargs)
-        
+
+    @property
+    def low_rank_forward(self):
+        return self._use_low_rank
+
+    @low_rank_forward.setter
+    def low_rank_forward(self, enabled):
+        if enabled:
+            self._init_low_rank_fake_quants()
+        self._use_low_rank = enabled
+
+    def _init_low_rank_fake_quants(self):
+        # Quantizers of the adapter path of the low-rank forward
+        if "weight_A_fake_quant" in self._modules:
+            return
+        device = self.weight.device
+        self.weight_A_fake_quant = self.qconfig.weight().to(device)
+        self.weight_B_fake_quant = self.qconfig.weight().to(device)
+        self.adapter_act_fake_quant = self.qconfig.activation().to(device)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # Create the low-rank quantizers before the submodules are loaded if
+        # the state dict was saved with them
+        names = tuple(prefix + name + "." for name in self._LOW_RANK_FAKE_QUANTS)
+        if any(key.startswith(names) for key in state_dict):
+            self._init_low_rank_fake_quants()
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
+
+    def _base_weight(self):
+        fake_quant = self.weight_fake_quant
+        if not self.weight.requires_grad and getattr(fake_quant, "_observer_enabled", False):
+            # With delayed scaling the scale of a constant weight is final
+            # after it has been observed twice
+            self._base_observations += 1
+            if self._base_observations >= 2:
+                weight = fake_quant(self.weight)
+                fake_quant.enable_observer(False)
+                return weight
+        return self.fake_quant_weight()
+
+    def _adapter_delta(self, adapter, x):
+        weight_A = self.weight_A_fake_quant(self.lora_A[adapter].weight)
+        weight_B = self.weight_B_fake_quant(self.lora_B[adapter].weight)
+        hidden = self.adapter_act_fake_quant(F.linear(self.lora_dropout[adapter](x), weight_A))
+        return F.linear(hidden, weight_B) * self.scaling[adapter]
+
+    def _low_rank_forward(self, x):
+        weight = transpose(self._base_weight(), self.fan_in_fan_out)
+        result = F.linear(x, weight, bias=self.bias)
+        for active_adapter in self.active_adapters:
+            if active_adapter in self.lora_A.keys():
+                result = result + self._adapter_delta(active_adapter, x)
+        return result
+
+    def _serving_fake_quants(self):
+        if self.low_rank_forward:
+            return [self.weight_fake_quant] + [getattr(self, name) for name in self._LOW_RANK_FAKE_QUANTS]
+        return [self.weight_fake_quant]
+
+    def _multi_adapter_low_rank_forward(self, x):
+        # The base GEMM runs once on the whole batch, and each adapter only on
+        # the rows of the requests that name it
+        weight = transpose(self._base_weight(), self.fan_in_fan_out)
+        result = F.linear(x, weight, bias=self.bias)
+        for adapter, indices in self.batch_adapters:
+            if adapter in self.lora_A.keys():
+                if indices.device != x.device:
+                    indices = indices.to(x.device)
+                delta = self._adapter_delta(adapter, x.index_select(0, indices))
+                result.index_add_(0, indices, delta.to(result.dtype))
+        return result
+
+    def _adapter_merged_weight(self, adapter):
+        lora_A = self.lora_A[adapter].weight
+        lora_B = self.lora_B[adapter].weight
+        key = self._weight_cache_state(self.weight) if self.cache_weight_fake_quant else None
+        if key is None or (torch.is_grad_enabled() and (lora_A.requires_grad or lora_B.requires_grad)):
+            return self.weight_fake_quant(self._merge_adapters(self.weight.detach(), [adapter]))
+
+        key += (lora_A.data_ptr(), lora_A._version, lora_B.data_ptr(), lora_B._version)
+        if self._merged_weight_cache is None:
+            self._merged_weight_cache = {}
+        cached = self._merged_weight_cache.get(adapter)
+        if cached is None or cached[0] != key:
+            with torch.no_grad():
+                weight = self.weight_fake_quant(self._merge_adapters(self.weight.detach(), [adapter]))
+            cached = (key, weight)
+            self._merged_weight_cache[adapter] = cached
+        return cached[1]
+
+    def _multi_adapter_merged_forward(self, x):
+        # Every row starts from the base model output. Each adapter then runs
+        # one GEMM on its rows with its merged weight, like the merged forward
+        # of that adapter, and overwrites them.
+        weight = transpose(self.fake_quant_weight(), self.fan_in_fan_out)
+        result = F.linear(x, weight, bias=self.bias)
+        for adapter, indices in self.batch_adapters:
+            if adapter in self.lora_A.keys():
+                if indices.device != x.device:
+                    indices = indices.to(x.device)
+                weight = transpose(self._adapter_merged_weight(adapter), self.fan_in_fan_out)
+                output = F.linear(x.index_select(0, indices), weight, bias=self.bias)
+                result.index_copy_(0, indices, output.to(result.dtype))
+        return result
+
+    def _multi_adapter_forward(self, x):
+        num_rows = sum(indices.numel() for _, indices in self.batch_adapters)
+        if x.shape[0] != num_rows:
+            raise ValueError(
+                f"Expected a batch of {num_rows} rows, one per adapter name, "
+                f"but got {x.shape[0]}"
+            )
+        with _observers_disabled(self._serving_fake_quants()):
+            if self.low_rank_forward:
+                return self._multi_adapter_low_rank_forward(x)
+            return self._multi_adapter_merged_forward(x)
+
+    def invalidate_weight_cache(self):
+        super().invalidate_weight_cache()
+        self._merged_weight_cache = None
+
+    def _merge_adapters(self, weight, adapters=None):
+        if adapters is None:
+            adapters = self.active_adapters
+        for active_adapter in adapters:
+            if active_adapter in self.lora_A.keys():
+                weight_A = self.weight_fake_quant(self.lora_A[active_adapter].weight)
+                weight_B = self.weight_fake_quant(self.lora_B[active_adapter].weight)
+                scaling = self.scaling[active_adapter]
+                weight = weight + transpose(weight_B @ weight_A, self.fan_in_fan_out) * scaling
+        return weight
+
+    def _merged_forward(self, x):
+        weight = self.weight_fake_quant(self._merge_adapters(self.weight.detach()))
+        return F.linear(x, transpose(weight, self.fan_in_fan_out), bias=self.bias)
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         previous_dtype = x.dtype
 
@@ -40,16 +254,12 @@ class Linear(lora.Linear):
             result = self._linear(x)
         elif self.merged:
             result = self._linear(x)
+        elif self.batch_adapters is not None:
+            result = self._multi_adapter_forward(x)
+        elif self.low_rank_forward:
+            result = self._low_rank_forward(x)
         else:
-            orig_weights = self.weight.data.clone()
-            for active_adapter in self.active_adapters:
-                if active_adapter in self.lora_A.keys():
-                    weight_A = self.weight_fake_quant(self.lora_A[active_adapter].weight)
-                    weight_B = self.weight_fake_quant(self.lora_B[active_adapter].weight)
-                    scaling = self.scaling[active_adapter]
-                    orig_weights += transpose(weight_B @ weight_A, self.fan_in_fan_out) * scaling
-            orig_weights = self.weight_fake_quant(orig_weights)
-            result = F.linear(x, transpose(orig_weights, self.fan_in_fan_out), bias=self.bias)
+            result = self._merged_forward(x)
 
         result = result.to(previous_dtype)
         return result
@@ -83,6 +293,51 @@ class Linear(lora.Linear):
         qat_linear.lora_B = mod.lora_B
         return qat_linear
 
-    @classmethod
-    def to_float():
-        raise NotImplementedError
+    def _to_linear(self, cls, weight, **kwargs):
+        linear = cls(self.in_features, self.out_features, self.bias is not None, **kwargs)
+        linear.weight = torch.nn.Parameter(transpose(weight, self.fan_in_fan_out).contiguous())
+        if self.bias is not None:
+            linear.bias = torch.nn.Parameter(self.bias.detach())
+        linear.train(self.training)
+        return linear
+
+    @torch.no_grad()
+    def _merged_weight(self):
+        weight = self.weight.detach()
+        if self.disable_adapters or self.merged:
+            return weight
+        with _observers_disabled([self.weight_fake_quant]):
+            return self._merge_adapters(weight)
+
+    def to_float(self):
+        r"""Returns an ``nn.Linear`` whose weight is the base weight with the
+        active adapters folded in, without the final weight fake quantization.
+        """
+        return self._to_linear(torch.nn.Linear, self._merged_weight())
+
+    @torch.no_grad()
+    def merge_and_quantize(self, keep_fake_quant=False):
+        r"""Folds the active adapters into the base weight once and applies the
+        final weight fake quantization, so that the result computes the merged
+        forward without the adapter GEMMs or the per-step merge.
+
+        Args:
+            keep_fake_quant: return a ``qat.Linear`` that holds the merged
+                weight and this module's `weight_fake_quant` instead of an
+                ``nn.Linear`` with the fake quantized weight
+
+        Returns:
+            An ``nn.Linear`` or ``qat.Linear`` module
+
+        The observer of `weight_fake_quant` is paused during the merge, so the
+        scales are those of the last training step and this module is left
+        unchanged.
+        """
+        weight = self._merged_weight()
+        if keep_fake_quant:
+            linear = self._to_linear(QATLinear, weight, qconfig=self.qconfig)
+            linear.weight_fake_quant = self.weight_fake_quant
+            return linear
+        with _observers_disabled([self.weight_fake_quant]):
+            weight = self.weight_fake_quant(weight)
+        return self._to_linear(torch.nn.Linear, weight)
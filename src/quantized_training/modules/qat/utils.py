@@ -0,0 +1,90 @@
+import torch
+
+__all__ = [
+    "WeightFakeQuantCacheMixin",
+]
+
+class WeightFakeQuantCacheMixin:
+    r"""
+    Mixin for QAT modules that caches the fake quantized weight while no
+    gradient is required, e.g. in `eval()` or under `torch.no_grad()`.
+
+    The cached weight is reused until the weight or the state of
+    `weight_fake_quant` changes. Changes are detected through the version
+    counters of the weight and the scale, the weight storage, and the enable
+    flags of the fake quantizer. A fake quantizer that is still observing is
+    never cached, since every call updates its scale.
+
+    Writes through `weight.data` do not bump the version counter, so
+    `invalidate_weight_cache()` has to be called after them. Setting
+    `cache_weight_fake_quant` to False forces the weight to be quantized on
+    every forward.
+
+    Modules whose cached weight also depends on other tensors, such as the
+    BN statistics folded into a conv, add them to the cache key through
+    `_weight_cache_extra_state()` and compute the weight with
+    `_cached_weight()`.
+
+    Attributes:
+        cache_weight_fake_quant: whether to reuse the fake quantized weight
+    """
+    cache_weight_fake_quant = True
+    _weight_cache = None
+    _weight_cache_key = None
+
+    def invalidate_weight_cache(self):
+        self._weight_cache = None
+        self._weight_cache_key = None
+
+    def _weight_cache_state(self, weight):
+        fake_quant = self.weight_fake_quant
+        scale = getattr(fake_quant, "scale", None)
+        if scale is None or getattr(fake_quant, "_observer_enabled", True):
+            return None
+        return (
+            weight.data_ptr(),
+            weight._version,
+            weight.dtype,
+            weight.device,
+            scale._version,
+            fake_quant._fake_quant_enabled,
+        ) + self._weight_cache_extra_state()
+
+    def _weight_cache_extra_state(self):
+        return ()
+
+    def _cached_weight(self, weight, compute, tensors=()):
+        r"""Returns ``compute()``, reusing the cached result while the key of
+        `_weight_cache_state` is unchanged. Nothing is cached while the weight
+        or one of ``tensors``, the other inputs of ``compute``, requires a
+        gradient.
+        """
+        if (
+            not self.cache_weight_fake_quant
+            or (torch.is_grad_enabled()
+                and any(t is not None and t.requires_grad for t in (weight, *tensors)))
+            or (key := self._weight_cache_state(weight)) is None
+        ):
+            self.invalidate_weight_cache()
+            return compute()
+
+        if key != self._weight_cache_key:
+            self._weight_cache = compute()
+            self._weight_cache_key = key
+        return self._weight_cache
+
+    def fake_quant_weight(self, weight=None):
+        r"""Returns the fake quantized weight, reusing the cached result when
+        neither the weight nor the fake quantizer have changed.
+        """
+        if weight is None:
+            weight = self.weight
+        return self._cached_weight(weight, lambda: self.weight_fake_quant(weight))
+
+    def train(self, mode=True):
+        self.invalidate_weight_cache()
+        return super().train(mode)
+
+    def _apply(self, fn, *args, **kwargs):
+        self.invalidate_weight_cache()
+        return super()._apply(fn, *args, **kwargs)
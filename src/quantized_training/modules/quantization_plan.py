@@ -0,0 +1,87 @@
+from typing import Callable, Optional
+
+import torch
+from torch import nn
+
+__all__ = [
+    "init_quantization_sites",
+    "set_quantization_plan",
+]
+
+
+def _identity(input):
+    return input
+
+
+class _STEQuantize(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, input, fake_quant):
+        return fake_quant(input)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output, None
+
+
+class _InputQuantizer:
+    """Fake quantizes the input of a site with a straight-through gradient."""
+
+    __slots__ = ("fake_quant",)
+
+    def __init__(self, fake_quant):
+        self.fake_quant = fake_quant
+
+    def __call__(self, input):
+        return _STEQuantize.apply(input, self.fake_quant)
+
+
+def init_quantization_sites(module: nn.Module):
+    """Give every site declared in ``module.quantization_sites`` an identity
+    quantizer until a plan is installed with ``set_quantization_plan``.
+    """
+    module.input_quantizers = dict.fromkeys(module.quantization_sites, _identity)
+
+
+def set_quantization_plan(
+    model: nn.Module,
+    get_quantizer: Optional[Callable[[str], Optional[nn.Module]]],
+):
+    """Resolve the quantizer of every quantization site in ``model`` once, so
+    that the forward pass only does a dictionary lookup per site.
+
+    A site is named by the path of its module in ``model`` followed by the
+    site name, e.g. ``bert.encoder.layer.0.output.dense``. ``get_quantizer``
+    is called once per site with that name and returns the fake quantizer of
+    the site, or None to leave the site unquantized. Fake quantizers are
+    registered under ``model.input_fake_quants`` so that they move with the
+    model and are saved in its state dict. Passing None for ``get_quantizer``
+    removes the plan.
+
+    Args:
+        model: model with modules that declare ``quantization_sites``
+        get_quantizer: function from a site name to a fake quantizer or None
+    """
+    fake_quants = nn.ModuleDict()
+    registered = set()
+    for prefix, module in model.named_modules():
+        sites = getattr(module, "quantization_sites", None)
+        if sites is None:
+            continue
+        input_quantizers = {}
+        for site in sites:
+            name = f"{prefix}.{site}" if prefix else site
+            fake_quant = get_quantizer(name) if get_quantizer is not None else None
+            if fake_quant is None:
+                input_quantizers[site] = _identity
+                continue
+            if id(fake_quant) not in registered:
+                registered.add(id(fake_quant))
+                fake_quants[name.replace(".", "_")] = fake_quant
+            input_quantizers[site] = _InputQuantizer(fake_quant)
+        module.input_quantizers = input_quantizers
+
+    if "input_fake_quants" in model._modules:
+        del model.input_fake_quants
+    if len(fake_quants) > 0:
+        model.input_fake_quants = fake_quants
+    return model
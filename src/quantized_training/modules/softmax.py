@@ -1,85 +1,243 @@
+import math
+import os
+import threading
+import weakref
+
 import torch
 from torch import nn
 
+from quantized_training.fake_quantize import _canonical_device
+from quantized_training.posit import quantize_to_posit
+from quantized_training.quant_tables import load_table
+
 
 POSIT_EXP_FILE = "src/quantized_training/posit_gold/posit16_1_exp.txt"
 POSIT_EXP_SHIFTED_FILE = "src/quantized_training/posit_gold/posit16_1_exp_shifted.txt"
 POSIT_RECIPROCAL_FILE = "src/quantized_training/posit_gold/posit16_1_reciprocal.txt"
 
-def _convert(input: torch.Tensor, values: torch.Tensor):
+def _convert(input: torch.Tensor, values: torch.Tensor, inplace: bool = False):
     # Keep 8 exponent bits and 14 fraction bits, which is the maximum number
     # of fraction bits for a 16-bit posit.
     if input.dtype == torch.bfloat16:
         indices = (input.view(torch.int16).int() << 7) & 0x3fffff
+    elif inplace and input.dtype == torch.float:
+        # Compute the indices in the memory of the input, which is consumed
+        raw_bits = input.view(torch.int32)
+        sticky = (raw_bits & 0x1ff) != 0
+        indices = raw_bits.bitwise_right_shift_(9).bitwise_and_(0x3fffff).bitwise_or_(sticky)
     else:
         raw_bits = input.float().view(torch.int32)
         indices = ((raw_bits >> 9) & 0x3fffff) | ((raw_bits & 0x1ff) != 0).int()
     return values[indices].to(input.dtype)
 
 class PositSoftmax(torch.autograd.Function):
+    """Softmax with optional posit lookup tables for the exponential and the
+    reciprocal of the sum. The input is shifted by its max inside the
+    function, which the result does not depend on. With the posit reciprocal
+    the gradient w.r.t. the shifted input does not sum to zero, and the part
+    that flows through the shift is routed to the max like autograd through
+    torch.amax would.
+
+    With ``recompute`` the backward pass only keeps the output and the per
+    row sum, and recovers exp(x) as the output divided by the reciprocal
+    looked up from the sum, instead of saving exp(x).
+    """
+
     @staticmethod
-    def forward(ctx, i, dim, posit_exp=None, posit_reciprocal=None):
+    def forward(ctx, i, dim, posit_exp=None, posit_reciprocal=None, recompute=False):
+        max_i = torch.amax(i, dim=dim, keepdim=True)
+        is_max = i == max_i if posit_reciprocal is not None else None
+        shifted = torch.sub(i, max_i)
+        del max_i
         if posit_exp is None:
-            exp_x = torch.exp(i)
+            exp_x = shifted.exp_()
         else:
-            exp_x = _convert(i, posit_exp)
+            exp_x = _convert(shifted, posit_exp, inplace=True)
+        del shifted
         exp_x_sum = torch.sum(exp_x, dim=dim, keepdim=True)
 
+        ctx.dim = dim
+        ctx.posit_reciprocal = posit_reciprocal
+        ctx.recompute = recompute
         if posit_reciprocal is None:
-            output = exp_x / exp_x_sum
-            ctx.save_for_backward(output, None, None)
+            output = exp_x.div_(exp_x_sum)
+            ctx.save_for_backward(output, None, None, None)
+        elif recompute:
+            output = exp_x.mul_(_convert(exp_x_sum, posit_reciprocal))
+            ctx.save_for_backward(output, None, exp_x_sum, is_max)
         else:
             output = exp_x * _convert(exp_x_sum, posit_reciprocal)
-            ctx.save_for_backward(output, exp_x, exp_x_sum)
+            ctx.save_for_backward(output, exp_x, exp_x_sum, is_max)
 
         return output
 
     @staticmethod
     def backward(ctx, grad_output):
-        output, exp_x, exp_x_sum = ctx.saved_tensors
+        output, exp_x, exp_x_sum, is_max = ctx.saved_tensors
+        dim = ctx.dim
 
-        if exp_x is None and exp_x_sum is None:
-            grad_input = output * grad_output
-            sum_grad = torch.sum(grad_input, dim=-1, keepdims=True)
+        grad_input = output * grad_output
+        if exp_x_sum is None:
+            sum_grad = torch.sum(grad_input, dim=dim, keepdim=True)
             grad_input -= output * sum_grad
+            return grad_input, None, None, None, None
+
+        deriv = torch.pow(2, torch.floor(torch.log2(exp_x_sum)) * -2 - 1)
+        if exp_x is None:
+            # exp_x = output / r, where r is the reciprocal of the sum
+            reciprocal = _convert(exp_x_sum, ctx.posit_reciprocal)
+            sum_grad = torch.sum(grad_input, dim=dim, keepdim=True)
+            grad_input -= (deriv * sum_grad / (reciprocal * reciprocal)) * output
         else:
-            grad_input = output * grad_output
-            sum_grad = torch.sum(exp_x * grad_output, dim=-1, keepdims=True)
-            deriv = torch.pow(2, torch.floor(torch.log2(exp_x_sum)) * -2 - 1)
+            sum_grad = torch.sum(exp_x * grad_output, dim=dim, keepdim=True)
             grad_input -= deriv * exp_x * sum_grad
 
-        return grad_input, None, None, None
+        # Gradient of the max shift, split evenly between tied maxima
+        grad_max = torch.sum(grad_input, dim=dim, keepdim=True)
+        grad_input -= is_max * (grad_max / torch.sum(is_max, dim=dim, keepdim=True))
+        return grad_input, None, None, None, None
 
-def _read_tensor(filepath, dtype=None, device=None):
+def _parse_table(filepath):
     with open(filepath, 'r') as file:
         values = [float.fromhex(line.rstrip()) for line in file]
-    return torch.tensor(values, dtype=dtype, device=device)
+    return torch.tensor(values, dtype=torch.float)
 
-class Softmax(nn.Softmax):
-    posit_exp: torch.Tensor
-    posit_reciprocal: torch.Tensor
+def _generate_table(fn):
+    # Every 22-bit index of _convert is the magnitude of a float with the
+    # same exponent and top 14 fraction bits. The input is rounded to a
+    # posit before the function is applied, and the result after it.
+    indices = torch.arange(1 << 22, dtype=torch.int32)
+    input = quantize_to_posit((indices << 9).view(torch.float), 16, 1)
+    return quantize_to_posit(fn(input), 16, 1)
+
+# Table name -> (gold file, function used to generate the table without it).
+# Softmax inputs are shifted by their max, so the exponential is taken of the
+# negated magnitude.
+SOFTMAX_TABLES = {
+    "posit16_1_exp": (POSIT_EXP_FILE, lambda x: torch.exp(-x)),
+    "posit16_1_exp_shifted": (POSIT_EXP_SHIFTED_FILE, None),
+    "posit16_1_reciprocal": (POSIT_RECIPROCAL_FILE, torch.reciprocal),
+}
 
+# Tables are loaded on first use, memory-mapped from the table store, and
+# shared per (name, dtype, device) by all Softmax modules. The cache only
+# holds weak references; every Softmax keeps the tables it uses alive.
+_TABLE_CACHE = weakref.WeakValueDictionary()
+_TABLE_LOCK = threading.Lock()
+
+def get_softmax_table(name, dtype=None, device=None):
+    key = (name, dtype, _canonical_device(device))
+    with _TABLE_LOCK:
+        values = _TABLE_CACHE.get(key)
+        if values is None:
+            filepath, fn = SOFTMAX_TABLES[name]
+            if os.path.exists(filepath):
+                values = load_table(name, lambda: _parse_table(filepath), torch.float)
+            elif fn is not None:
+                values = load_table(f"{name}_generated", lambda: _generate_table(fn), torch.float)
+            else:
+                raise FileNotFoundError(f"Table {name} can not be generated and {filepath} does not exist")
+            values = values.to(dtype=dtype, device=key[2])
+            _TABLE_CACHE[key] = values
+    return values
+
+class Softmax(nn.Softmax):
     def __init__(
         self,
         posit_exp=False,
         posit_exp_shifted=False,
         posit_reciprocal=False,
         dim=None,
+        recompute=False,
         **kwargs
     ):
         super().__init__(dim)
-        dtype = kwargs.get("dtype", None)
-        device = kwargs.get("device", None)
-        factory_kwargs = {'dtype': dtype, 'device': device}
-        self.posit_exp = None
+        # Recompute exp(x) in the backward pass instead of saving it
+        self.recompute = recompute
+        # The device argument is accepted for compatibility. Tables are
+        # looked up on the device of the input.
+        self.table_dtype = kwargs.get("dtype", None)
+        self.posit_exp_table = None
         if posit_exp:
-            self.posit_exp = _read_tensor(POSIT_EXP_FILE, **factory_kwargs)
+            self.posit_exp_table = "posit16_1_exp"
         elif posit_exp_shifted:
-            self.posit_exp = _read_tensor(POSIT_EXP_SHIFTED_FILE, **factory_kwargs)
-        self.posit_reciprocal = None
-        if posit_reciprocal:
-            self.posit_reciprocal = _read_tensor(POSIT_RECIPROCAL_FILE, **factory_kwargs)
+            self.posit_exp_table = "posit16_1_exp_shifted"
+        self.posit_reciprocal_table = "posit16_1_reciprocal" if posit_reciprocal else None
+        # (device, exp table, reciprocal table) for the device of the last
+        # input. Holding the shared tables keeps them in the cache.
+        self._tables = None
+
+    def _get_table(self, name, device):
+        if name is None:
+            return None
+        return get_softmax_table(name, self.table_dtype, device)
+
+    def _get_tables(self, device):
+        tables = self._tables
+        if tables is None or tables[0] != device:
+            tables = (
+                device,
+                self._get_table(self.posit_exp_table, device),
+                self._get_table(self.posit_reciprocal_table, device),
+            )
+            self._tables = tables
+        return tables
+
+    def _current_tables(self):
+        device = self._tables[0] if self._tables is not None else _canonical_device(None)
+        return self._get_tables(device)
+
+    @property
+    def posit_exp(self):
+        return self._current_tables()[1]
+
+    @property
+    def posit_reciprocal(self):
+        return self._current_tables()[2]
+
+    def __getstate__(self):
+        # Copies and pickles look the shared tables up again
+        state = self.__dict__.copy()
+        state["_tables"] = None
+        return state
 
     def forward(self, input: torch.Tensor) -> torch.Tensor:
-        input = input - torch.amax(input, dim=self.dim, keepdim=True)
-        return PositSoftmax.apply(input, self.dim, self.posit_exp, self.posit_reciprocal)
+        _, posit_exp, posit_reciprocal = self._get_tables(input.device)
+        return PositSoftmax.apply(input, self.dim, posit_exp, posit_reciprocal, self.recompute)
+
+class IntSoftmaxFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, input, dim, scale, output_bits):
+        output = torch.ops.quantized_ops.softmax_int(input, dim, scale, output_bits)
+        ctx.dim = dim
+        ctx.save_for_backward(output)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        output, = ctx.saved_tensors
+        grad_input = output * grad_output
+        sum_grad = torch.sum(grad_input, dim=ctx.dim, keepdim=True)
+        grad_input -= output * sum_grad
+        return grad_input, None, None, None
+
+class IntSoftmax(nn.Softmax):
+    r"""Integer-only softmax, see ``quantized_ops.softmax_int``. The input is
+    rounded to multiples of ``scale`` and the output to multiples of
+    ``2 ** -output_bits``. The backward pass is the softmax gradient evaluated
+    at the integer output.
+    """
+
+    def __init__(self, dim=None, scale=2 ** -8, output_bits=8):
+        super().__init__(dim)
+        # The exponential is evaluated with 32-bit integers
+        if not 2 ** -14 <= scale < math.log(2):
+            raise ValueError(f"scale must be in [2^-14, ln(2)), got {scale}")
+        self.scale = scale
+        self.output_bits = output_bits
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        return IntSoftmaxFunction.apply(input, self.dim, self.scale, self.output_bits)
+
+    def extra_repr(self) -> str:
+        return f"dim={self.dim}, scale={self.scale}, output_bits={self.output_bits}"
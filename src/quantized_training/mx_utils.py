@@ -1,9 +1,16 @@
+import functools
+import itertools
+
 import torch
 
 __all__ = [
     "_shared_exponents",
     "_reshape_to_blocks",
     "_undo_reshape_to_blocks",
+    "_exponent_from_bits",
+    "_mx_block_plan",
+    "_mx_shared_exponents",
+    "_memory_order",
 ]
 
 
@@ -132,3 +139,123 @@ def _undo_reshape_to_blocks(A, padded_shape, orig_shape, axes):
         # Remove extra dimension
         A = torch.squeeze(A, dim=axis + 1)
     return A
+
+
+def _exponent_from_bits(A):
+    """
+    Compute floor(log2(A)) of a non-negative tensor by reading the float32
+    exponent field. The exponent of a subnormal is read from its mantissa
+    converted to a float, so that it does not depend on denormals being
+    flushed. Zeros get the exponent of the smallest normal number,
+    infinities and NaNs are passed through.
+    """
+    A = A.float()
+    bits = A.view(torch.int32)
+    biased_exp = (bits >> 23) & 0xff
+    mantissa_exp = ((((bits & 0x7fffff).float().view(torch.int32) >> 23) & 0xff)
+                    - 2 * FP32_EXPONENT_BIAS - 22)
+    shared_exp = torch.where(biased_exp == 0, mantissa_exp, biased_exp - FP32_EXPONENT_BIAS)
+    shared_exp = torch.where((bits & 0x7fffffff) == 0, 1 - FP32_EXPONENT_BIAS, shared_exp)
+    return torch.where(biased_exp == 0xff, A, shared_exp.float())
+
+
+@functools.lru_cache(maxsize=None)
+def _mx_block_plan(shape, axes, block_size):
+    """
+    Plan how to split a tensor into MX blocks along the given axes without
+    padding. Every axis is split into a region of full blocks and a ragged
+    last block, so that each combination of regions can be viewed as blocks
+    of equal size.
+    Args:
+      shape      {tuple(int)} -- Shape of the tensor
+      axes       {tuple(int)} -- Sorted, non-negative axes to block along
+      block_size {int}        -- Block size, or 0 to use the whole axis
+    Returns:
+      exp_shape {tuple(int)} -- Shape of the shared exponents, one per block
+      segments  {list}       -- (slices, block_shape, amax_shape, reduce_dims,
+                                exp_slices) for each region
+    """
+    regions = []
+    for axis in axes:
+        size = shape[axis]
+        step = block_size if 0 < block_size <= size else size
+        num_blocks, remainder = divmod(size, step)
+        axis_regions = []
+        if num_blocks > 0:
+            axis_regions.append((0, num_blocks, step))
+        if remainder > 0:
+            axis_regions.append((num_blocks * step, 1, remainder))
+        regions.append(axis_regions)
+
+    exp_shape = list(shape)
+    for axis, axis_regions in zip(axes, regions):
+        exp_shape[axis] = sum(r[1] for r in axis_regions)
+
+    segments = []
+    for combo in itertools.product(*regions):
+        region = dict(zip(axes, combo))
+        slices = [slice(None)] * len(shape)
+        exp_slices = [slice(None)] * len(shape)
+        block_shape, amax_shape, reduce_dims = [], [], []
+        for dim, size in enumerate(shape):
+            if dim not in region:
+                block_shape.append(size)
+                amax_shape.append(size)
+                continue
+            start, num_blocks, length = region[dim]
+            exp_start = 0 if start == 0 else exp_shape[dim] - 1
+            slices[dim] = slice(start, start + num_blocks * length)
+            exp_slices[dim] = slice(exp_start, exp_start + num_blocks)
+            block_shape += [num_blocks, length]
+            amax_shape += [num_blocks, 1]
+            reduce_dims.append(len(block_shape) - 1)
+        segments.append((
+            tuple(slices), tuple(block_shape), tuple(amax_shape), tuple(reduce_dims),
+            tuple(exp_slices),
+        ))
+    return tuple(exp_shape), segments
+
+
+def _memory_order(A, axes):
+    """
+    Find the permutation of the dimensions of A that makes it contiguous, so
+    that a channels_last or otherwise permuted tensor can be blocked in its
+    memory order. Blocks along the innermost dimension are then contiguous,
+    and the blocks, their scales and the result are all dense without copies.
+    Returns:
+      perm {tuple(int)} -- Permutation, or None if A is contiguous or is not a
+                           permutation of a contiguous tensor
+      axes {tuple(int)} -- Sorted, non-negative axes in the permuted tensor
+    """
+    axes = tuple(sorted({x + A.ndim if x < 0 else x for x in axes}))
+    if A.is_contiguous():
+        return None, axes
+    perm = tuple(sorted(range(A.ndim), key=lambda d: -A.stride(d)))
+    if not A.permute(perm).is_contiguous():
+        return None, axes
+    return perm, tuple(sorted(perm.index(x) for x in axes))
+
+
+def _inverse_permutation(perm):
+    return tuple(sorted(range(len(perm)), key=lambda d: perm[d]))
+
+
+def _mx_shared_exponents(A, axes, block_size):
+    """
+    Get the shared exponent of each MX block of A, read from the exponent
+    bits of the block maximum. Blocks are viewed in place, and a ragged last
+    block along an axis is handled as a separate region instead of padding.
+    Permuted inputs such as channels_last tensors are blocked in memory order.
+    Returns:
+      shared_exp {PyTorch tensor} -- float32 tensor with one exponent per block
+    """
+    perm, axes = _memory_order(A, axes)
+    if perm is not None:
+        shared_exp = _mx_shared_exponents(A.permute(perm), axes, block_size)
+        return shared_exp.permute(_inverse_permutation(perm))
+    exp_shape, segments = _mx_block_plan(tuple(A.shape), axes, block_size)
+    shared_exp = torch.empty(exp_shape, dtype=torch.float, device=A.device)
+    for slices, block_shape, _, reduce_dims, exp_slices in segments:
+        amax = torch.amax(torch.abs(A[slices].view(block_shape)), dim=reduce_dims)
+        shared_exp[exp_slices] = _exponent_from_bits(amax).view(shared_exp[exp_slices].shape)
+    return shared_exp
@@ -1,5 +1,9 @@
+import functools
+
 import torch
 
+from quantized_training.elementwise import apply_elementwise
+
 
 def create_normal_map(offset=0.9677083, use_extra_value=True, k=4):
     try:
@@ -31,8 +35,37 @@ def create_normal_map(offset=0.9677083, use_extra_value=True, k=4):
     return values
 
 
-def quantize_to_nf(input: torch.Tensor, k: int = 4):
-    values = create_normal_map(k=k)
-    values = values.to(dtype=torch.bfloat16, device=input.device)
-    indices = torch.argmin(torch.abs(values - input.unsqueeze(-1)), dim=-1)
-    return values[indices]
+@functools.lru_cache(maxsize=None)
+def get_normal_code_book(k: int = 4, device=None):
+    """Return the bfloat16 NormalFloat values of a k-bit code book and the
+    float32 midpoints between neighbouring values. Both are computed once per
+    k and device, and must not be modified.
+    """
+    values = create_normal_map(k=k).to(dtype=torch.bfloat16, device=device)
+    boundaries = (values[:-1].float() + values[1:].float()) / 2
+    return values, boundaries
+
+
+def quantize_to_nf(
+    input: torch.Tensor,
+    k: int = 4,
+    return_codes: bool = False,
+    chunk_size: int = None,
+    out: torch.Tensor = None,
+    num_threads: int = 0,
+):
+    """Round the input to the nearest value of the k-bit NormalFloat code
+    book. Ties go to the smaller value and NaNs are kept. If ``return_codes``
+    is True, the uint8 codes are returned along with the quantized values.
+    """
+    if chunk_size is not None or out is not None:
+        assert not return_codes, "return_codes is not supported with chunk_size or out"
+        fn = functools.partial(quantize_to_nf, k=k)
+        return apply_elementwise(fn, input, chunk_size, out, num_threads)
+
+    values, boundaries = get_normal_code_book(k, input.device)
+    codes = torch.bucketize(input.float(), boundaries)
+    output = values[codes].masked_fill(torch.isnan(input), float("nan"))
+    if return_codes:
+        return output, codes.to(torch.uint8)
+    return output
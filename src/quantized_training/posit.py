@@ -1,7 +1,10 @@
+import functools
 import math
 import torch
 
-__all__ = ["quantize_to_posit"]
+from quantized_training.elementwise import apply_elementwise
+
+__all__ = ["quantize_to_posit", "encode_posit", "decode_posit"]
 
 def quantize_to_posit(
     input: torch.Tensor,
@@ -9,7 +12,15 @@ def quantize_to_posit(
     es: int = 1,
     round_to_even: bool = True,
     return_pbits: bool = False,
+    chunk_size: int = None,
+    out: torch.Tensor = None,
+    num_threads: int = 0,
 ) -> torch.Tensor:
+    if chunk_size is not None or out is not None:
+        assert not return_pbits, "return_pbits is not supported with chunk_size or out"
+        fn = functools.partial(quantize_to_posit, nbits=nbits, es=es, round_to_even=round_to_even)
+        return apply_elementwise(fn, input, chunk_size, out, num_threads)
+
     raw_bits = input.clone().to(torch.float).view(torch.int32)
     scale = ((raw_bits & 0x7f800000) >> 23) - 127
     fraction = raw_bits & 0x7fffff
@@ -60,19 +71,118 @@ def quantize_to_posit(
     if return_pbits:
         pt_bits >>= len - nbits
         pt_bits &= (1 << (nbits - 1)) - 1 # Mask out any bits left of the sign bit including the sign bit
-        pt_bits[rb] += 1
+        pt_bits += rb.int()
         pt_bits *= torch.sign(input).int()
         return output, pt_bits
 
     return output
 
+def _decode_posit_bits(bits: int, nbits: int, es: int) -> float:
+    """Decode an unsigned nbits posit bit pattern to a Python float."""
+    if bits == 0:
+        return 0.0
+    if bits == 1 << (nbits - 1):
+        return math.nan
+
+    sign = bits >> (nbits - 1)
+    if sign:
+        bits = -bits & ((1 << nbits) - 1)
+
+    # Regime: run of identical bits after the sign bit
+    pos = nbits - 2
+    first = (bits >> pos) & 1
+    run = 0
+    while pos >= 0 and ((bits >> pos) & 1) == first:
+        run += 1
+        pos -= 1
+    k = run - 1 if first else -run
+    pos -= 1  # skip the terminating bit
+
+    # Exponent bits that do not fit are zero
+    exponent = 0
+    for _ in range(es):
+        exponent <<= 1
+        if pos >= 0:
+            exponent |= (bits >> pos) & 1
+            pos -= 1
+
+    nf = max(pos + 1, 0)
+    fraction = bits & ((1 << nf) - 1)
+    value = math.ldexp(1 + fraction / (1 << nf), k * (1 << es) + exponent)
+    return -value if sign else value
+
+
+@functools.lru_cache(maxsize=None)
+def get_posit_decode_table(nbits: int = 8, es: int = 1, device=None) -> torch.Tensor:
+    """Return the float32 value of every nbits posit code, indexed by the
+    unsigned bit pattern. The table is cached and must not be modified.
+    """
+    values = [_decode_posit_bits(bits, nbits, es) for bits in range(1 << nbits)]
+    return torch.tensor(values, dtype=torch.float, device=device)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_posit_encode_table(nbits: int, es: int, device=None) -> torch.Tensor:
+    # Posit codes read as two's complement integers are ordered like their
+    # values, so the values of codes -maxcode..maxcode are sorted.
+    max_code = (1 << (nbits - 1)) - 1
+    codes = torch.arange(-max_code, max_code + 1, device=device) & ((1 << nbits) - 1)
+    return get_posit_decode_table(nbits, es, device)[codes]
+
+
+def encode_posit(
+    input: torch.Tensor,
+    nbits: int = 8,
+    es: int = 1,
+    round_to_even: bool = True,
+    chunk_size: int = None,
+) -> torch.Tensor:
+    """Round the input to the nbits posit grid like quantize_to_posit and
+    return the posit codes. Codes of up to 8 bits are packed as uint8 bit
+    patterns, wider codes as sign-extended int16. NaNs and infinities map to
+    NaR.
+
+    The input is processed in chunks of ``chunk_size`` elements to bound the
+    size of the temporaries.
+    """
+    assert nbits <= 16, "Posit codes wider than 16 bits are not supported"
+    code_dtype = torch.uint8 if nbits <= 8 else torch.int16
+    sorted_values = _get_posit_encode_table(nbits, es, input.device)
+    max_code = (1 << (nbits - 1)) - 1
+
+    flat = input.reshape(-1)
+    codes = torch.empty(flat.shape, dtype=code_dtype, device=input.device)
+    chunk_size = chunk_size or max(flat.numel(), 1)
+    for start in range(0, flat.numel(), chunk_size):
+        chunk = flat[start:start + chunk_size].float()
+        value = quantize_to_posit(chunk, nbits, es, round_to_even=round_to_even)
+        code = torch.searchsorted(sorted_values, value) - max_code
+        code = torch.where(torch.isnan(value), -max_code - 1, code)
+        if nbits <= 8:
+            code &= (1 << nbits) - 1
+        codes[start:start + chunk_size] = code
+    return codes.view(input.shape)
+
+
+def decode_posit(
+    codes: torch.Tensor,
+    nbits: int = 8,
+    es: int = 1,
+    dtype: torch.dtype = torch.float,
+) -> torch.Tensor:
+    """Decode posit codes produced by encode_posit through the decode table."""
+    table = get_posit_decode_table(nbits, es, codes.device)
+    return table[codes.long() & ((1 << nbits) - 1)].to(dtype)
+
+
 def write_posit_values():
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
     input_tensor = torch.arange(2 ** 16, dtype=torch.int16, device=device).view(torch.bfloat16)
     posit_values = quantize_to_posit(input_tensor, 8, 1, round_to_even=True)
     with open('posit8_1.txt', 'w') as file:
-        for v1, v2 in zip(input_tensor, posit_values):
-            file.write(f"{v1.item()}\t{v2.item()}\n")
+        file.writelines(
+            f"{v1}\t{v2}\n" for v1, v2 in zip(input_tensor.tolist(), posit_values.tolist())
+        )
 
 if __name__ == "__main__":
     write_posit_values()
@@ -32,23 +32,23 @@ class QConfig(namedtuple('QConfig', ['activation', 'weight', 'error'])):
     def __new__(cls, activation, weight, error):
         return super().__new__(cls, activation, weight, error)
 
-def _create_fake_quant(quantization_spec, record_histogram, force_scale_power_of_two):
+def _create_fake_quant(quantization_spec, **fake_quant_kwargs):
     if quantization_spec is None:
         return nn.Identity
 
     kwargs_dict = asdict(quantization_spec)
     kwargs = copy.deepcopy(kwargs_dict)
-    return FusedAmaxObsFakeQuantize.with_args(
-        **kwargs,
-        record_histogram=record_histogram,
-        force_scale_power_of_two=force_scale_power_of_two
-    )
+    return FusedAmaxObsFakeQuantize.with_args(**kwargs, **fake_quant_kwargs)
 
 def get_qconfig(activation, weight, error, record_histogram=False,
-                force_scale_power_of_two=False):
+                force_scale_power_of_two=False, compile_kernel=False,
+                histogram_sample_every=1, histogram_sample_size=None):
     kwargs = {
         "record_histogram": record_histogram,
-        "force_scale_power_of_two": force_scale_power_of_two
+        "force_scale_power_of_two": force_scale_power_of_two,
+        "compile_kernel": compile_kernel,
+        "histogram_sample_every": histogram_sample_every,
+        "histogram_sample_size": histogram_sample_size,
     }
     return QConfig(
         activation=_create_fake_quant(activation, **kwargs),
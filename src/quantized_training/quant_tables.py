@@ -0,0 +1,113 @@
+"""On-disk store for precomputed lookup tables.
+
+Tables are saved as one ``.npy`` file per name under a versioned directory and
+loaded back with a copy-on-write memory map, so reading a table does not copy
+or recompute it. Missing tables are generated on first use and written to the
+store. The store location defaults to ``~/.cache/quantized_training/tables`` and
+can be overridden with the ``QUANTIZED_TRAINING_TABLE_DIR`` environment
+variable.
+"""
+import logging
+import os
+import tempfile
+from typing import Callable
+
+import numpy as np
+import torch
+
+__all__ = [
+    "TABLE_VERSION",
+    "get_table_dir",
+    "load_table",
+]
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the contents of any generated table change
+TABLE_VERSION = 3
+
+_STORAGE_DTYPES = {
+    1: (torch.uint8, np.uint8),
+    2: (torch.int16, np.int16),
+    4: (torch.int32, np.int32),
+    8: (torch.int64, np.int64),
+}
+
+
+def get_table_dir() -> str:
+    root = os.environ.get(
+        "QUANTIZED_TRAINING_TABLE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "quantized_training", "tables"),
+    )
+    return os.path.join(root, f"v{TABLE_VERSION}")
+
+
+def _table_path(name: str) -> str:
+    return os.path.join(get_table_dir(), name + ".npy")
+
+
+def _save(path: str, table: torch.Tensor):
+    storage_dtype, _ = _STORAGE_DTYPES[table.element_size()]
+    array = table.detach().cpu().contiguous().view(storage_dtype).numpy()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so concurrent readers never see a partial table
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npy")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _load(path: str, dtype: torch.dtype) -> torch.Tensor:
+    # Copy-on-write mapping keeps the buffer writable for torch.frombuffer
+    # without touching the file on disk.
+    array = np.load(path, mmap_mode="c")
+    _, np_dtype = _STORAGE_DTYPES[dtype.itemsize]
+    if array.dtype != np_dtype:
+        raise ValueError(f"Table {path} has dtype {array.dtype}, expected {np_dtype}")
+    return torch.frombuffer(array, dtype=dtype)
+
+
+def load_table(name: str, build_fn: Callable[[], torch.Tensor], dtype: torch.dtype) -> torch.Tensor:
+    """Load the 1-D table called ``name`` from the store, building it with
+    ``build_fn`` and saving it if it does not exist yet.
+
+    Returns a CPU tensor of the given dtype backed by a memory-mapped file.
+    """
+    path = _table_path(name)
+    if os.path.exists(path):
+        try:
+            return _load(path, dtype)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load table {path}, rebuilding it: {e}")
+
+    table = build_fn().to(device="cpu", dtype=dtype).flatten()
+    try:
+        _save(path, table)
+    except OSError as e:
+        logger.warning(f"Failed to save table {path}: {e}")
+        return table
+    return _load(path, dtype)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from quantized_training.fake_quantize import load_quantization_map
+
+    parser = argparse.ArgumentParser(description="Prebuild quantization map tables.")
+    parser.add_argument(
+        "--dtype",
+        nargs="+",
+        default=["int8", "int4", "fp8_e4m3", "fp8_e5m2", "fp6_e3m2", "fp6_e2m3",
+                 "fp4_e2m1", "posit8_1", "posit16_1", "nf4"],
+    )
+    args = parser.parse_args()
+
+    for dtype in args.dtype:
+        load_quantization_map(dtype)
+        print(f"{dtype}: {_table_path(dtype)}")
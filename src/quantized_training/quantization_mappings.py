@@ -70,3 +70,10 @@ QCONFIG_PROPAGATE_MODULE_CLASS_LIST = {
         quantizable.MulFunctional,
     ],
 }
+
+# Number of tensor inputs of modules that take more than one, used to create
+# their observers up front. Every other module takes a single tensor input.
+MODULE_INPUT_ARITY: Dict[Callable, int] = {
+    quantizable.MatmulFunctional: 2,
+    quantizable.AddFunctional: 2,
+}
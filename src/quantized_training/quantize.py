@@ -1,5 +1,6 @@
 import copy
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
@@ -9,15 +10,27 @@ from torch.nn.utils.parametrize import type_before_parametrizations
 
 from accelerate import dispatch_model
 from transformers import PretrainedConfig
+from transformers import activations
 
 from quantized_training.modules import (
+    IntSoftmax,
+    LUTActivation,
+    LUTLayerNorm,
     Softmax,
     modeling_bert,
     modeling_mobilebert,
 )
+import quantized_training.modules.qat as nnqat
+from quantized_training.modules.qat.lora import group_adapters
+from quantized_training.modules.quantization_plan import set_quantization_plan
+from quantized_training.fake_quantize import (
+    FusedAmaxObsFakeQuantize,
+    _foreach_fake_quantize_,
+)
 from quantized_training.qconfig import get_qconfig
 from quantized_training.quantization_mappings import (
     DEFAULT_QAT_MODULE_MAPPINGS,
+    MODULE_INPUT_ARITY,
     QCONFIG_PROPAGATE_MODULE_CLASS_LIST,
     TRANSFORMER_MODULE_MAPPINGS,
 )
@@ -25,9 +38,13 @@ from quantized_training.quantization_mappings import (
 __all__ = [
     "propagate_config",
     "quantize",
+    "quantize_weights_",
     "prepare",
     "convert",
+    "replace_activation",
     "replace_softmax",
+    "merge_and_quantize",
+    "set_batch_adapters",
     "get_quantized_model",
 ]
 
@@ -59,6 +76,7 @@ def quantize(model, args, inplace=True):
         or args.posit_exp
         or args.posit_exp_shifted
         or args.posit_reciprocal
+        or getattr(args, 'int_softmax', False)
     ) and (
         hasattr(model, 'config') and isinstance(model.config, PretrainedConfig)
     ):
@@ -68,13 +86,24 @@ def quantize(model, args, inplace=True):
     if hasattr(model, 'hf_device_map'):
         dispatch_model(model, device_map=model.hf_device_map)
 
-    if args.posit_exp or args.posit_exp_shifted or args.posit_reciprocal:
+    int_softmax = getattr(args, 'int_softmax', False)
+    if args.posit_exp or args.posit_exp_shifted or args.posit_reciprocal or int_softmax:
         replace_softmax(
             model,
             posit_exp=args.posit_exp,
             posit_exp_shifted=args.posit_exp_shifted,
             posit_reciprocal=args.posit_reciprocal,
             dtype=torch.bfloat16 if args.bf16 else None,
+            recompute=getattr(args, 'softmax_recompute', False),
+            integer=int_softmax,
+            scale=getattr(args, 'int_softmax_scale', 2 ** -8),
+        )
+
+    if getattr(args, 'lut_activation', None):
+        replace_activation(
+            model,
+            functions=args.lut_activation,
+            dtype=getattr(args, 'lut_activation_dtype', None),
         )
 
     if getattr(args, 'bf16', False):
@@ -86,31 +115,74 @@ def quantize(model, args, inplace=True):
         args.error,
         args.record_histogram,
         args.force_scale_power_of_two,
+        getattr(args, 'compile_fake_quant', False),
+        getattr(args, 'histogram_sample_every', 1),
+        getattr(args, 'histogram_sample_size', None),
     )
 
     propagate_config(model, 'qconfig', qconfig)
 
-    for name, param in model.named_parameters():
-        if 'bias' in name:
-            continue
-        obs_or_fq = qconfig.weight(device=param.device)
-        if getattr(obs_or_fq, 'qscheme', None) is not None:
-            obs_or_fq(param.data)
-        param.data = obs_or_fq(param.data)
+    quantize_weights_(
+        model, qconfig.weight, num_workers=getattr(args, 'weight_quant_num_workers', 0)
+    )
 
     # If doing quantization aware training, swap QAT modules. LoRA has custom
     # implementation, so it needs to be swapped to match the training behavior.
     if args.weight is not None and (args.do_train or args.lora_rank > 0):
         convert(model, DEFAULT_QAT_MODULE_MAPPINGS, inplace=True)
+        if getattr(args, 'lora_low_rank_forward', False):
+            for module in model.modules():
+                if isinstance(module, nnqat.LoraLinear):
+                    module.low_rank_forward = True
 
     if args.activation is None:
         args.quantize_forward = None
     if args.error is None:
         args.quantize_backprop = None
-    prepare(model, True, args.quantize_forward, args.quantize_backprop, args.op_fusion)
+    prepare(
+        model, True, args.quantize_forward, args.quantize_backprop, args.op_fusion,
+        input_arity=MODULE_INPUT_ARITY if getattr(args, 'create_observers_up_front', False) else None,
+    )
 
     return model
 
+def quantize_weights_(model, weight_obs_or_fq_ctr, chunk_numel=2 ** 26, num_workers=0):
+    r"""Fake quantizes all weights of the model in place. Each weight is
+    quantized with its own scale, as if observed and then quantized by a
+    fresh weight fake quantizer.
+
+    Weights are bucketed by shape, dtype and device. Each bucket is split into
+    chunks of at most ``chunk_numel`` elements (and at least one weight), and
+    every chunk is quantized in a single multi-tensor pass. The chunks can be
+    run on a pool of ``num_workers`` threads.
+    """
+    buckets = {}
+    for name, param in model.named_parameters():
+        if 'bias' in name:
+            continue
+        buckets.setdefault((param.shape, param.dtype, param.device), []).append(param)
+
+    def quantize_chunk(device, params):
+        obs_or_fq = weight_obs_or_fq_ctr(device=device)
+        if isinstance(obs_or_fq, FusedAmaxObsFakeQuantize):
+            _foreach_fake_quantize_([param.data for param in params], obs_or_fq)
+        else:
+            for param in params:
+                param.data = obs_or_fq(param.data)
+
+    chunks = []
+    for (shape, _, device), params in buckets.items():
+        chunk_size = max(chunk_numel // max(shape.numel(), 1), 1)
+        for i in range(0, len(params), chunk_size):
+            chunks.append((device, params[i:i + chunk_size]))
+
+    if num_workers > 0:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(lambda chunk: quantize_chunk(*chunk), chunks))
+    else:
+        for chunk in chunks:
+            quantize_chunk(*chunk)
+
 def _parse_ops(op_str):
     ops = {op.lower() for op in op_str.split(',')} if op_str is not None else set()
     valid_ops = set(QCONFIG_PROPAGATE_MODULE_CLASS_LIST.keys())
@@ -124,7 +196,23 @@ def _get_unique_devices_(mod):
     return {p.device for p in mod.parameters()} | \
         {p.device for p in mod.buffers()}
 
-def _register_module_hook(module, hook_name, name):
+class ErrorQuantFunction(torch.autograd.Function):
+    r"""Identity in the forward pass that quantizes the gradient with the
+    given error observer in the backward pass. Wrapping the inputs or outputs
+    of a module with it quantizes the errors like full backward hooks would,
+    without their per-module bookkeeping.
+    """
+
+    @staticmethod
+    def forward(ctx, input, obs_or_fq):
+        ctx.obs_or_fq = obs_or_fq
+        return input.view_as(input)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return ctx.obs_or_fq(grad_output), None
+
+def _register_module_hook(module, hook_name, name, input_spec=None, device=None):
     obs_or_fq_dict = nn.ModuleDict()
     module.add_module(hook_name, obs_or_fq_dict)
 
@@ -133,50 +221,161 @@ def _register_module_hook(module, hook_name, name):
         else module.qconfig.error
     )
 
-    # TODO statically create all fake quant modules depends on the type of the
-    # input module. Only MatmulFunctional, AddFunctional, and MulFunctional have
-    # two inputs
+    # Observers indexed by the position of the input they quantize, None for
+    # positions that have not seen a tensor yet
+    obs_or_fqs = []
+
+    def create_obs_or_fq(i, device):
+        obs_or_fq = obs_or_fq_ctr(device=device)
+        obs_or_fq.name = f"{name}.{i}"
+        obs_or_fq_dict[str(i)] = obs_or_fq
+        obs_or_fqs.extend([None] * (i + 1 - len(obs_or_fqs)))
+        obs_or_fqs[i] = obs_or_fq
+        return obs_or_fq
+
+    # Observers of the inputs in input_spec are created up front. Tensors at
+    # any other position get their observer on first use.
+    for i in input_spec or ():
+        create_obs_or_fq(i, device)
+
     def observer_pre_hook(self, inputs):
-        new_inputs = []
+        if len(inputs) == 1 and len(obs_or_fqs) == 1:
+            input = inputs[0]
+            return (obs_or_fqs[0](input),) if isinstance(input, torch.Tensor) else inputs
+
+        new_inputs = list(inputs)
         for i, input in enumerate(inputs):
             if not isinstance(input, torch.Tensor):
-                new_inputs.append(input)
                 continue
-
-            if (obs_or_fq_name := str(i)) not in obs_or_fq_dict:
-                obs_or_fq = obs_or_fq_ctr(device=input.device)
-                obs_or_fq.name = f"{name}.{obs_or_fq_name}"
-                obs_or_fq_dict[obs_or_fq_name] = obs_or_fq
-            new_inputs.append(obs_or_fq_dict[obs_or_fq_name](input))
+            obs_or_fq = obs_or_fqs[i] if i < len(obs_or_fqs) else None
+            if obs_or_fq is None:
+                obs_or_fq = create_obs_or_fq(i, input.device)
+            new_inputs[i] = obs_or_fq(input)
         return tuple(new_inputs)
 
-    def backward_hook(self, grad_inputs, grad_outputs):
-        return observer_pre_hook(self, grad_inputs)
+    def quantize_grads(tensors):
+        new_tensors = list(tensors)
+        for i, tensor in enumerate(tensors):
+            if not isinstance(tensor, torch.Tensor) or not tensor.requires_grad:
+                continue
+            obs_or_fq = obs_or_fqs[i] if i < len(obs_or_fqs) else None
+            if obs_or_fq is None:
+                obs_or_fq = create_obs_or_fq(i, tensor.device)
+            new_tensors[i] = ErrorQuantFunction.apply(tensor, obs_or_fq)
+        return tuple(new_tensors)
+
+    # Gradients of the outputs are quantized before they reach the module
+    def error_pre_hook(self, inputs, output):
+        if not torch.is_grad_enabled():
+            return None
+        if isinstance(output, torch.Tensor):
+            return quantize_grads((output,))[0]
+        if isinstance(output, tuple):
+            return quantize_grads(output)
+        return None
+
+    # Gradients of the inputs are quantized when they leave the module
+    def error_post_hook(self, inputs):
+        if not torch.is_grad_enabled():
+            return None
+        return quantize_grads(inputs)
 
     if hook_name == 'activation_pre_process':
         module.register_forward_pre_hook(observer_pre_hook)
     elif hook_name == 'error_pre_process':
-        module.register_full_backward_pre_hook(observer_pre_hook)
+        module.register_forward_hook(error_pre_hook)
     elif hook_name == 'error_post_process':
-        module.register_full_backward_hook(backward_hook)
+        module.register_forward_pre_hook(error_post_hook)
+
+def _tensor_positions(values, requires_grad=False):
+    if isinstance(values, torch.Tensor):
+        values = (values,)
+    elif not isinstance(values, (tuple, list)):
+        return ()
+    return tuple(
+        i for i, v in enumerate(values)
+        if isinstance(v, torch.Tensor) and (v.requires_grad or not requires_grad)
+    )
+
+def _record_input_specs(model, example_inputs):
+    """Run the model once on the example inputs and record, for every
+    submodule, the positions of its tensor inputs and outputs, and the device
+    of its first tensor input. Returns a dict from module name to
+    ``{hook_name: input_spec, "device": device}``.
+    """
+    specs = {}
+
+    def record_hook(name):
+        def hook(module, args, output):
+            device = next((a.device for a in args if isinstance(a, torch.Tensor)), None)
+            specs[name] = {
+                'activation_pre_process': _tensor_positions(args),
+                'error_pre_process': _tensor_positions(output, requires_grad=True),
+                'error_post_process': _tensor_positions(args, requires_grad=True),
+                'device': device,
+            }
+        return hook
+
+    handles = [
+        m.register_forward_hook(record_hook(name)) for name, m in model.named_modules()
+    ]
+    was_training = model.training
+    try:
+        # Gradients are enabled to find the inputs and outputs that get one
+        model.eval()
+        with torch.enable_grad():
+            model(*example_inputs)
+    finally:
+        model.train(was_training)
+        for handle in handles:
+            handle.remove()
+    return specs
+
+def _arity_input_specs(module, input_arity, device):
+    num_inputs = input_arity.get(type_before_parametrizations(module), 1)
+    if device is None:
+        devices = _get_unique_devices_(module)
+        device = next(iter(devices)) if len(devices) == 1 else None
+    if device is None:
+        return None
+    return {
+        'activation_pre_process': tuple(range(num_inputs)),
+        'error_pre_process': (0,),
+        'error_post_process': tuple(range(num_inputs)),
+        'device': device,
+    }
 
 def _add_observer_(
         module, fwd_pre_hook_module_list, bwd_pre_hook_module_list,
-        bwd_residual, op_fusion, prefix):
+        bwd_residual, op_fusion, prefix, input_specs=None, input_arity=None,
+        device=None):
     def insert_obs_or_fq(m, name):
         if not hasattr(m, 'qconfig') or m.qconfig is None:
             return
         if op_fusion is not None and any(layer in name for layer in op_fusion):
             return
+
+        spec = None
+        if input_specs is not None:
+            spec = input_specs.get(name)
+        elif input_arity is not None:
+            spec = _arity_input_specs(m, input_arity, device)
+
+        def register(hook_name):
+            if spec is None:
+                _register_module_hook(m, hook_name, name)
+            else:
+                _register_module_hook(m, hook_name, name, spec[hook_name], spec['device'])
+
         if isinstance(m, fwd_pre_hook_module_list):
-            _register_module_hook(m, 'activation_pre_process', name)
+            register('activation_pre_process')
         if isinstance(m, bwd_pre_hook_module_list):
-            _register_module_hook(m, 'error_pre_process', name)
+            register('error_pre_process')
         if bwd_residual and (
             any(layer in name for layer in RESIDUAL_LAYERS_BWD)
             or isinstance(m, _parse_ops("residual"))
         ):
-            _register_module_hook(m, 'error_post_process', name)
+            register('error_post_process')
 
     named_modules = dict(module.named_children())
     for name, child in named_modules.items():
@@ -186,21 +385,42 @@ def _add_observer_(
         else:
             _add_observer_(
                 child, fwd_pre_hook_module_list, bwd_pre_hook_module_list,
-                bwd_residual, op_fusion, module_prefix)
+                bwd_residual, op_fusion, module_prefix, input_specs,
+                input_arity, device)
     insert_obs_or_fq(module, prefix)
 
 def prepare(
         model, inplace=False, fwd_quantized_ops=None, bwd_quantized_ops=None,
-        op_fusion=None):
+        op_fusion=None, example_inputs=None, input_arity=None):
+    r"""Attach activation and error observers to the modules of the given
+    operation types through forward and backward hooks.
+
+    By default, observers are created when a hook first sees a tensor. With
+    ``example_inputs``, the model is run once to find the tensor inputs of
+    every module and all observers are created up front. ``input_arity`` maps
+    module types to their number of tensor inputs and is used instead of
+    example inputs, e.g. ``MODULE_INPUT_ARITY``. Modules missing from it take
+    one input. Unlike ``example_inputs``, ``input_arity`` also creates
+    observers for modules that never run, so the state dict can have keys
+    that lazily created observers would not.
+    """
     if not inplace:
         model = copy.deepcopy(model)
 
+    input_specs = None
+    if example_inputs is not None:
+        input_specs = _record_input_specs(model, example_inputs)
+
+    devices = _get_unique_devices_(model)
+    device = next(iter(devices)) if len(devices) == 1 else None
+
     fwd_pre_hook_module_list = _parse_ops(fwd_quantized_ops)
     bwd_pre_hook_module_list = _parse_ops(bwd_quantized_ops)
     is_bwd_residual = bwd_quantized_ops and "residual" in bwd_quantized_ops
     _add_observer_(
         model, fwd_pre_hook_module_list, bwd_pre_hook_module_list,
-        is_bwd_residual, op_fusion, prefix='')
+        is_bwd_residual, op_fusion, prefix='', input_specs=input_specs,
+        input_arity=input_arity, device=device)
     return model
 
 def convert(module, mapping=None, inplace=False, custom_module_class_mapping=None):
@@ -299,21 +519,127 @@ def replace_softmax(
     posit_exp_shifted: bool,
     posit_reciprocal: bool,
     dtype=None,
-    device=None
+    device=None,
+    recompute=False,
+    integer=False,
+    scale=2 ** -8,
+    output_bits=8,
 ):
+    """Replace nn.Softmax with the posit lookup table Softmax, or with the
+    integer-only IntSoftmax if ``integer`` is set. ``scale`` and
+    ``output_bits`` are the input scale and output fraction bits of
+    IntSoftmax.
+    """
     if device is None:
         devices = _get_unique_devices_(module)
         device = next(iter(devices)) if len(devices) == 1 else None
 
     for name, mod in module.named_children():
         if type_before_parametrizations(mod) == nn.Softmax:
-            new_mod = Softmax(posit_exp, posit_exp_shifted, posit_reciprocal,
-                              dim=-1, dtype=dtype, device=device)
+            if integer:
+                new_mod = IntSoftmax(dim=-1, scale=scale, output_bits=output_bits)
+            else:
+                new_mod = Softmax(posit_exp, posit_exp_shifted, posit_reciprocal,
+                                  dim=-1, recompute=recompute, dtype=dtype, device=device)
             setattr(module, name, new_mod)
         else:
-            replace_softmax(mod, posit_exp, posit_exp_shifted, posit_reciprocal, dtype, device)
+            replace_softmax(mod, posit_exp, posit_exp_shifted, posit_reciprocal,
+                            dtype, device, recompute, integer, scale, output_bits)
+
+# Module type -> function of the lookup table that replaces it
+LUT_ACTIVATION_MAPPINGS = {
+    nn.GELU: lambda mod: "gelu_tanh" if mod.approximate == "tanh" else "gelu",
+    nn.Tanh: lambda mod: "tanh",
+    nn.SiLU: lambda mod: "silu",
+    activations.GELUActivation: lambda mod: "gelu",
+    activations.NewGELUActivation: lambda mod: "gelu_tanh",
+    activations.PytorchGELUTanh: lambda mod: "gelu_tanh",
+    activations.FastGELUActivation: lambda mod: "gelu_tanh",
+}
+
+def replace_activation(module: Module, functions=None, dtype=None):
+    """Replace activations with LUTActivation and nn.LayerNorm with
+    LUTLayerNorm in place.
+
+    Args:
+        module: module to rewrite
+        functions: names of the functions to replace, e.g. ("gelu", "rsqrt").
+            rsqrt replaces the LayerNorms. All of them are replaced if None.
+        dtype: format of the table entries
+    """
+    for name, mod in module.named_children():
+        mod_type = type_before_parametrizations(mod)
+        if mod_type in LUT_ACTIVATION_MAPPINGS:
+            function = LUT_ACTIVATION_MAPPINGS[mod_type](mod)
+            if functions is None or function in functions:
+                setattr(module, name, LUTActivation(function, dtype))
+        elif mod_type == nn.LayerNorm:
+            if functions is None or "rsqrt" in functions:
+                setattr(module, name, LUTLayerNorm.from_float(mod, dtype))
+        else:
+            replace_activation(mod, functions, dtype)
+
+def merge_and_quantize(model: Module, keep_fake_quant=False, inplace=True):
+    """Replace every qat.LoraLinear in the model with a linear layer whose
+    weight has the active adapters folded in and the final weight fake
+    quantization applied, for evaluation and export.
 
-def get_quantized_model(model, qconfig, op_fusion=None, device=None):
+    Args:
+        model: model with LoRA QAT modules
+        keep_fake_quant: swap in qat.Linear modules that keep fake quantizing
+            the merged weight instead of nn.Linear modules with the fake
+            quantized weight
+        inplace: whether to modify the model in place
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+
+    for name, mod in model.named_children():
+        if isinstance(mod, nnqat.LoraLinear):
+            setattr(model, name, mod.merge_and_quantize(keep_fake_quant))
+        else:
+            merge_and_quantize(mod, keep_fake_quant, inplace=True)
+    return model
+
+def set_batch_adapters(model: Module, adapter_names=None):
+    """Name the LoRA adapter of every request in the next batches, so that
+    requests for different adapters are served in one forward pass over the
+    shared base model. Rows whose adapter is None only use the base model.
+    Passing None restores the active adapters. The forward raises a
+    ValueError for a batch that does not have one row per adapter name.
+
+    Args:
+        model: model with LoRA QAT modules
+        adapter_names: adapter of every row of the batch
+    """
+    modules = [mod for mod in model.modules() if isinstance(mod, nnqat.LoraLinear)]
+    if adapter_names is None:
+        for mod in modules:
+            mod.batch_adapters = None
+        return model
+
+    known = {adapter for mod in modules for adapter in mod.lora_A.keys()}
+    unknown = {adapter for adapter in adapter_names if adapter is not None} - known
+    if unknown:
+        raise ValueError(f"Unknown adapter(s): {', '.join(sorted(unknown))}")
+
+    groups = {}
+    for mod in modules:
+        device = mod.weight.device
+        if device not in groups:
+            groups[device] = group_adapters(adapter_names, device)
+        mod.batch_adapters = groups[device]
+    return model
+
+def get_quantized_model(model, qconfig, op_fusion=None, device=None, per_layer=False):
+    """Rebuild a BERT or MobileBERT model with fake quantized activations.
+
+    Which activations are quantized is decided once when the model is built:
+    sites whose name contains an entry of ``op_fusion`` are skipped and all
+    other sites get the activation fake quantizer of ``qconfig``. The fake
+    quantizer is shared by all sites, or created per site if ``per_layer``
+    is True.
+    """
     logger.info(f"Fusing operations: {op_fusion}")
 
     if device is None:
@@ -323,18 +649,12 @@ def get_quantized_model(model, qconfig, op_fusion=None, device=None):
         )
         device = next(iter(devices)) if len(devices) > 0 else None
 
-    act_fake_quant = qconfig.activation(device=device)
-    class Quantizer(torch.autograd.Function):
-        @staticmethod
-        def forward(ctx, input, layer=None):
-            ctx.layer = layer
-            if op_fusion and any(x in layer for x in op_fusion):
-                return input
-            return act_fake_quant(input)
+    act_fake_quant = None if per_layer else qconfig.activation(device=device)
 
-        @staticmethod
-        def backward(ctx, grad_output):
-            return grad_output, None
+    def get_quantizer(name):
+        if op_fusion and any(x in name for x in op_fusion):
+            return None
+        return act_fake_quant or qconfig.activation(device=device)
 
     model_name = type(model).__name__
     model_type = model_name.split("For", 1)[0]
@@ -343,8 +663,9 @@ def get_quantized_model(model, qconfig, op_fusion=None, device=None):
     )
 
     module = modeling_bert if model_type == "Bert" else modeling_mobilebert
-    quantized_model = getattr(module, model_name)(model.config, Quantizer.apply)
+    quantized_model = getattr(module, model_name)(model.config)
     quantized_model.load_state_dict(model.state_dict())
+    set_quantization_plan(quantized_model, get_quantizer)
     quantized_model.to(device)
 
     return quantized_model
@@ -24,7 +24,7 @@ from torch.fx.passes.utils.source_matcher_utils import get_source_partitions
 import quantized_training as qt
 from quantized_training.codegen.mapping import _decompose_node
 from quantized_training.export_utils import _allow_exported_model_train_eval
-from quantized_training.fake_quantize import FusedAmaxObsFakeQuantize, get_fake_quant_fn
+from quantized_training.fake_quantize import FusedAmaxObsFakeQuantize, get_quantization_map
 from quantized_training.quantizer.quantizer import QuantizationSpec
 from quantized_training.quantizer.xnnpack_quantizer import XNNPACKQuantizer
 from quantized_training.quantizer.xnnpack_quantizer_utils import QuantizationConfig
@@ -32,7 +32,7 @@ from quantized_training.quantizer.xnnpack_quantizer_utils import QuantizationCon
 from .codegen.mapping_utils import _is_nop
 from .codegen.mapping import get_input_nodes
 from .decomposed import quantized_decomposed_lib
-from .mx_utils import _reshape_to_blocks, _shared_exponents
+from .mx_utils import _mx_shared_exponents
 
 
 def _create_obs_or_fq_from_qspec(quantization_spec, obs_or_fq_map, is_qat):
@@ -136,7 +136,10 @@ def get_default_quantizer(
     weight: Optional[QuantizationSpec],
     bias: Optional[QuantizationSpec],
     record_histogram: bool = False,
-    force_scale_power_of_two: bool = False
+    force_scale_power_of_two: bool = False,
+    compile_kernel: bool = False,
+    histogram_sample_every: int = 1,
+    histogram_sample_size: Optional[int] = None,
 ) -> XNNPACKQuantizer:
     """
     Create a quantizer for the given activation and weight quantization specifications.
@@ -146,6 +149,9 @@ def get_default_quantizer(
     - weight: The quantization spec for weights.
     - record_histogram: Whether to record histogram of input.
     - force_scale_power_of_two: Whether to force the scaling factor to be a power of two.
+    - compile_kernel: Whether to run fake quantization with the compiled kernel.
+    - histogram_sample_every: Record the histogram on every k-th call.
+    - histogram_sample_size: Number of randomly sampled elements to record in the histogram.
 
     Returns:
     - A configured XNNPACKQuantizer.
@@ -154,6 +160,9 @@ def get_default_quantizer(
     observer_or_fake_quant_ctr = FusedAmaxObsFakeQuantize.with_args(
         record_histogram=record_histogram,
         force_scale_power_of_two=force_scale_power_of_two,
+        compile_kernel=compile_kernel,
+        histogram_sample_every=histogram_sample_every,
+        histogram_sample_size=histogram_sample_size,
     )
 
     qschemes = []
@@ -259,11 +268,7 @@ QUANTIZATION_DTYPES = {
 
 
 def _get_quantization_map(dtype, device):
-    values = torch.arange(2 ** 16, dtype=torch.int16).view(torch.bfloat16)
-    if dtype is not None:
-        fq_fn = get_fake_quant_fn(dtype)
-        values = fq_fn(values)
-    return values.to(device)
+    return get_quantization_map(dtype, device)
 
 
 def _replace_observer_with_quantize_dequantize_node_decomposed(
@@ -413,28 +418,14 @@ def _calculate_mx_qparam(
     block_size: int = 32,
 ) -> torch.Tensor:
     axes = [axes] if type(axes) == int else axes
-    axes = [x + input.ndim if x < 0 else x for x in axes]
-
-    # Perform tiling to the hardware vector size
-    reshaped, axes, _, _ = _reshape_to_blocks(
-        input, axes, block_size
-    )
 
-    shared_exp_axes = [x + 1 for x in axes] if block_size > 0 else axes
-
-    # Get shared exponents
-    shared_exp = _shared_exponents(
-        reshaped, method="max", axes=shared_exp_axes, ebits=0,
-    )
+    # Get shared exponents from the exponent bits of the block maxima
+    shared_exp = _mx_shared_exponents(input, axes, block_size)
 
     # Offset the max exponent by the largest representable exponent
     # in the element data format
     shared_exp = shared_exp - math.floor(math.log2(quant_max))
 
-    for axis in reversed(axes):
-        # Remove extra dimension
-        shared_exp = torch.squeeze(shared_exp, dim=axis + 1)
-
     return shared_exp.to(input.dtype)
 
 
@@ -312,6 +312,14 @@ def add_qspec_args(parser=None):
         default="query,value",
         help="The modules (for example, attention blocks) to apply the LoRA update matrices."
     )
+    parser.add_argument(
+        "--lora_low_rank_forward",
+        action="store_true",
+        help=(
+            "Apply the LoRA adapters as low-rank products next to the cached quantized base weight "
+            "instead of quantizing the merged weight on every step."
+        ),
+    )
     parser.add_argument(
         "--peft_model_id",
         default=None,
@@ -387,6 +395,26 @@ def add_qspec_args(parser=None):
         action='store_true',
         help='Whether to force the scaling factor to be a power of two.',
     )
+    parser.add_argument(
+        '--compile_fake_quant',
+        action='store_true',
+        help='Whether to run fake quantization with a kernel compiled by torch.compile.',
+    )
+    parser.add_argument(
+        '--create_observers_up_front',
+        action='store_true',
+        help=(
+            'Whether to create all activation and error observers when the hooks are registered, '
+            'instead of when a module first runs. Observers are also created for modules that '
+            'never run, so the state dict can differ from lazily created observers.'
+        ),
+    )
+    parser.add_argument(
+        '--weight_quant_num_workers',
+        type=int,
+        default=0,
+        help='Number of threads used to quantize the model weights.',
+    )
     parser.add_argument(
         '--calibration_steps',
         type=int,
@@ -419,11 +447,50 @@ def add_qspec_args(parser=None):
         action="store_true",
         help="Whether to use posit approximated reciprocal function in softmax."
     )
+    parser.add_argument(
+        "--lut_activation",
+        nargs="+",
+        default=None,
+        help="Functions evaluated with lookup tables, e.g. gelu tanh silu rsqrt.",
+    )
+    parser.add_argument(
+        "--lut_activation_dtype",
+        default=None,
+        help="Format of the lookup table entries, e.g. posit16_1.",
+    )
+    parser.add_argument(
+        "--int_softmax",
+        action="store_true",
+        help="Whether to use the integer-only softmax.",
+    )
+    parser.add_argument(
+        "--int_softmax_scale",
+        type=float,
+        default=2 ** -8,
+        help="Scale of the integer input of the integer-only softmax.",
+    )
+    parser.add_argument(
+        "--softmax_recompute",
+        action="store_true",
+        help="Recompute the exponential in the softmax backward pass instead of saving it.",
+    )
     parser.add_argument(
         "--record_histogram",
         action="store_true",
         help="Whether to store and plot the histogram of tensor value.",
     )
+    parser.add_argument(
+        "--histogram_sample_every",
+        type=int,
+        default=1,
+        help="Record the histogram on every k-th call of each quantizer.",
+    )
+    parser.add_argument(
+        "--histogram_sample_size",
+        type=int,
+        default=None,
+        help="Number of randomly sampled elements per call to record in the histogram.",
+    )
     #----------------------------------------------------
     # Slurm arguments
     #----------------------------------------------------
@@ -0,0 +1,13 @@
+import os
+import tempfile
+
+
+def pytest_configure(config):
+    # Keep lookup tables generated by the tests, including those built while
+    # collecting test modules, out of the user's cache directory
+    config._table_dir = tempfile.TemporaryDirectory(prefix="quantized_training_tables_")
+    os.environ["QUANTIZED_TRAINING_TABLE_DIR"] = config._table_dir.name
+
+
+def pytest_unconfigure(config):
+    config._table_dir.cleanup()
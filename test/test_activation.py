@@ -0,0 +1,78 @@
+import copy
+import gc
+import weakref
+
+import torch
+from torch import nn
+from transformers.activations import GELUActivation
+
+from quantized_training import replace_activation
+from quantized_training.modules import LUTActivation, LUTLayerNorm
+from quantized_training.modules import activation
+from quantized_training.modules.activation import get_activation_table
+from quantized_training.quant_tables import load_table
+
+
+def test_lut_activation_matches_function_on_bfloat16():
+    x = torch.randn(4, 256).bfloat16()
+    for function, fn in [
+        ("gelu", nn.functional.gelu),
+        ("tanh", torch.tanh),
+        ("silu", nn.functional.silu),
+        ("exp", torch.exp),
+    ]:
+        expected = fn(x.float()).bfloat16()
+        torch.testing.assert_close(LUTActivation(function)(x), expected, atol=0, rtol=0)
+
+
+def test_lut_activation_table_is_rounded_and_shared():
+    table = get_activation_table("tanh", "fp8_e4m3")
+    assert table is LUTActivation("tanh", "fp8_e4m3").table
+    torch.testing.assert_close(table, table.to(torch.float8_e4m3fn).float(), atol=0, rtol=0, equal_nan=True)
+
+
+def test_lut_tables_are_not_reloaded(monkeypatch):
+    loads = []
+
+    def counting_load_table(name, build_fn, dtype):
+        loads.append(name)
+        return load_table(name, build_fn, dtype)
+
+    monkeypatch.setattr(activation, "_TABLE_CACHE", weakref.WeakValueDictionary())
+    monkeypatch.setattr(activation, "load_table", counting_load_table)
+    modules = [LUTActivation("gelu", "fp8_e4m3"), LUTLayerNorm(16, table_dtype="fp8_e4m3")]
+    x = torch.randn(2, 16)
+    for _ in range(5):
+        for module in modules:
+            module(x)
+        gc.collect()
+    assert sorted(loads) == ["gelu_fp8_e4m3", "rsqrt_fp8_e4m3"]
+    assert copy.deepcopy(modules[0]).table is modules[0].table
+
+
+def test_lut_activation_backward_uses_exact_gradient():
+    x = torch.randn(16, 32, requires_grad=True)
+    LUTActivation("silu")(x).sum().backward()
+
+    expected_x = x.detach().clone().requires_grad_()
+    nn.functional.silu(expected_x).sum().backward()
+    torch.testing.assert_close(x.grad, expected_x.grad)
+
+
+def test_replace_activation():
+    model = nn.Sequential(
+        nn.Linear(16, 16),
+        GELUActivation(),
+        nn.LayerNorm(16),
+        nn.Sequential(nn.Tanh(), nn.SiLU()),
+    )
+    x = torch.randn(8, 16)
+    expected = model(x)
+
+    replace_activation(model, functions=("gelu", "rsqrt", "tanh"))
+    assert isinstance(model[1], LUTActivation) and model[1].function == "gelu"
+    assert isinstance(model[2], LUTLayerNorm)
+    assert isinstance(model[3][0], LUTActivation)
+    assert isinstance(model[3][1], nn.SiLU)
+
+    torch.testing.assert_close(model(x), expected, atol=5e-2, rtol=5e-2)
@@ -0,0 +1,39 @@
+import functools
+
+import pytest
+import torch
+
+from quantized_training.fake_quantize import _quantize, get_quantization_map
+from quantized_training.fp8 import _quantize_elemwise_core, quantize_to_fp8_e4m3
+from quantized_training.normal_float import quantize_to_nf
+from quantized_training.posit import quantize_to_posit
+
+
+QUANTIZERS = [
+    functools.partial(quantize_to_posit, nbits=8, es=1),
+    quantize_to_fp8_e4m3,
+    functools.partial(_quantize_elemwise_core, bits=5, exp_bits=3, max_norm=28.0,
+                      round="even", saturate_normals=True),
+    quantize_to_nf,
+    functools.partial(_quantize, quant_map=get_quantization_map("posit8_1"), dtype="posit8_1"),
+    functools.partial(_quantize, quant_map=get_quantization_map("int8"), dtype="int8"),
+]
+
+
+@pytest.mark.parametrize("quantize", QUANTIZERS)
+@pytest.mark.parametrize("num_threads", [0, 3])
+def test_chunked_quantization_matches_whole_input(quantize, num_threads):
+    x = torch.randn(37, 41) * 4
+    expected = quantize(x)
+
+    output = quantize(x, chunk_size=100, num_threads=num_threads)
+    assert torch.equal(output, expected)
+
+    out = torch.empty_like(expected)
+    assert quantize(x, chunk_size=100, out=out, num_threads=num_threads) is out
+    assert torch.equal(out, expected)
+
+    if expected.dtype == x.dtype:
+        y = x.t().contiguous().t()
+        assert quantize(y, chunk_size=64, out=y) is y
+        assert torch.equal(y, expected)
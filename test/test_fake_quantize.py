@@ -0,0 +1,449 @@
+import copy
+import functools
+import math
+
+import pytest
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+import quantized_training as qt
+from quantized_training import FusedAmaxObsFakeQuantize
+from quantized_training.decomposed import _apply_block_scale, _mul_exp2
+from quantized_training.fake_quantize import (
+    MXFakeQuantFunction,
+    _quantize,
+    get_quantization_map,
+)
+from quantized_training.fp8 import quantize_to_fp8_e4m3, quantize_to_fp8_e5m2
+from quantized_training.mx_utils import (
+    _exponent_from_bits,
+    _reshape_to_blocks,
+    _shared_exponents,
+    _undo_reshape_to_blocks,
+)
+from quantized_training.normal_float import get_normal_code_book, quantize_to_nf
+
+
+class SyncCounter(TorchDispatchMode):
+    """Counts operators that copy tensor values back to the host."""
+
+    SYNC_OPS = {
+        torch.ops.aten._local_scalar_dense.default,
+        torch.ops.aten.item.default,
+        torch.ops.aten.is_nonzero.default,
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        if func in self.SYNC_OPS:
+            self.count += 1
+        return func(*args, **(kwargs or {}))
+
+
+def _make_fake_quant(qscheme, device=None, **kwargs):
+    if qscheme == qt.microscaling:
+        return FusedAmaxObsFakeQuantize(
+            "int8", qscheme=qscheme, quant_max=64, ch_axis=-1, block_size=32, device=device, **kwargs)
+    return FusedAmaxObsFakeQuantize(
+        "int8", qscheme=qscheme, quant_max=127, ch_axis=0, device=device, **kwargs)
+
+
+@pytest.mark.parametrize("qscheme", [
+    qt.per_tensor_symmetric, qt.per_channel_symmetric, qt.microscaling,
+])
+def test_forward_has_no_host_sync(qscheme):
+    fq = _make_fake_quant(qscheme, record_histogram=True)
+    x = torch.randn(8, 64)
+    fq(x)
+
+    with SyncCounter() as counter:
+        for _ in range(3):
+            fq(x)
+        fq.disable_observer()
+        fq(x)
+        fq.disable_fake_quant()
+        fq(x)
+    assert counter.count == 0
+
+
+@pytest.mark.parametrize("qscheme", [qt.per_tensor_symmetric, qt.per_channel_symmetric])
+def test_forward_on_meta_tensors(qscheme):
+    # Meta tensors have no data, so any host read raises
+    fq = _make_fake_quant(qscheme, device="meta")
+    x = torch.randn(8, 64, device="meta")
+    for _ in range(3):
+        out = fq(x)
+    assert out.shape == x.shape and out.device.type == "meta"
+
+
+def test_enable_flags_follow_state_dict():
+    fq = _make_fake_quant(qt.per_tensor_symmetric)
+    fq.disable_observer()
+    fq.disable_fake_quant()
+
+    new_fq = _make_fake_quant(qt.per_tensor_symmetric)
+    new_fq.load_state_dict(fq.state_dict())
+    x = torch.randn(4, 4)
+    assert torch.equal(new_fq(x), x)
+
+
+def test_quantization_map_is_shared_after_apply():
+    fake_quants = [FusedAmaxObsFakeQuantize("fp8_e4m3") for _ in range(2)]
+    assert fake_quants[0].quant_map is fake_quants[1].quant_map
+
+    fake_quants[0].to("meta")
+    assert fake_quants[0].quant_map is get_quantization_map("fp8_e4m3", "meta")
+    assert fake_quants[1].quant_map is get_quantization_map("fp8_e4m3")
+
+    fake_quants[0].to_empty(device="cpu")
+    assert copy.deepcopy(fake_quants[0]).quant_map is fake_quants[0].quant_map
+    fake_quants[1].double()
+    assert fake_quants[0].quant_map is fake_quants[1].quant_map
+    assert fake_quants[0].quant_map.dtype == torch.bfloat16
+
+
+
+def _legacy_observe(amax_history, scale, input, quant_max):
+    """Scale update of the original implementation, which rolls the whole
+    history and keeps the newest amax at index 0."""
+    amax = torch.amax(amax_history, dim=0)
+    amax_history.copy_(torch.roll(amax_history, -1, 0))
+    amax_history[0] = torch.amax(torch.abs(input))
+    scale.copy_(torch.where(amax > 0.0, amax / quant_max, scale))
+
+
+@pytest.mark.parametrize("amax_history_len", [1, 6, 7, 12])
+def test_amax_history_ring_buffer(amax_history_len):
+    fq = FusedAmaxObsFakeQuantize(
+        "int8", qscheme=qt.per_tensor_symmetric, quant_max=127, amax_history_len=amax_history_len)
+    amaxes = []
+    for i in range(3 * amax_history_len + 2):
+        # Shrinking inputs make the scale depend on the oldest entries
+        amax = float(4 * amax_history_len - i) if i % 3 else 0.5
+        x = torch.full((4, 4), amax)
+        expected_scale = max(amaxes[-amax_history_len:], default=127.0) / 127
+        fq(x)
+        amaxes.append(amax)
+        assert fq.scale.item() == pytest.approx(expected_scale)
+
+
+def test_load_legacy_amax_history():
+    torch.manual_seed(0)
+    amax_history_len = 6
+    inputs = [torch.randn(8, 8) * float(2 ** (i % 5)) for i in range(15)]
+
+    history = torch.zeros(amax_history_len)
+    scale = torch.ones(())
+    for x in inputs[:8]:
+        _legacy_observe(history, scale, x, 127)
+
+    fq = FusedAmaxObsFakeQuantize(
+        "int8", qscheme=qt.per_tensor_symmetric, quant_max=127, amax_history_len=amax_history_len)
+    state_dict = fq.state_dict()
+    state_dict["amax_history"] = history.clone()
+    state_dict["scale"] = scale.clone()
+    fq.load_state_dict(state_dict)
+
+    for x in inputs[8:]:
+        _legacy_observe(history, scale, x, 127)
+        fq(x)
+        assert torch.equal(fq.scale, scale)
+        # The ring buffer is saved in the original layout
+        assert torch.equal(fq.state_dict()["amax_history"], history)
+
+
+@pytest.mark.parametrize("input_dtype", [torch.float32, torch.bfloat16])
+def test_compiled_kernel_matches_eager(input_dtype):
+    eager = FusedAmaxObsFakeQuantize(
+        "fp8_e4m3", qscheme=qt.per_tensor_symmetric, quant_max=448)
+    compiled = FusedAmaxObsFakeQuantize(
+        "fp8_e4m3", qscheme=qt.per_tensor_symmetric, quant_max=448, compile_kernel=True, inplace=True)
+    for i in range(3):
+        x = (torch.randn(16, 32) * (i + 1)).to(input_dtype)
+        assert torch.equal(eager(x), compiled(x))
+    assert torch.equal(eager.scale, compiled.scale)
+
+    x = torch.randn(16, 32).to(input_dtype)
+    expected = eager(x)
+    with torch.inference_mode():
+        x = x.clone()
+        out = compiled(x)
+    assert out.data_ptr() == x.data_ptr()
+    assert torch.equal(out, expected)
+
+
+def test_compiled_kernel_under_torch_compile():
+    eager = FusedAmaxObsFakeQuantize(
+        "fp8_e4m3", qscheme=qt.per_tensor_symmetric, quant_max=448)
+    fq = FusedAmaxObsFakeQuantize(
+        "fp8_e4m3", qscheme=qt.per_tensor_symmetric, quant_max=448, compile_kernel=True)
+    compiled = torch.compile(fq)
+    for i in range(3):
+        x = torch.randn(16, 32) * (i + 1)
+        assert torch.equal(eager(x), compiled(x))
+    assert torch.equal(eager.scale, fq.scale)
+    assert torch.equal(eager.amax_history, fq.amax_history)
+
+
+@pytest.mark.parametrize("input_dtype", [torch.float32, torch.bfloat16])
+def test_exponent_histogram_matches_log2(input_dtype):
+    fq = _make_fake_quant(qt.per_tensor_symmetric, record_histogram=True)
+    x = torch.randn(64, 64).to(input_dtype) * torch.logspace(-30, 30, 64)[:, None]
+    fq(x)
+
+    exp = torch.floor(torch.log2(torch.abs(x.float())))
+    assert torch.equal(fq.histogram, torch.histc(exp, 254, min=-126, max=127))
+
+
+def test_histogram_sampling():
+    fq = _make_fake_quant(
+        qt.per_tensor_symmetric, record_histogram=True,
+        histogram_sample_every=2, histogram_sample_size=16)
+    for _ in range(3):
+        fq(torch.randn(8, 8))
+    assert fq.histogram.sum() == 32
+
+
+def test_histogram_sampling_does_not_advance_global_rng():
+    fq = _make_fake_quant(
+        qt.per_tensor_symmetric, record_histogram=True, histogram_sample_size=16)
+    x = torch.randn(8, 8)
+    state = torch.get_rng_state()
+    fq(x)
+    assert torch.equal(torch.get_rng_state(), state)
+
+    copy.deepcopy(fq)(x)
+    assert torch.equal(torch.get_rng_state(), state)
+
+
+@pytest.mark.parametrize("qscheme", [
+    None, qt.per_tensor_symmetric, qt.per_channel_symmetric, qt.microscaling,
+])
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_quantize_weights_matches_per_parameter(qscheme, num_workers):
+    model = torch.nn.Sequential(*(torch.nn.Linear(64, 64) for _ in range(3)), torch.nn.Linear(64, 32))
+    expected = []
+    for name, param in model.named_parameters():
+        if 'bias' in name:
+            continue
+        fq = _make_fake_quant(qscheme)
+        if qscheme is not None:
+            fq(param.data)
+        expected.append(fq(param.data))
+
+    ctr = functools.partial(_make_fake_quant, qscheme)
+    qt.quantize_weights_(model, ctr, chunk_numel=2 * 64 * 64, num_workers=num_workers)
+    weights = [p for n, p in model.named_parameters() if 'bias' not in n]
+    for param, ref in zip(weights, expected):
+        assert torch.equal(param.data, ref)
+
+
+def test_quantize_weights_bfloat16_power_of_two_scale():
+    # 0.0546875 / 448.5 rounds up to 2 ** -13 in bfloat16, so the scale is
+    # only right when it is computed in float32
+    model = torch.nn.Linear(4, 4, bias=False).to(torch.bfloat16)
+    model.weight.data.fill_(0.01)[0, 0] = 0.0546875
+    ctr = functools.partial(
+        FusedAmaxObsFakeQuantize, "fp8_e4m3", qscheme=qt.per_tensor_symmetric,
+        quant_max=448.5, force_scale_power_of_two=True)
+    fq = ctr()
+    fq(model.weight.data)
+    expected = fq(model.weight.data)
+
+    qt.quantize_weights_(model, ctr)
+    assert fq.scale.item() == 2 ** -14
+    assert torch.equal(model.weight.data, expected)
+
+
+def _padded_mx_fake_quant(input, quant_map, quant_max, axes, block_size):
+    axes = [axes] if type(axes) == int else axes
+    axes = [x + input.ndim if x < 0 else x for x in axes]
+    input, axes, orig_shape, padded_shape = _reshape_to_blocks(input, axes, block_size)
+    shared_exp = _shared_exponents(input, method="max", axes=[x + 1 for x in axes])
+    scale = 2 ** (shared_exp - math.floor(math.log2(quant_max)))
+    input = _quantize(input / scale, quant_map) * scale
+    return _undo_reshape_to_blocks(input, padded_shape, orig_shape, axes)
+
+
+@pytest.mark.parametrize("shape,axes", [
+    ((4, 64), -1), ((4, 70), -1), ((70, 6), -2), ((3, 5, 40), [1, 2]), ((2, 3, 10), -1),
+])
+def test_mx_fake_quant_matches_padded_blocks(shape, axes):
+    quant_map = get_quantization_map("int8")
+    x = torch.randn(shape) * torch.logspace(-3, 3, shape[-1])
+    x[0, ..., 0] = 0
+    for input in (x, x.transpose(0, 1).contiguous().transpose(0, 1)):
+        expected = _padded_mx_fake_quant(input, quant_map, 64, axes, 16)
+        assert torch.equal(MXFakeQuantFunction.apply(input, True, quant_map, 64, "max", axes, 16), expected)
+
+
+def test_exponent_from_bits_subnormal():
+    # Built from bit patterns, since compiled kernels may enable flushing
+    # denormals for the whole process
+    amax = torch.tensor([
+        0, 0x1, 0x3 << 9, 0x7fffff, 0x800000, 0x3fc00000, 0x7f800000,
+    ], dtype=torch.int32).view(torch.float32)
+    expected = torch.tensor([-126.0, -149.0, -139.0, -127.0, -126.0, 0.0, float("inf")])
+    assert torch.equal(_exponent_from_bits(amax), expected)
+
+
+# 70 channels end in a ragged block of 6
+@pytest.mark.parametrize("channels", [64, 70], ids=["full", "ragged"])
+def test_mx_fake_quant_channels_last(channels):
+    quant_map = get_quantization_map("fp8_e4m3")
+    x = torch.randn(2, channels, 5, 7)
+    nhwc = x.contiguous(memory_format=torch.channels_last)
+    expected = MXFakeQuantFunction.apply(x, True, quant_map, 448, "max", 1, 32)
+    output = MXFakeQuantFunction.apply(nhwc, True, quant_map, 448, "max", 1, 32)
+    assert output.is_contiguous(memory_format=torch.channels_last)
+    assert torch.equal(output, expected)
+    # The padding-free plan gives the same result as zero padded blocks
+    assert torch.equal(output, _padded_mx_fake_quant(x, quant_map, 448, 1, 32))
+
+
+def _repeated_block_scale(scale, channels, block_size=32):
+    return scale.repeat_interleave(block_size, 1)[:, :channels]
+
+
+@pytest.mark.parametrize("channels", [64, 70], ids=["full", "ragged"])
+def test_apply_block_scale_channels_last(channels):
+    x = torch.randn(2, channels, 6, 6)
+    scale = torch.randint(-3, 3, (2, math.ceil(channels / 32), 6, 6)).float()
+    nhwc = x.contiguous(memory_format=torch.channels_last)
+    for fn, expected in [
+        (_mul_exp2, x * 2 ** _repeated_block_scale(scale, channels)),
+        (torch.div, x / _repeated_block_scale(scale, channels)),
+    ]:
+        for input in (x, nhwc):
+            output = _apply_block_scale(fn, input, scale, 32)
+            assert torch.equal(output, expected)
+        assert output.is_contiguous(memory_format=torch.channels_last)
+
+
+@pytest.mark.parametrize("channels", [64, 70], ids=["full", "ragged"])
+def test_conv2d_mx_channels_last(channels):
+    x = torch.randn(2, channels, 6, 6)
+    weight = torch.randn(16, channels, 3, 3)
+    num_blocks = math.ceil(channels / 32)
+    scale_inp = torch.randint(-3, 3, (2, num_blocks, 6, 6)).float()
+    scale_wt = torch.randint(-3, 3, (16, num_blocks, 3, 3)).float()
+    # Convolutions in NHWC accumulate in a different order than in NCHW
+    expected = torch.nn.functional.conv2d(
+        (x * 2 ** _repeated_block_scale(scale_inp, channels)).contiguous(memory_format=torch.channels_last),
+        weight * 2 ** _repeated_block_scale(scale_wt, channels),
+    )
+    nhwc = x.contiguous(memory_format=torch.channels_last)
+    output = torch.ops.quantized_ops.conv2d_mx(
+        nhwc, weight, scale_inp=scale_inp, scale_wt=scale_wt, block_size=32)
+    assert output.is_contiguous(memory_format=torch.channels_last)
+    assert torch.equal(output, expected)
+
+
+# Exponent bits, mantissa bits and largest value of the IEEE-like formats.
+# float8_e4m3fn and the MX fp6/fp4 formats have no infinities and use the
+# top exponent for normal values.
+_FLOAT_FORMATS = {
+    "fp8_e4m3": (4, 3, 448.0),
+    "fp8_e5m2": (5, 2, 57344.0),
+    "fp6_e3m2": (3, 2, 28.0),
+    "fp6_e2m3": (2, 3, 7.5),
+    "fp4_e2m1": (2, 1, 6.0),
+}
+
+
+def _float_format_values(ebits, mbits, max_norm):
+    """Non-negative values of a float format in code order."""
+    bias = 2 ** (ebits - 1) - 1
+    values = [k * 2.0 ** (1 - bias - mbits) for k in range(2 ** mbits)]
+    for exp in range(1, 2 ** ebits):
+        values += [(1 + k / 2 ** mbits) * 2.0 ** (exp - bias) for k in range(2 ** mbits)]
+    return torch.tensor([v for v in values if v <= max_norm], dtype=torch.float64)
+
+
+def _round_to_float_format(x, dtype):
+    """Round to the nearest value of the format with ties to even codes,
+    saturating at the largest value."""
+    values = _float_format_values(*_FLOAT_FORMATS[dtype])
+    a = torch.clamp(x.double().abs(), max=values[-1])
+    hi = torch.clamp(torch.searchsorted(values, a), max=len(values) - 1)
+    lo = torch.clamp(hi - 1, min=0)
+    d_lo, d_hi = a - values[lo], values[hi] - a
+    use_hi = (d_hi < d_lo) | ((d_hi == d_lo) & (hi % 2 == 0))
+    return torch.copysign(torch.where(use_hi, values[hi], values[lo]), x.double())
+
+
+def _finite_bfloat16_values():
+    x = torch.arange(2 ** 16, dtype=torch.int16).view(torch.bfloat16)
+    return x[torch.isfinite(x)]
+
+
+@pytest.mark.parametrize("dtype", list(_FLOAT_FORMATS))
+def test_float_quantizer_matches_reference(dtype):
+    x = _finite_bfloat16_values()
+    expected = _round_to_float_format(x, dtype)
+    quant_map = get_quantization_map(dtype)
+    assert torch.equal(_quantize(x, quant_map).double(), expected)
+    assert torch.equal(_quantize(x, quant_map, dtype).double(), expected)
+
+    # float32 inputs between bfloat16 values take the arithmetic path
+    x = torch.randn(10000) * torch.logspace(-4, 4, 10000)
+    assert torch.equal(_quantize(x, quant_map, dtype).double(), _round_to_float_format(x, dtype))
+
+
+@pytest.mark.parametrize("dtype,reference", [
+    ("e4m3", quantize_to_fp8_e4m3), ("e5m2", quantize_to_fp8_e5m2),
+])
+def test_native_float8_matches_bitwise_reference(dtype, reference):
+    x = _finite_bfloat16_values()
+    quant_map = get_quantization_map(dtype)
+    assert torch.equal(_quantize(x, quant_map), reference(x))
+    assert torch.equal(_quantize(x.float(), quant_map, dtype), reference(x.float()))
+
+
+def test_int_quantizer_values():
+    x = torch.tensor([0.5, 1.5, 2.5, -2.5, 3.49, 126.5, 127.4, 130.0, -128.6, -300.0])
+    expected = torch.tensor([0.0, 2.0, 2.0, -2.0, 3.0, 126.0, 127.0, 127.0, -128.0, -128.0])
+    quant_map = get_quantization_map("int8")
+    assert torch.equal(_quantize(x, quant_map, "int8"), expected)
+    assert torch.equal(_quantize(x.bfloat16(), quant_map), expected.bfloat16())
+
+
+@pytest.mark.parametrize("dtype", list(_FLOAT_FORMATS))
+def test_float_quantizer_rounds_below_half_subnormal_to_zero(dtype):
+    ebits, mbits, _ = _FLOAT_FORMATS[dtype]
+    min_subnormal = 2.0 ** (2 - 2 ** (ebits - 1) - mbits)
+    x = torch.tensor([0.99, 1.0, 1.01]) * (min_subnormal / 2)
+    x = torch.cat([x, -x])
+    expected = torch.tensor([0.0, 0.0, 1.0, 0.0, 0.0, -1.0]) * min_subnormal
+    quant_map = get_quantization_map(dtype)
+    assert torch.equal(_quantize(x, quant_map, dtype), expected)
+    assert torch.equal(_quantize(x.bfloat16(), quant_map), expected.bfloat16())
+
+
+@pytest.mark.parametrize("dtype", list(_FLOAT_FORMATS))
+def test_float_quantizer_saturates_near_float_max(dtype):
+    max_norm = _FLOAT_FORMATS[dtype][2]
+    x = torch.tensor([3e38, -3e38, torch.finfo(torch.bfloat16).max])
+    expected = torch.tensor([max_norm, -max_norm, max_norm])
+    quant_map = get_quantization_map(dtype)
+    assert torch.equal(_quantize(x, quant_map, dtype), expected)
+    assert torch.equal(_quantize(x.bfloat16(), quant_map), expected.bfloat16())
+
+
+def test_arithmetic_int_quantizer_is_exact_for_float32():
+    x = torch.tensor([100.25, 101.25, -101.25, 126.75])
+    quant_map = get_quantization_map("int8")
+    assert torch.equal(_quantize(x, quant_map, "int8"), torch.round(x))
+
+
+def test_normal_float_codes():
+    x = torch.randn(1000)
+    values, codes = quantize_to_nf(x, 4, return_codes=True)
+    code_book, _ = get_normal_code_book(4, x.device)
+    expected = code_book[torch.argmin(torch.abs(code_book - x.unsqueeze(-1)), dim=-1)]
+    assert codes.dtype == torch.uint8
+    assert torch.equal(values, expected)
+    assert torch.equal(code_book[codes.long()], values)
@@ -0,0 +1,17 @@
+import pytest
+import torch
+
+from quantized_training.posit import decode_posit, encode_posit, quantize_to_posit
+
+
+@pytest.mark.parametrize("nbits,es", [(8, 1), (8, 0), (6, 2), (16, 1)])
+@pytest.mark.parametrize("input_dtype", [torch.float32, torch.bfloat16])
+def test_posit_codes_round_trip(nbits, es, input_dtype):
+    x = torch.arange(2 ** 16, dtype=torch.int16).view(torch.bfloat16).to(input_dtype)
+    expected = quantize_to_posit(x, nbits, es)
+
+    codes = encode_posit(x, nbits, es, chunk_size=10000)
+    assert codes.dtype == (torch.uint8 if nbits <= 8 else torch.int16)
+    output = decode_posit(codes, nbits, es, dtype=input_dtype)
+    assert torch.equal(output.isnan(), expected.isnan())
+    assert torch.equal(output.nan_to_num(), expected.nan_to_num())
@@ -0,0 +1,271 @@
+import pytest
+import torch
+
+import quantized_training as qt
+from quantized_training import get_qconfig
+from quantized_training.modules import qat
+
+
+def _make_linear():
+    qspec = qt.QuantizationSpec.from_str("int8,qs=per_tensor_symmetric")
+    qconfig = get_qconfig(None, qspec, None)
+    linear = qat.Linear(16, 16, qconfig=qconfig)
+    with torch.no_grad():
+        for _ in range(2):
+            linear.weight_fake_quant(linear.weight)
+    linear.weight_fake_quant.disable_observer()
+    return linear
+
+
+def test_weight_cache_reused_until_weight_changes():
+    linear = _make_linear()
+    x = torch.randn(4, 16)
+    with torch.no_grad():
+        out = linear(x)
+        cached = linear._weight_cache
+        assert cached is not None
+        assert torch.equal(linear(x), out)
+        assert linear._weight_cache is cached
+
+        linear.weight.mul_(2)
+        out = linear(x)
+        assert linear._weight_cache is not cached
+        expected = torch.nn.functional.linear(x, linear.weight_fake_quant(linear.weight), linear.bias)
+        assert torch.equal(out, expected)
+
+
+def test_weight_cache_disabled():
+    linear = _make_linear()
+    x = torch.randn(4, 16)
+
+    out = linear(x)
+    assert linear._weight_cache is None
+    out.sum().backward()
+
+    linear.cache_weight_fake_quant = False
+    with torch.no_grad():
+        linear(x)
+    assert linear._weight_cache is None
+
+    linear.cache_weight_fake_quant = True
+    linear.weight_fake_quant.enable_observer()
+    with torch.no_grad():
+        linear(x)
+    assert linear._weight_cache is None
+
+
+def _make_lora_linear(activation=False):
+    from peft import LoraConfig, get_peft_model
+    torch.manual_seed(0)
+    model = get_peft_model(
+        torch.nn.Sequential(torch.nn.Linear(64, 64)),
+        LoraConfig(r=4, lora_alpha=8, target_modules=["0"]),
+    )
+    mod = model.base_model.model[0]
+    torch.nn.init.normal_(mod.lora_B["default"].weight)
+    qspec = qt.QuantizationSpec.from_str("int8,qs=per_tensor_symmetric")
+    mod.qconfig = get_qconfig(qspec if activation else None, qspec, None)
+    return qat.LoraLinear.from_float(mod)
+
+
+def test_lora_merged_forward_matches_merged_weight():
+    linear = _make_lora_linear()
+    x = torch.randn(8, 64)
+    out = linear(x)
+
+    reference = _make_lora_linear()
+    A = reference.weight_fake_quant(reference.lora_A["default"].weight)
+    B = reference.weight_fake_quant(reference.lora_B["default"].weight)
+    weight = reference.weight_fake_quant(reference.weight + B @ A * reference.scaling["default"])
+    torch.testing.assert_close(out, torch.nn.functional.linear(x, weight, reference.bias), atol=0, rtol=0)
+
+
+def test_lora_low_rank_forward_caches_base_weight():
+    linear = _make_lora_linear(activation=True)
+    linear.low_rank_forward = True
+    x = torch.randn(8, 64)
+
+    for _ in range(3):
+        out = linear(x)
+    assert not linear.weight_fake_quant._observer_enabled
+    cached = linear._weight_cache
+    assert cached is not None
+
+    out.sum().backward()
+    assert linear.lora_A["default"].weight.grad is not None
+    assert linear.weight.grad is None
+    linear(x)
+    assert linear._weight_cache is cached
+
+    for name in linear._LOW_RANK_FAKE_QUANTS:
+        getattr(linear, name).disable_observer()
+    with torch.no_grad():
+        out = linear(x)
+        A = linear.weight_A_fake_quant(linear.lora_A["default"].weight)
+        B = linear.weight_B_fake_quant(linear.lora_B["default"].weight)
+        hidden = linear.adapter_act_fake_quant(x @ A.T)
+        weight = linear.weight_fake_quant(linear.weight)
+        expected = torch.nn.functional.linear(x, weight, linear.bias) + hidden @ B.T * linear.scaling["default"]
+    assert linear.weight_A_fake_quant.scale.item() != 1.0
+    assert linear.adapter_act_fake_quant.scale.item() != 1.0
+    torch.testing.assert_close(out, expected, atol=1e-6, rtol=1e-6)
+
+
+def test_lora_low_rank_fake_quants_in_state_dict():
+    linear = _make_lora_linear()
+    keys = set(linear.state_dict())
+    assert not any("weight_A_fake_quant" in key for key in keys)
+    linear(torch.randn(8, 64))
+
+    # Checkpoints of the merged forward load without the low-rank quantizers
+    merged = _make_lora_linear()
+    merged.load_state_dict(linear.state_dict())
+    assert set(merged.state_dict()) == keys
+
+    linear.low_rank_forward = True
+    linear(torch.randn(8, 64))
+    low_rank = _make_lora_linear()
+    low_rank.load_state_dict(linear.state_dict())
+    assert not low_rank.low_rank_forward
+    torch.testing.assert_close(low_rank.weight_A_fake_quant.scale, linear.weight_A_fake_quant.scale)
+
+
+def test_lora_merge_and_quantize_matches_merged_forward():
+    linear = _make_lora_linear()
+    x = torch.randn(8, 64)
+    for _ in range(2):
+        linear(x)
+    fake_quant = linear.weight_fake_quant
+    fake_quant.disable_observer()
+    expected = linear(x)
+    # Merging does not observe the merged weight
+    fake_quant.enable_observer()
+    buffers = {name: buf.clone() for name, buf in fake_quant.named_buffers()}
+    merged = linear.merge_and_quantize()
+    merged_fq = linear.merge_and_quantize(keep_fake_quant=True)
+    model = qt.merge_and_quantize(torch.nn.Sequential(linear), inplace=False)
+    assert type(linear.to_float()) is torch.nn.Linear
+    assert fake_quant._observer_enabled
+    for name, buf in fake_quant.named_buffers():
+        assert torch.equal(buf, buffers[name]), name
+
+    assert type(merged) is torch.nn.Linear
+    torch.testing.assert_close(merged(x), expected, atol=0, rtol=0)
+    assert type(model[0]) is torch.nn.Linear
+    torch.testing.assert_close(model(x), expected, atol=0, rtol=0)
+
+    assert type(merged_fq) is qat.Linear and merged_fq.weight_fake_quant is fake_quant
+    fake_quant.disable_observer()
+    torch.testing.assert_close(merged_fq(x), expected, atol=0, rtol=0)
+
+
+@pytest.mark.parametrize("low_rank", [False, True])
+def test_lora_batch_adapters_match_single_adapter(low_rank):
+    from peft import LoraConfig, get_peft_model
+    torch.manual_seed(0)
+    model = get_peft_model(
+        torch.nn.Sequential(torch.nn.Linear(64, 64)),
+        LoraConfig(r=4, lora_alpha=8, target_modules=["0"]),
+        adapter_name="a",
+    )
+    model.add_adapter("b", LoraConfig(r=2, lora_alpha=4, target_modules=["0"]))
+    mod = model.base_model.model[0]
+    for adapter in ("a", "b"):
+        torch.nn.init.normal_(mod.lora_B[adapter].weight)
+    qspec = qt.QuantizationSpec.from_str("int8,qs=per_tensor_symmetric")
+    mod.qconfig = get_qconfig(qspec, qspec, None)
+    linear = qat.LoraLinear.from_float(mod)
+    linear.low_rank_forward = low_rank
+
+    # Train both adapters so that the scales they are served with are calibrated
+    for adapter in ("a", "b"):
+        linear.set_adapter(adapter)
+        params = [linear.lora_A[adapter].weight, linear.lora_B[adapter].weight]
+        optimizer = torch.optim.SGD(params, lr=0.1)
+        for _ in range(3):
+            linear(torch.randn(4, 8, 64)).square().mean().backward()
+            optimizer.step()
+            optimizer.zero_grad()
+    linear.eval()
+
+    fake_quants = [m for m in linear.modules() if isinstance(m, qt.FusedAmaxObsFakeQuantize)]
+    state = [(m._observer_enabled, m.scale.clone(), m.amax_history.clone()) for m in fake_quants]
+    assert any(enabled for enabled, _, _ in state)
+    x = torch.randn(4, 8, 64)
+    names = ["a", None, "b", "a"]
+    with torch.no_grad():
+        qt.set_batch_adapters(torch.nn.Sequential(linear), names)
+        out = linear(x)
+        # Serving neither updates nor depends on the observer state
+        torch.testing.assert_close(linear(x), out, atol=0, rtol=0)
+        for m, (enabled, scale, history) in zip(fake_quants, state):
+            assert m._observer_enabled == enabled
+            assert torch.equal(m.scale, scale) and torch.equal(m.amax_history, history)
+
+        qt.set_batch_adapters(linear, None)
+        for m in fake_quants:
+            m.disable_observer()
+        for i, name in enumerate(names):
+            if name is None:
+                weight = linear.weight_fake_quant(linear.weight)
+                expected = torch.nn.functional.linear(x[i], weight, linear.bias)
+            else:
+                linear.set_adapter(name)
+                expected = linear(x[i])
+            torch.testing.assert_close(out[i], expected, atol=1e-6, rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        qt.set_batch_adapters(linear, ["c"])
+    # One adapter name per row is required
+    qt.set_batch_adapters(linear, names[:3])
+    with pytest.raises(ValueError):
+        linear(x)
+
+
+def _make_conv_bn():
+    torch.manual_seed(0)
+    qspec = qt.QuantizationSpec.from_str("int8,qs=per_tensor_symmetric")
+    conv_bn = qat.ConvBn2d(8, 16, 3, padding=1, bias=True, qconfig=get_qconfig(None, qspec, None))
+    with torch.no_grad():
+        conv_bn.bn.running_mean.normal_()
+        conv_bn.bn.running_var.uniform_(0.5, 2)
+        conv_bn.bn.bias.normal_()
+        for _ in range(2):
+            conv_bn.weight_fake_quant(conv_bn.weight)
+    conv_bn.weight_fake_quant.disable_observer()
+    return conv_bn
+
+
+def test_conv_bn_frozen_matches_approximate_path():
+    conv_bn = _make_conv_bn().freeze_bn_stats()
+    x = torch.randn(2, 8, 10, 10)
+    out = conv_bn(x)
+    torch.testing.assert_close(out, conv_bn._forward_approximate(x), atol=1e-4, rtol=1e-4)
+
+    out.sum().backward()
+    assert conv_bn.weight.grad is not None and conv_bn.bn.weight.grad is not None
+    assert conv_bn._weight_cache is None
+
+
+def test_conv_bn_eval_keeps_approximate_path():
+    conv_bn = _make_conv_bn().eval()
+    x = torch.randn(2, 8, 10, 10)
+    with torch.no_grad():
+        assert torch.equal(conv_bn(x), conv_bn._forward_approximate(x))
+    assert conv_bn._weight_cache is None
+
+
+def test_conv_bn_frozen_caches_folded_weight():
+    conv_bn = _make_conv_bn().freeze_bn_stats().eval()
+    x = torch.randn(2, 8, 10, 10)
+    with torch.no_grad():
+        out = conv_bn(x)
+        cached = conv_bn._weight_cache
+        assert cached is not None
+        assert torch.equal(conv_bn(x), out)
+        assert conv_bn._weight_cache is cached
+
+        conv_bn.bn.running_var.mul_(2)
+        out = conv_bn(x)
+        assert conv_bn._weight_cache is not cached
+        torch.testing.assert_close(out, conv_bn._forward_approximate(x), atol=1e-4, rtol=1e-4)
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from quantized_training import quant_tables
+from quantized_training.quant_tables import get_table_dir, load_table
+
+
+@pytest.fixture
+def table_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("QUANTIZED_TRAINING_TABLE_DIR", str(tmp_path))
+    return tmp_path
+
+
+class CountingBuilder:
+    def __init__(self, table):
+        self.table = table
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.table
+
+
+def test_load_table_builds_once(table_dir):
+    build_fn = CountingBuilder(torch.arange(16, dtype=torch.float))
+    first = load_table("test", build_fn, torch.float)
+    second = load_table("test", build_fn, torch.float)
+
+    assert build_fn.calls == 1
+    assert os.listdir(get_table_dir()) == ["test.npy"]
+    assert get_table_dir() == str(table_dir / f"v{quant_tables.TABLE_VERSION}")
+    assert torch.equal(first, build_fn.table)
+    assert torch.equal(second, build_fn.table)
+
+
+def test_load_table_rebuilds_after_version_bump(table_dir, monkeypatch):
+    load_table("test", CountingBuilder(torch.zeros(4)), torch.float)
+
+    monkeypatch.setattr(quant_tables, "TABLE_VERSION", quant_tables.TABLE_VERSION + 1)
+    build_fn = CountingBuilder(torch.ones(4))
+    table = load_table("test", build_fn, torch.float)
+
+    assert build_fn.calls == 1
+    assert torch.equal(table, torch.ones(4))
+    assert sorted(os.listdir(table_dir)) == [
+        f"v{quant_tables.TABLE_VERSION - 1}", f"v{quant_tables.TABLE_VERSION}"]
+
+
+def test_load_table_rebuilds_corrupt_table(table_dir):
+    load_table("test", CountingBuilder(torch.zeros(4)), torch.float)
+    with open(os.path.join(get_table_dir(), "test.npy"), "wb") as f:
+        f.write(b"not a table")
+
+    build_fn = CountingBuilder(torch.ones(4))
+    assert torch.equal(load_table("test", build_fn, torch.float), torch.ones(4))
+    assert build_fn.calls == 1
+    # The rebuilt table replaced the corrupt file
+    assert torch.equal(load_table("test", build_fn, torch.float), torch.ones(4))
+    assert build_fn.calls == 1
+
+
+def test_failed_save_leaves_no_partial_table(table_dir, monkeypatch):
+    def failing_save(f, array):
+        f.write(b"partial")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(np, "save", failing_save)
+    table = load_table("test", CountingBuilder(torch.ones(4)), torch.float)
+
+    assert torch.equal(table, torch.ones(4))
+    assert os.listdir(get_table_dir()) == []
+
@@ -0,0 +1,152 @@
+import copy
+
+import pytest
+import torch
+from torch import nn
+
+import quantized_training as qt
+from quantized_training import get_qconfig, prepare, propagate_config
+from quantized_training.modules.quantization_plan import set_quantization_plan
+from quantized_training.modules.quantizable import AddFunctional, MatmulFunctional, MulFunctional
+from quantized_training.quantization_mappings import MODULE_INPUT_ARITY
+from quantized_training.training_args import add_qspec_args
+
+
+class Block(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(16, 16)
+        self.gelu = nn.GELU()
+        self.scaling = MulFunctional()
+        self.matmul = MatmulFunctional()
+        self.residual = AddFunctional()
+
+    def forward(self, x):
+        h = self.scaling(self.gelu(self.linear(x)), 0.5)
+        h = self.matmul(h, h.transpose(-1, -2))
+        return self.residual(x, h[..., :16])
+
+
+def _make_model():
+    torch.manual_seed(0)
+    model = nn.Sequential(Block(), Block())
+    qspec = qt.QuantizationSpec.from_str("int8,qs=per_tensor_symmetric")
+    propagate_config(model, "qconfig", get_qconfig(qspec, None, qspec))
+    return model
+
+
+def _observer_names(model):
+    return sorted(
+        name for name, m in model.named_modules() if isinstance(m, qt.FusedAmaxObsFakeQuantize)
+    )
+
+
+@pytest.mark.parametrize("static", ["example_inputs", "input_arity"])
+def test_prepare_creates_observers_up_front(static):
+    x = torch.randn(2, 16, 16, requires_grad=True)
+    ops = ("gemm,activation,residual,scaling", "gemm,residual")
+
+    lazy = prepare(_make_model(), False, *ops)
+    kwargs = {"example_inputs": (x,)} if static == "example_inputs" else {"input_arity": MODULE_INPUT_ARITY}
+    eager = prepare(_make_model(), False, *ops, **kwargs)
+
+    names = _observer_names(eager)
+    assert len(names) > 0 and _observer_names(lazy) == []
+    # No observer has seen data yet
+    assert all(m.scale.item() == 1.0 for m in eager.modules() if isinstance(m, qt.FusedAmaxObsFakeQuantize))
+
+    outputs = []
+    for model in (lazy, eager):
+        input = x.detach().clone().requires_grad_()
+        output = model(input)
+        output.sum().backward()
+        outputs.append((output, input.grad))
+
+    assert _observer_names(lazy) == names
+    torch.testing.assert_close(outputs[0], outputs[1])
+
+
+class BlockWithUnusedLayer(Block):
+    def __init__(self):
+        super().__init__()
+        self.unused = nn.Linear(16, 16)
+
+
+@pytest.mark.parametrize("up_front", [False, True])
+def test_quantize_creates_observers_lazily_by_default(up_front):
+    argv = [
+        "--activation", "int8,qs=per_tensor_symmetric",
+        "--error", "int8,qs=per_tensor_symmetric",
+        "--quantize_forward", "gemm,activation,residual,scaling",
+        "--quantize_backprop", "gemm,residual",
+    ]
+    args = add_qspec_args().parse_args(argv + (["--create_observers_up_front"] if up_front else []))
+    torch.manual_seed(0)
+    model = qt.quantize(nn.Sequential(BlockWithUnusedLayer(), BlockWithUnusedLayer()), args)
+    assert (len(_observer_names(model)) > 0) == up_front
+
+    model(torch.randn(2, 16, 16, requires_grad=True)).sum().backward()
+    names = _observer_names(model)
+    assert any(".unused." in name for name in names) == up_front
+    if not up_front:
+        # Same observers as the lazy prepare() without any static information
+        lazy = prepare(_make_model(), False, args.quantize_forward, args.quantize_backprop)
+        lazy(torch.randn(2, 16, 16, requires_grad=True)).sum().backward()
+        assert names == _observer_names(lazy)
+
+
+def test_error_quantization_without_backward_hooks():
+    torch.manual_seed(0)
+    linear = nn.Linear(16, 16)
+    qspec = qt.QuantizationSpec.from_str("fp8_e5m2,qs=per_tensor_symmetric")
+    propagate_config(linear, "qconfig", get_qconfig(None, None, qspec))
+    linear = prepare(linear, False, None, "gemm", input_arity={})
+    assert not linear._backward_hooks and not linear._backward_pre_hooks
+
+    x = torch.randn(4, 16)
+    grad = torch.randn(4, 16)
+    obs_or_fq = copy.deepcopy(linear.error_pre_process["0"])
+    linear(x).backward(grad)
+
+    expected = obs_or_fq(grad).t() @ x
+    torch.testing.assert_close(linear.weight.grad, expected)
+
+    # No gradient is quantized without autograd
+    with torch.no_grad():
+        linear(x)
+    assert torch.equal(linear.error_pre_process["0"].scale, obs_or_fq.scale)
+
+
+def _tiny_bert():
+    from transformers import BertConfig, BertForQuestionAnswering
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=32, hidden_size=16, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=16,
+    )
+    return BertForQuestionAnswering(config).eval()
+
+
+def test_quantized_model_resolves_sites_once():
+    model = _tiny_bert()
+    qspec = qt.QuantizationSpec.from_str("posit16_1")
+    qconfig = get_qconfig(qspec, None, None)
+
+    quantized = qt.get_quantized_model(model, qconfig, op_fusion=["residual"])
+    output = quantized.bert.encoder.layer[1].output
+    assert output.input_quantizers["residual.hidden_states"] is not output.input_quantizers["dense"]
+    assert output.input_quantizers["dense"].fake_quant is quantized.input_fake_quants["qa_outputs"]
+    assert list(quantized.input_fake_quants) == ["qa_outputs"]
+
+    per_layer = qt.get_quantized_model(model, qconfig, op_fusion=["residual"], per_layer=True).eval()
+    assert "bert_encoder_layer_1_output_dense" in per_layer.input_fake_quants
+    assert not any("residual" in name for name in per_layer.input_fake_quants)
+
+    input_ids = torch.randint(0, 32, (2, 8))
+    assert per_layer(input_ids).start_logits.isfinite().all()
+
+    # Without a plan every site is the identity
+    set_quantization_plan(per_layer, None)
+    assert not hasattr(per_layer, "input_fake_quants")
+    torch.testing.assert_close(
+        per_layer(input_ids).start_logits, model(input_ids).start_logits, atol=0, rtol=0)
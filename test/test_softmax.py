@@ -0,0 +1,174 @@
+import copy
+import gc
+import weakref
+
+import pytest
+import torch
+from torch import nn
+from torch._export import capture_pre_autograd_graph
+
+from quantized_training import replace_softmax
+from quantized_training.codegen import ShapeProp
+from quantized_training.codegen.mapping_utils import OP_TO_MAPPING_FUNC
+from quantized_training.modules import softmax
+from quantized_training.modules.softmax import IntSoftmax, Softmax, get_softmax_table
+from quantized_training.quant_tables import load_table
+
+
+def test_posit_softmax_tables_are_shared():
+    softmaxes = [Softmax(posit_exp=True, posit_reciprocal=True, dim=-1) for _ in range(2)]
+    posit_exp = softmaxes[0].posit_exp
+    gc.collect()
+    assert softmaxes[1].posit_exp is posit_exp
+    assert softmaxes[0].posit_reciprocal is get_softmax_table("posit16_1_reciprocal")
+    assert copy.deepcopy(softmaxes[0]).posit_exp is posit_exp
+
+    x = torch.randn(2, 4, 16, 16)
+    output = softmaxes[0](x)
+    torch.testing.assert_close(output, torch.softmax(x, dim=-1), atol=1e-3, rtol=1e-2)
+
+
+def test_posit_softmax_tables_are_not_reloaded(monkeypatch):
+    loads = []
+
+    def counting_load_table(name, build_fn, dtype):
+        loads.append(name)
+        return load_table(name, build_fn, dtype)
+
+    monkeypatch.setattr(softmax, "_TABLE_CACHE", weakref.WeakValueDictionary())
+    monkeypatch.setattr(softmax, "load_table", counting_load_table)
+    module = Softmax(posit_exp=True, posit_reciprocal=True, dim=-1, dtype=torch.bfloat16)
+    x = torch.randn(2, 16)
+    for _ in range(5):
+        module(x)
+        gc.collect()
+    assert len(loads) == 2
+
+
+def test_posit_softmax_recompute_in_backward():
+    torch.manual_seed(0)
+    x = torch.randn(2, 4, 16, 16)
+    grad = torch.randn_like(x)
+
+    results = []
+    for recompute in (False, True):
+        softmax = Softmax(posit_exp=True, posit_reciprocal=True, dim=-1, recompute=recompute)
+        input = x.clone().requires_grad_()
+        output = softmax(input)
+        output.backward(grad)
+        results.append((output.detach(), input.grad))
+
+    torch.testing.assert_close(results[0][0], results[1][0], atol=0, rtol=0)
+    torch.testing.assert_close(results[0][1], results[1][1])
+
+
+class BaselinePositSoftmax(torch.autograd.Function):
+    """PositSoftmax before the max shift moved into the function, applied to
+    an input that autograd shifts by its max."""
+
+    @staticmethod
+    def forward(ctx, i, posit_exp, posit_reciprocal):
+        exp_x = softmax._convert(i, posit_exp)
+        exp_x_sum = torch.sum(exp_x, dim=-1, keepdim=True)
+        output = exp_x * softmax._convert(exp_x_sum, posit_reciprocal)
+        ctx.save_for_backward(output, exp_x, exp_x_sum)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        output, exp_x, exp_x_sum = ctx.saved_tensors
+        grad_input = output * grad_output
+        sum_grad = torch.sum(exp_x * grad_output, dim=-1, keepdim=True)
+        deriv = torch.pow(2, torch.floor(torch.log2(exp_x_sum)) * -2 - 1)
+        grad_input -= deriv * exp_x * sum_grad
+        return grad_input, None, None
+
+
+def test_posit_softmax_gradient_matches_baseline():
+    torch.manual_seed(0)
+    x = torch.randn(2, 4, 16, 16)
+    # Tied maxima share the gradient of the shift
+    x[0, 0, :, :2] = 5.0
+    grad = torch.randn_like(x)
+
+    expected_input = x.clone().requires_grad_()
+    module = Softmax(posit_exp=True, posit_reciprocal=True, dim=-1)
+    shifted = expected_input - torch.amax(expected_input, dim=-1, keepdim=True)
+    expected = BaselinePositSoftmax.apply(shifted, module.posit_exp, module.posit_reciprocal)
+    expected.backward(grad)
+
+    for recompute in (False, True):
+        input = x.clone().requires_grad_()
+        output = Softmax(posit_exp=True, posit_reciprocal=True, dim=-1, recompute=recompute)(input)
+        output.backward(grad)
+        torch.testing.assert_close(output, expected, atol=0, rtol=0)
+        torch.testing.assert_close(input.grad, expected_input.grad, atol=1e-6, rtol=1e-5)
+
+
+def test_posit_softmax_dim():
+    torch.manual_seed(0)
+    x = torch.randn(4, 16, 8)
+    grad = torch.randn_like(x)
+
+    for dim in (1, -1):
+        input = x.clone().requires_grad_()
+        output = Softmax(dim=dim)(input)
+        output.backward(grad)
+
+        expected_input = x.clone().requires_grad_()
+        expected = torch.softmax(expected_input, dim=dim)
+        expected.backward(grad)
+
+        torch.testing.assert_close(output, expected)
+        torch.testing.assert_close(input.grad, expected_input.grad)
+
+
+def test_int_softmax():
+    torch.manual_seed(0)
+    x = torch.randn(2, 4, 32, 32) * 3
+    output = IntSoftmax(dim=-1)(x)
+    torch.testing.assert_close(output, torch.softmax(x, dim=-1), atol=2 ** -7, rtol=0)
+    # The output is a fixed-point number with 8 fraction bits
+    torch.testing.assert_close(output, torch.round(output * 256) / 256, atol=0, rtol=0)
+
+
+@pytest.mark.parametrize("mask_value", [float("-inf"), torch.finfo(torch.float32).min])
+def test_int_softmax_masked(mask_value):
+    torch.manual_seed(0)
+    x = torch.randn(2, 4, 32, 32) * 3
+    mask = torch.ones(32, 32, dtype=torch.bool).triu(1)
+    x = x.masked_fill(mask, mask_value)
+    output = IntSoftmax(dim=-1)(x)
+    assert torch.all(output[..., mask] == 0)
+    torch.testing.assert_close(output, torch.softmax(x, dim=-1), atol=2 ** -7, rtol=0)
+
+
+def test_replace_softmax_with_int_softmax():
+    model = nn.Sequential(nn.Linear(8, 8), nn.Softmax(dim=-1))
+    replace_softmax(model, False, False, False, integer=True, scale=2 ** -10)
+    assert isinstance(model[1], IntSoftmax) and model[1].scale == 2 ** -10
+
+    x = torch.randn(4, 8, requires_grad=True)
+    model(x).sum().backward()
+    assert x.grad is not None
+
+
+def test_int_softmax_codegen_reduce_param():
+    class Attention(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.softmax = IntSoftmax(dim=-1, output_bits=10)
+
+        def forward(self, x):
+            return self.softmax(x @ x.transpose(-1, -2))
+
+    x = torch.randn(2, 8, 16)
+    gm = capture_pre_autograd_graph(Attention(), (x,))
+    ShapeProp(gm).propagate(x)
+
+    nodes = [n for n in gm.graph.nodes if n.target == torch.ops.quantized_ops.softmax_int.default]
+    assert len(nodes) == 1
+    param = OP_TO_MAPPING_FUNC["reduce"](nodes[0], None)
+    assert param.opcode == "softmax_int"
+    assert list(param.dim) == [-1]
+    assert param.scale == 2 ** -8 and param.output_bits == 10